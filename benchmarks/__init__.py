@@ -0,0 +1 @@
+"""Load-test and benchmark harness that runs the services against a fake Dapr sidecar"""
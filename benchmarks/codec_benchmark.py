@@ -0,0 +1,135 @@
+"""Compare the JSON codecs on the payloads the services exchange most.
+
+Times encoding and decoding an order_created event, an inventory_processed
+event and an order list response with the standard library json module
+and, when it is installed, orjson. Both are called with the options
+common.codec uses.
+
+Run from the repository root:
+    python -m benchmarks.codec_benchmark --items 20 --number 2000
+"""
+import argparse
+import json
+import sys
+import timeit
+import uuid
+from datetime import datetime
+
+from common import codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def order_created_event(items):
+    return {
+        "event_id": str(uuid.uuid4()),
+        "order_id": str(uuid.uuid4()),
+        "customer_id": "customer-42",
+        "items": [
+            {"product_id": f"product-{i}", "name": f"Product {i}", "quantity": 1 + i % 3, "price": 9.99 + i}
+            for i in range(items)
+        ],
+        "total_amount": sum((9.99 + i) * (1 + i % 3) for i in range(items)),
+        "event_type": "order_created",
+    }
+
+
+def inventory_processed_event(items):
+    order_id = str(uuid.uuid4())
+    return {
+        "event_id": f"inventory_processed:{order_id}",
+        "order_id": order_id,
+        "customer_id": "customer-42",
+        "inventory_status": [
+            {"product_id": f"product-{i}", "status": "reserved", "reserved_quantity": 1, "remaining_quantity": 1000 - i}
+            for i in range(items)
+        ],
+        "all_items_reserved": True,
+        "event_type": "inventory_processed",
+    }
+
+
+def order_list(orders, items):
+    return {
+        "orders": [
+            dict(order_created_event(items), status="pending", created_at=datetime.utcnow().isoformat())
+            for _ in range(orders)
+        ],
+        "count": orders,
+    }
+
+
+def codecs():
+    """(name, dumps, loads) for each codec available here"""
+    encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, default=codec._default)
+    found = [("stdlib", lambda obj: encoder.encode(obj).encode("utf-8"), json.loads)]
+    if orjson is not None:
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        found.append(("orjson", lambda obj: orjson.dumps(obj, default=codec._default, option=options), orjson.loads))
+    return found
+
+
+def best_per_call(func, number, repeat):
+    """Fastest of repeat runs, in microseconds per call"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(args):
+    payloads = {
+        "order_created": order_created_event(args.items),
+        "inventory_processed": inventory_processed_event(args.items),
+        "order_list": order_list(args.orders, args.items),
+    }
+    results = {}
+    for payload_name, payload in payloads.items():
+        encoded = json.dumps(payload).encode("utf-8")
+        timings = {"bytes": len(encoded)}
+        for name, dumps, loads in codecs():
+            timings[name] = {
+                "dumps_us": round(best_per_call(lambda: dumps(payload), args.number, args.repeat), 2),
+                "loads_us": round(best_per_call(lambda: loads(encoded), args.number, args.repeat), 2),
+            }
+        results[payload_name] = timings
+    return results
+
+
+def print_summary(results, out):
+    print(f"{'payload':<22}{'bytes':>8}{'codec':>8}{'dumps us':>10}{'loads us':>10}{'speedup':>10}", file=out)
+    for payload_name, timings in results.items():
+        stdlib = timings["stdlib"]
+        for name in ("stdlib", "orjson"):
+            if name not in timings:
+                continue
+            timing = timings[name]
+            speedup = (stdlib["dumps_us"] + stdlib["loads_us"]) / (timing["dumps_us"] + timing["loads_us"])
+            print(
+                f"{payload_name:<22}{timings['bytes']:>8}{name:>8}{timing['dumps_us']:>10}"
+                f"{timing['loads_us']:>10}{speedup:>9.1f}x",
+                file=out
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=20, help="line items per order")
+    parser.add_argument("--orders", type=int, default=50, help="orders in the order list response")
+    parser.add_argument("--number", type=int, default=2000, help="calls per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs; the fastest is reported")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    if orjson is None:
+        print("orjson is not installed; only the stdlib codec is timed", file=sys.stderr)
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_summary(results, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""In-memory stand-in for the Dapr sidecars of all three services.
+
+FakeDapr implements the parts of the Dapr HTTP API the services use: state
+get, bulk get, save, delete and transactions (with ETags, first-write
+concurrency and TTLs), single and bulk publish, and actor method calls.
+Published events are fanned out to every app subscribed to the topic,
+honouring bulk subscribe settings and redelivering entries the app answers
+with RETRY. Actor calls go to the app that registered the actor type, one
+call at a time per actor, as with Dapr's turn-based concurrency. Every sidecar
+call can be slowed down by a fixed latency plus random jitter to mimic a
+real sidecar and Redis round trip.
+
+One FakeDapr serves every sidecar port, so the services share one state
+store and one broker exactly as they would share Redis.
+"""
+import itertools
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+
+import requests
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+# Deliveries the app rejects are retried this many times before being dropped
+MAX_REDELIVERIES = 10
+REDELIVERY_BACKOFF = 0.05
+
+
+def cloud_event(pubsub_name, topic, data):
+    return {
+        "specversion": "1.0",
+        "id": str(uuid.uuid4()),
+        "source": "fake-sidecar",
+        "type": "com.dapr.event.sent",
+        "datacontenttype": "application/json",
+        "pubsubname": pubsub_name,
+        "topic": topic,
+        "data": data,
+    }
+
+
+class Subscription:
+    """One app's subscription to a topic, delivered by its own thread"""
+
+    def __init__(self, dapr, app_id, app_url, entry):
+        self.dapr = dapr
+        self.app_id = app_id
+        self.url = f"{app_url}{entry['route']}"
+        self.pubsub_name = entry["pubsubname"]
+        self.topic = entry["topic"]
+        bulk = entry.get("bulkSubscribe") or {}
+        self.bulk = bool(bulk.get("enabled"))
+        self.max_messages = int(bulk.get("maxMessagesCount", 100))
+        self.max_await = int(bulk.get("maxAwaitDurationMs", 1000)) / 1000.0
+        self.queue = queue.Queue()
+        self.in_flight = 0
+        self.session = requests.Session()
+        threading.Thread(target=self._run, name=f"deliver-{app_id}-{self.topic}", daemon=True).start()
+
+    def offer(self, data):
+        with self.dapr.lock:
+            self.in_flight += 1
+        self.queue.put((data, 0))
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        if not self.bulk:
+            return batch
+        deadline = time.monotonic() + self.max_await
+        while len(batch) < self.max_messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                statuses = self._deliver(batch)
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"Delivery of {len(batch)} {self.topic} events to {self.app_id} failed: {e}")
+                statuses = ["RETRY"] * len(batch)
+            for (data, attempts), status in zip(batch, statuses):
+                if status == "RETRY" and attempts < MAX_REDELIVERIES:
+                    threading.Timer(REDELIVERY_BACKOFF, self.queue.put, ((data, attempts + 1),)).start()
+                    continue
+                if status == "SUCCESS":
+                    self.dapr.delivered(self.app_id, self.topic, data)
+                with self.dapr.lock:
+                    self.in_flight -= 1
+
+    def _deliver(self, batch):
+        """POST a batch to the app and return a status per event"""
+        if not self.bulk:
+            (data, _), = batch
+            response = self.session.post(self.url, json=cloud_event(self.pubsub_name, self.topic, data))
+            return ["SUCCESS" if response.status_code < 300 else "RETRY"]
+
+        entries = [
+            {
+                "entryId": str(i),
+                "event": cloud_event(self.pubsub_name, self.topic, data),
+                "contentType": "application/cloudevents+json",
+            }
+            for i, (data, _) in enumerate(batch)
+        ]
+        response = self.session.post(self.url, json={
+            "id": str(uuid.uuid4()),
+            "entries": entries,
+            "pubsubname": self.pubsub_name,
+            "topic": self.topic,
+            "type": "com.dapr.event.sent.bulk",
+        })
+        if response.status_code >= 300:
+            return ["RETRY"] * len(batch)
+        statuses = {entry["entryId"]: entry["status"] for entry in response.json().get("statuses", [])}
+        # Entries the app left out of its reply count as successful, as in Dapr
+        return [statuses.get(str(i), "SUCCESS") for i in range(len(batch))]
+
+
+class FakeDapr:
+    """State store, broker and HTTP API shared by every fake sidecar"""
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.state = {}  # key -> (value, etag, expires_at)
+        self.subscriptions = []
+        self.listeners = []
+        self.actor_hosts = {}  # actor type -> app URL
+        self._actor_locks = {}
+        self._local = threading.local()
+        self.calls = 0
+        self._etags = itertools.count(1)
+        self._servers = []
+        self.app = self._build_app()
+
+    # State store
+
+    def _get(self, key):
+        entry = self.state.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+            del self.state[key]
+            return None
+        return entry
+
+    def _put(self, key, value, metadata=None):
+        ttl = (metadata or {}).get("ttlInSeconds")
+        expires_at = time.monotonic() + int(ttl) if ttl and int(ttl) > 0 else None
+        self.state[key] = (value, str(next(self._etags)), expires_at)
+
+    def _conflicts(self, item):
+        """True if an item's ETag or first-write condition does not hold"""
+        current = self._get(item["key"])
+        etag = item.get("etag")
+        if etag is not None:
+            return current is None or current[1] != str(etag)
+        first_write = (item.get("options") or {}).get("concurrency") == "first-write"
+        return first_write and current is not None
+
+    def save(self, items):
+        with self.lock:
+            if any(self._conflicts(item) for item in items):
+                return False
+            for item in items:
+                self._put(item["key"], item["value"], item.get("metadata"))
+        return True
+
+    def transact(self, operations):
+        with self.lock:
+            if any(self._conflicts(operation["request"]) for operation in operations):
+                return False
+            for operation in operations:
+                item = operation["request"]
+                if operation["operation"] == "upsert":
+                    self._put(item["key"], item["value"], item.get("metadata"))
+                else:
+                    self.state.pop(item["key"], None)
+        return True
+
+    # Pub/sub
+
+    def subscribe(self, app_id, app_url):
+        """Register an app's programmatic subscriptions from its /dapr/subscribe"""
+        response = requests.get(f"{app_url}/dapr/subscribe")
+        if response.status_code == 404:  # The app subscribes to nothing
+            return
+        response.raise_for_status()
+        for entry in response.json():
+            self.subscriptions.append(Subscription(self, app_id, app_url, entry))
+
+    def register_actors(self, app_url):
+        """Register the actor types an app hosts, from its /dapr/config"""
+        response = requests.get(f"{app_url}/dapr/config")
+        if response.status_code == 404:  # The app hosts no actors
+            return
+        response.raise_for_status()
+        for actor_type in response.json().get("entities", []):
+            self.actor_hosts[actor_type] = app_url
+
+    def invoke_actor(self, actor_type, actor_id, method, body):
+        """Forward an actor call to its host; returns the host's response"""
+        with self.lock:
+            actor_lock = self._actor_locks.setdefault((actor_type, actor_id), threading.Lock())
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        with actor_lock:
+            return session.put(
+                f"{self.actor_hosts[actor_type]}/actors/{actor_type}/{actor_id}/method/{method}",
+                data=body, headers={"Content-Type": "application/json"}
+            )
+
+    def publish(self, pubsub_name, topic, events):
+        for subscription in self.subscriptions:
+            if subscription.pubsub_name == pubsub_name and subscription.topic == topic:
+                for data in events:
+                    subscription.offer(data)
+
+    def delivered(self, app_id, topic, data):
+        for listener in self.listeners:
+            listener(app_id, topic, data)
+
+    def idle(self):
+        """True once every published event has been delivered (or given up on)"""
+        with self.lock:
+            return all(subscription.in_flight == 0 for subscription in self.subscriptions)
+
+    def wait_idle(self, timeout=60.0):
+        deadline = time.monotonic() + timeout
+        while not self.idle():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    # HTTP API
+
+    def _build_app(self):
+        app = Flask("fake-sidecar")
+
+        @app.before_request
+        def inject_latency():
+            with self.lock:
+                self.calls += 1
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay > 0:
+                time.sleep(delay)
+
+        @app.route("/v1.0/state/<store>", methods=["POST"])
+        def save_state(store):
+            if not self.save(request.get_json()):
+                return "possible etag mismatch", 409
+            return "", 204
+
+        @app.route("/v1.0/state/<store>/bulk", methods=["POST"])
+        def get_bulk_state(store):
+            result = []
+            with self.lock:
+                for key in request.get_json()["keys"]:
+                    entry = self._get(key)
+                    result.append({"key": key} if entry is None else {"key": key, "data": entry[0], "etag": entry[1]})
+            return Response(json.dumps(result), content_type="application/json")
+
+        @app.route("/v1.0/state/<store>/transaction", methods=["POST"])
+        def transact_state(store):
+            if not self.transact(request.get_json()["operations"]):
+                # Redis reports a failed ETag check inside a transaction as a 500
+                return "possible etag mismatch. error from state store", 500
+            return "", 204
+
+        @app.route("/v1.0/state/<store>/<path:key>", methods=["GET", "DELETE"])
+        def state_key(store, key):
+            with self.lock:
+                if request.method == "DELETE":
+                    self.state.pop(key, None)
+                    return "", 204
+                entry = self._get(key)
+            if entry is None:
+                return "", 204
+            return Response(json.dumps(entry[0]), content_type="application/json", headers={"ETag": entry[1]})
+
+        @app.route("/v1.0/publish/<pubsub_name>/<topic>", methods=["POST"])
+        def publish(pubsub_name, topic):
+            self.publish(pubsub_name, topic, [request.get_json()])
+            return "", 204
+
+        @app.route("/v1.0-alpha1/publish/bulk/<pubsub_name>/<topic>", methods=["POST"])
+        def publish_bulk(pubsub_name, topic):
+            self.publish(pubsub_name, topic, [entry["event"] for entry in request.get_json()])
+            return "", 204
+
+        @app.route("/v1.0/actors/<actor_type>/<actor_id>/method/<method>", methods=["POST", "PUT"])
+        def invoke_actor(actor_type, actor_id, method):
+            if actor_type not in self.actor_hosts:
+                return f"actor type {actor_type} is not registered", 400
+            response = self.invoke_actor(actor_type, actor_id, method, request.get_data())
+            return Response(response.content, status=response.status_code, content_type=response.headers.get("Content-Type"))
+
+        return app
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the sidecar API on port from a background thread"""
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)  # No per-request access log
+        server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name=f"fake-sidecar-{port}", daemon=True).start()
+        self._servers.append(server)
+        return server
+
+    def shutdown(self):
+        for server in self._servers:
+            server.shutdown()
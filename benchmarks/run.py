@@ -0,0 +1,344 @@
+"""Benchmark the three services end to end against a fake Dapr sidecar.
+
+Starts each Flask app in its own process, pointed at an in-process
+FakeDapr, then drives three scenarios:
+
+- create-order: latency and throughput of POST /orders
+- reservation: POST /inventory/{product_id}/reserve spread over a few hot products
+- event-chain: time from POST /orders until the notification service has
+  handled the order's inventory result, i.e. order -> inventory -> notification
+
+A summary table goes to stderr and the results, as JSON, to stdout or
+--output. With --baseline, the run fails if throughput or p99 latency
+regressed by more than --max-regression against an earlier results file.
+
+Run from the repository root:
+    python -m benchmarks.run --requests 1000 --concurrency 32 --output results.json
+"""
+import argparse
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+from benchmarks.fake_sidecar import FakeDapr
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ("order-service", "inventory-service", "notification-service")
+SCENARIOS = ("create-order", "reservation", "event-chain")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Cluster:
+    """The three services running against one FakeDapr, for the duration of a with block"""
+
+    def __init__(self, latency=0.0, jitter=0.0, app_log=None, startup_timeout=30.0):
+        self.dapr = FakeDapr(latency, jitter)
+        self.app_log = app_log
+        self.startup_timeout = startup_timeout
+        self.urls = {}
+        self._processes = []
+
+    def __enter__(self):
+        log = open(self.app_log, "a") if self.app_log else subprocess.DEVNULL
+        try:
+            for service in SERVICES:
+                sidecar_port = free_port()
+                self.dapr.serve(sidecar_port)
+                app_port = free_port()
+                env = dict(os.environ, DAPR_HTTP_PORT=str(sidecar_port), PYTHONPATH=ROOT)
+                self._processes.append(subprocess.Popen(
+                    [sys.executable, os.path.join(ROOT, "benchmarks", "serve.py"), service, str(app_port)],
+                    env=env, stdout=log, stderr=subprocess.STDOUT
+                ))
+                self.urls[service] = f"http://127.0.0.1:{app_port}"
+            for service, url in self.urls.items():
+                self._wait_healthy(service, url)
+                self.dapr.subscribe(service, url)
+                self.dapr.register_actors(url)
+        except Exception:
+            self.__exit__(*sys.exc_info())
+            raise
+        finally:
+            if self.app_log:
+                log.close()
+        return self
+
+    def _wait_healthy(self, service, url):
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            try:
+                if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{service} did not become healthy within {self.startup_timeout}s")
+            time.sleep(0.1)
+
+    def __exit__(self, *exc_info):
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.dapr.shutdown()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency figures for one scenario; latencies are in seconds"""
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "duration_seconds": round(elapsed, 3),
+        "throughput_per_second": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(sum(values) / len(values), 3) if values else 0.0,
+            "p50": round(percentile(values, 50), 3),
+            "p90": round(percentile(values, 90), 3),
+            "p99": round(percentile(values, 99), 3),
+            "max": round(values[-1], 3) if values else 0.0,
+        },
+    }
+
+
+def run_load(total, concurrency, call):
+    """Run call(session, i) for i in range(total) from concurrency threads.
+
+    call returns True on success. Returns (latencies of successful calls, error count, elapsed).
+    """
+    local = threading.local()
+
+    def timed(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = call(session, i)
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, range(total)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for latency, ok in results if ok]
+    return latencies, len(results) - len(latencies), elapsed
+
+
+def seed_inventory(cluster, products, quantity):
+    url = cluster.urls["inventory-service"]
+    for i in range(products):
+        response = requests.post(f"{url}/inventory", json={
+            "product_id": f"bench-{i}", "name": f"Benchmark product {i}", "quantity": quantity, "price": 9.99
+        })
+        response.raise_for_status()
+
+
+def order_body(i, products):
+    return {
+        "customer_id": f"bench-customer-{i % 100}",
+        "items": [{"product_id": f"bench-{i % products}", "quantity": 1, "price": 9.99}],
+    }
+
+
+def create_order_scenario(cluster, args):
+    url = f"{cluster.urls['order-service']}/orders"
+
+    def call(session, i):
+        return session.post(url, json=order_body(i, args.products)).status_code == 201
+
+    return summarize(*run_load(args.requests, args.concurrency, call))
+
+
+def reservation_scenario(cluster, args):
+    url = cluster.urls["inventory-service"]
+
+    def call(session, i):
+        response = session.post(
+            f"{url}/inventory/bench-{i % args.products}/reserve",
+            json={"quantity": 1, "order_id": f"bench-reservation-{uuid.uuid4()}"}
+        )
+        return response.status_code == 200
+
+    return summarize(*run_load(args.requests, args.concurrency, call))
+
+
+def event_chain_scenario(cluster, args):
+    url = f"{cluster.urls['order-service']}/orders"
+    started = {}
+    completed = {}
+    lock = threading.Lock()
+
+    def on_delivered(app_id, topic, data):
+        if app_id == "notification-service" and topic == "inventory-events":
+            with lock:
+                completed.setdefault(data.get("order_id"), time.perf_counter())
+
+    def call(session, i):
+        begin = time.perf_counter()
+        response = session.post(url, json=order_body(i, args.products))
+        if response.status_code != 201:
+            return False
+        with lock:
+            started[response.json()["order_id"]] = begin
+        return True
+
+    cluster.dapr.listeners.append(on_delivered)
+    try:
+        first = time.perf_counter()
+        _, errors, _ = run_load(args.requests, args.concurrency, call)
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            with lock:
+                if all(order_id in completed for order_id in started):
+                    break
+            time.sleep(0.01)
+    finally:
+        cluster.dapr.listeners.remove(on_delivered)
+
+    with lock:
+        latencies = [completed[order_id] - begin for order_id, begin in started.items() if order_id in completed]
+        last = max((completed[order_id] for order_id in started if order_id in completed), default=first)
+    incomplete = len(started) - len(latencies)
+    result = summarize(latencies, errors + incomplete, last - first)
+    result["incomplete"] = incomplete
+    return result
+
+
+SCENARIO_FUNCTIONS = {
+    "create-order": create_order_scenario,
+    "reservation": reservation_scenario,
+    "event-chain": event_chain_scenario,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, baseline, max_regression):
+    """Describe scenarios whose throughput fell or p99 rose by more than max_regression"""
+    found = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        before, after = previous["throughput_per_second"], current["throughput_per_second"]
+        if before and after < before * (1 - max_regression):
+            found.append(f"{name}: throughput {before}/s -> {after}/s")
+        before, after = previous["latency_ms"]["p99"], current["latency_ms"]["p99"]
+        if before and after > before * (1 + max_regression):
+            found.append(f"{name}: p99 {before}ms -> {after}ms")
+    return found
+
+
+def print_summary(results, out):
+    print(f"{'scenario':<14}{'requests':>10}{'errors':>8}{'per sec':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}", file=out)
+    for name, result in results["scenarios"].items():
+        latency = result["latency_ms"]
+        print(
+            f"{name:<14}{result['requests']:>10}{result['errors']:>8}{result['throughput_per_second']:>10}"
+            f"{latency['p50']:>10}{latency['p99']:>10}{latency['max']:>10}",
+            file=out
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--products", type=int, default=10, help="number of products orders are spread over")
+    parser.add_argument("--stock", type=int, default=1000000, help="initial stock per product")
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="latency injected into every sidecar call")
+    parser.add_argument("--jitter-ms", type=float, default=0.5, help="random extra latency per sidecar call")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated scenarios to run")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for event chains to finish")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON results to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="tolerated relative regression")
+    parser.add_argument("--app-log", help="append the services' logs to this file")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIO_FUNCTIONS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "products": args.products,
+            "sidecar_latency_ms": args.latency_ms,
+            "sidecar_jitter_ms": args.jitter_ms,
+        },
+        "scenarios": {},
+    }
+
+    with Cluster(args.latency_ms / 1000.0, args.jitter_ms / 1000.0, args.app_log) as cluster:
+        seed_inventory(cluster, args.products, args.stock)
+        for name in args.scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+            results["scenarios"][name] = SCENARIO_FUNCTIONS[name](cluster, args)
+            # Let the events a scenario triggered drain before the next one starts
+            cluster.dapr.wait_idle(args.timeout)
+        results["sidecar_calls"] = cluster.dapr.calls
+
+    print_summary(results, sys.stderr)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.max_regression)
+        for regression in found:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
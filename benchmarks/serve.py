@@ -0,0 +1,28 @@
+"""Serve one service's Flask app on a threaded WSGI server for a benchmark run.
+
+Usage: python benchmarks/serve.py <service-directory> <port>
+
+The service talks to the sidecar on DAPR_HTTP_PORT, which the benchmark
+runner points at its fake sidecar.
+"""
+import logging
+import os
+import sys
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    service, port = sys.argv[1], int(sys.argv[2])
+    sys.path[:0] = [os.path.join(ROOT, service), ROOT]
+    from app import app
+
+    # Access logs would be written for every request; gunicorn has none by default either
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
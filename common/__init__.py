@@ -0,0 +1 @@
+"""Shared helpers used by all three Dapr demo services"""
@@ -0,0 +1,206 @@
+"""Asyncio counterpart of DaprClient for the ASGI serving mode.
+
+Backed by a single httpx.AsyncClient so that every coroutine in the process
+shares one keep-alive connection pool to the sidecar. The method names and
+error behaviour mirror common.dapr_client.DaprClient.
+"""
+import asyncio
+import time
+
+import httpx
+
+from common.dapr_client import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_RETRY_BACKOFF,
+    IDEMPOTENT_METHODS,
+    PUBSUB_NAME,
+    RETRY_STATUS_CODES,
+    STATE_STORE_NAME,
+    DaprError,
+    EtagMismatchError,
+    bulk_publish_entries,
+    bulk_publish_failures,
+)
+from common import codec
+from common.metrics import observe_dapr_request
+
+
+class AsyncDaprClient:
+    """Async wrapper over the Dapr HTTP API backed by a pooled httpx client"""
+
+    def __init__(self, base_url, store_name=STATE_STORE_NAME, pubsub_name=PUBSUB_NAME,
+                 pool_size=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, retry_backoff=None):
+        self.base_url = base_url.rstrip("/")
+        self.store_name = store_name
+        self.pubsub_name = pubsub_name
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.timeout = httpx.Timeout(
+            read_timeout if read_timeout is not None else DEFAULT_READ_TIMEOUT,
+            connect=connect_timeout if connect_timeout is not None else DEFAULT_CONNECT_TIMEOUT,
+        )
+        self.max_retries = max_retries if max_retries is not None else DEFAULT_MAX_RETRIES
+        self.retry_backoff = retry_backoff if retry_backoff is not None else DEFAULT_RETRY_BACKOFF
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                ),
+            )
+        return self._client
+
+    async def close(self):
+        """Release pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method, path, operation, json=None, idempotent=None, **kwargs):
+        """Send a request; connection errors are always retried, read errors and statuses only if idempotent"""
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        if json is not None:
+            kwargs["content"] = codec.dumps(json)
+            kwargs["headers"] = {"Content-Type": codec.CONTENT_TYPE}
+        started = time.perf_counter()
+        status = "error"
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await self.client.request(method, path, **kwargs)
+                except httpx.TransportError as e:
+                    # The request never reached the sidecar, unless the failure came after connecting
+                    unsent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+                    if attempt == self.max_retries or not (idempotent or unsent):
+                        raise DaprError(f"{method} {path} failed: {e}") from e
+                else:
+                    if not idempotent or response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                        status = response.status_code
+                        return response
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+        finally:
+            observe_dapr_request(operation, status, time.perf_counter() - started)
+
+    @staticmethod
+    def _check(response, operation, expected=(200, 204)):
+        if response.status_code not in expected:
+            raise DaprError(f"{operation} failed", response.status_code, response.text)
+
+    # State management
+
+    def _state_path(self, suffix=""):
+        return f"/v1.0/state/{self.store_name}{suffix}"
+
+    async def get_state(self, key):
+        """Return the value stored under key, or None if it does not exist"""
+        value, _ = await self.get_state_with_etag(key)
+        return value
+
+    async def get_state_with_etag(self, key):
+        """Return (value, etag) for key, or (None, None) if it does not exist"""
+        response = await self._request("GET", self._state_path(f"/{key}"), "state_get")
+        if response.status_code == 204:  # No content means key doesn't exist
+            return None, None
+        self._check(response, f"Get state {key}", expected=(200,))
+        return codec.loads(response.content), response.headers.get("ETag")
+
+    async def get_bulk_state(self, keys, parallelism=10):
+        """Fetch many keys in one call; returns {key: value} for keys that exist"""
+        entries = await self.get_bulk_state_with_etags(keys, parallelism)
+        return {key: value for key, (value, _) in entries.items()}
+
+    async def get_bulk_state_with_etags(self, keys, parallelism=10):
+        """Fetch many keys in one call; returns {key: (value, etag)} for keys that exist"""
+        if not keys:
+            return {}
+        response = await self._request(
+            "POST",
+            self._state_path("/bulk"),
+            "state_bulk_get",
+            json={"keys": list(keys), "parallelism": parallelism},
+            idempotent=True,  # A read sent as POST
+        )
+        self._check(response, "Bulk get state", expected=(200,))
+        return {
+            entry["key"]: (entry["data"], entry.get("etag"))
+            for entry in codec.loads(response.content)
+            if "data" in entry and entry["data"] is not None
+        }
+
+    async def save_state(self, key, value):
+        """Save a single key"""
+        await self.save_bulk_state([{"key": key, "value": value}])
+
+    async def save_bulk_state(self, items):
+        """Save several {"key", "value"} items in one call"""
+        if not items:
+            return
+        response = await self._request("POST", self._state_path(), "state_save", json=list(items))
+        if response.status_code == 409:
+            raise EtagMismatchError("Save state failed", response.status_code, response.text)
+        self._check(response, "Save state", expected=(200, 204))
+
+    async def transact_state(self, operations):
+        """Apply upsert/delete operations atomically through the transaction API"""
+        if not operations:
+            return
+        response = await self._request(
+            "POST",
+            self._state_path("/transaction"),
+            "state_transaction",
+            json={"operations": list(operations)},
+        )
+        if response.status_code == 409 or (
+            response.status_code == 500 and "etag" in response.text.lower()
+        ):
+            raise EtagMismatchError("State transaction failed", response.status_code, response.text)
+        self._check(response, "State transaction", expected=(200, 204))
+
+    async def delete_state(self, key):
+        """Delete a single key"""
+        response = await self._request("DELETE", self._state_path(f"/{key}"), "state_delete")
+        self._check(response, f"Delete state {key}", expected=(200, 204))
+
+    # Pub/sub
+
+    async def publish(self, topic, data, pubsub_name=None):
+        """Publish an event to a topic on the configured (or given) pub/sub component"""
+        pubsub_name = pubsub_name or self.pubsub_name
+        response = await self._request("POST", f"/v1.0/publish/{pubsub_name}/{topic}", "publish", json=data)
+        self._check(response, f"Publish to {topic}", expected=(200, 204))
+
+    async def publish_bulk(self, topic, events, pubsub_name=None):
+        """Publish (entry_id, data) events in one call; returns the entry IDs that failed"""
+        if not events:
+            return []
+        pubsub_name = pubsub_name or self.pubsub_name
+        response = await self._request(
+            "POST",
+            f"/v1.0-alpha1/publish/bulk/{pubsub_name}/{topic}",
+            "publish_bulk",
+            json=bulk_publish_entries(events),
+        )
+        return bulk_publish_failures(response, topic)
+
+    # Actors
+
+    async def invoke_actor(self, actor_type, actor_id, method, data=None):
+        """Call a method on a virtual actor, wherever it is placed; returns the decoded reply or None"""
+        response = await self._request(
+            "PUT",
+            f"/v1.0/actors/{actor_type}/{actor_id}/method/{method}",
+            "actor_invoke",
+            json=data if data is not None else {},
+        )
+        self._check(response, f"Invoke {actor_type}/{actor_id}.{method}", expected=(200, 204))
+        return codec.loads(response.content) if response.content else None
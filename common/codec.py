@@ -0,0 +1,97 @@
+"""JSON codec shared by request parsing, sidecar calls and responses.
+
+Uses orjson when it is installed and falls back to the standard library
+otherwise. JSON_CODEC=stdlib forces the fallback, and JSON_CODEC=orjson
+fails at startup if orjson is missing. Both codecs produce compact UTF-8
+bytes, and both encode datetimes, UUIDs and Decimals the same way.
+
+The services plug the codec in at three points:
+- Flask, through json_provider(), for request.json and jsonify
+- the sidecar clients, for request and response bodies
+- the ASGI endpoints, through json_response() and request_json()
+
+Run python -m benchmarks.codec_benchmark to compare the codecs.
+"""
+import json
+import os
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+JSON_CODEC = os.getenv("JSON_CODEC", "auto").lower()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if JSON_CODEC == "orjson" and orjson is None:
+    raise ImportError("JSON_CODEC=orjson but orjson is not installed")
+
+CONTENT_TYPE = "application/json"
+
+
+def _default(obj):
+    """Encode the non-JSON types the services may hand to the codec"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None and JSON_CODEC != "stdlib":
+    NAME = "orjson"
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        """Encode obj as JSON bytes"""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    def loads(data):
+        """Decode JSON from bytes or str; raises ValueError on malformed input"""
+        return orjson.loads(data)
+else:
+    NAME = "stdlib"
+    _encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, default=_default)
+
+    def dumps(obj):
+        """Encode obj as JSON bytes"""
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data):
+        """Decode JSON from bytes or str; raises ValueError on malformed input"""
+        return json.loads(data)
+
+
+def json_provider(app):
+    """Flask JSON provider backed by this codec, for app.json"""
+    from flask.json.provider import JSONProvider
+
+    class CodecJSONProvider(JSONProvider):
+        def dumps(self, obj, **kwargs):
+            return dumps(obj).decode("utf-8")
+
+        def loads(self, s, **kwargs):
+            return loads(s)
+
+        def response(self, *args, **kwargs):
+            # Skip dumps() so the encoded bytes are not decoded only to be re-encoded
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(dumps(obj), mimetype=CONTENT_TYPE)
+
+    return CodecJSONProvider(app)
+
+
+def json_response(content, status_code=200):
+    """Starlette response with a body encoded by this codec"""
+    from starlette.responses import Response
+
+    return Response(dumps(content), status_code=status_code, media_type=CONTENT_TYPE)
+
+
+async def request_json(request):
+    """Decode a Starlette request body with this codec"""
+    return loads(await request.body())
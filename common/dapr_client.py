@@ -0,0 +1,311 @@
+"""Pooled, keep-alive HTTP client for the local Dapr sidecar.
+
+Every service talks to its sidecar through a single DaprClient instance so
+that state and pub/sub calls reuse connections from one pool instead of
+opening a new TCP connection per call.
+"""
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common import codec
+from common.metrics import observe_dapr_request
+
+STATE_STORE_NAME = "redis-statestore"
+PUBSUB_NAME = "redis-pubsub"
+
+# Defaults, overridable through the environment
+DEFAULT_POOL_SIZE = int(os.getenv("DAPR_POOL_SIZE", "20"))
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("DAPR_CONNECT_TIMEOUT", "2"))
+DEFAULT_READ_TIMEOUT = float(os.getenv("DAPR_READ_TIMEOUT", "10"))
+DEFAULT_MAX_RETRIES = int(os.getenv("DAPR_MAX_RETRIES", "3"))
+DEFAULT_RETRY_BACKOFF = float(os.getenv("DAPR_RETRY_BACKOFF", "0.2"))
+
+# Sidecar responses worth retrying (sidecar starting up or overloaded)
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# Calls that are safe to send again after a read timeout or one of the
+# statuses above. Anything else (saves, transactions, publishes, actor calls)
+# is only retried when the connection could not be made, since the sidecar
+# may already have applied it.
+IDEMPOTENT_METHODS = frozenset(["GET", "DELETE"])
+
+
+class DaprError(Exception):
+    """Raised when the sidecar rejects or fails a request"""
+
+    def __init__(self, message, status_code=None, body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+    def __str__(self):
+        if self.status_code is None:
+            return super().__str__()
+        return f"{super().__str__()} (status {self.status_code}): {self.body}"
+
+
+class EtagMismatchError(DaprError):
+    """Raised when a write is rejected because the key changed since it was read"""
+
+
+def upsert_operation(key, value, etag=None, first_write=False, ttl=None):
+    """Build an upsert operation for transact_state.
+
+    With an etag the write only succeeds if the key is unchanged; with
+    first_write and no etag it only succeeds if the key does not exist yet.
+    With ttl the state store expires the key after that many seconds; a ttl
+    of -1 removes an earlier TTL.
+    """
+    request = {"key": key, "value": value}
+    if etag is not None:
+        request["etag"] = etag
+    if etag is not None or first_write:
+        request["options"] = {"concurrency": "first-write"}
+    if ttl is not None:
+        request["metadata"] = ttl_metadata(ttl)
+    return {"operation": "upsert", "request": request}
+
+
+def ttl_metadata(ttl):
+    """State metadata asking the store to expire a key after ttl seconds"""
+    return {"ttlInSeconds": str(int(ttl))}
+
+
+def delete_operation(key, etag=None):
+    """Build a delete operation for transact_state"""
+    request = {"key": key}
+    if etag is not None:
+        request["etag"] = etag
+        request["options"] = {"concurrency": "first-write"}
+    return {"operation": "delete", "request": request}
+
+
+def bulk_publish_entries(events):
+    """Build the bulk publish request body for (entry_id, data) events"""
+    return [
+        {"entryId": str(entry_id), "event": data, "contentType": "application/json"}
+        for entry_id, data in events
+    ]
+
+
+def bulk_publish_failures(response, topic):
+    """Return the failed entry IDs of a bulk publish response, raising if the whole call failed"""
+    if response.status_code in (200, 204):
+        return []
+    if response.status_code == 500:
+        try:
+            failed = codec.loads(response.content).get("failedEntries")
+        except ValueError:
+            failed = None
+        if failed:
+            return [entry["entryId"] for entry in failed]
+    raise DaprError(f"Bulk publish to {topic} failed", response.status_code, response.text)
+
+
+class DaprClient:
+    """Thin wrapper over the Dapr HTTP API backed by a pooled session"""
+
+    def __init__(self, base_url, store_name=STATE_STORE_NAME, pubsub_name=PUBSUB_NAME,
+                 pool_size=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, retry_backoff=None):
+        self.base_url = base_url.rstrip("/")
+        self.store_name = store_name
+        self.pubsub_name = pubsub_name
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.timeout = (
+            connect_timeout if connect_timeout is not None else DEFAULT_CONNECT_TIMEOUT,
+            read_timeout if read_timeout is not None else DEFAULT_READ_TIMEOUT,
+        )
+        self.max_retries = max_retries if max_retries is not None else DEFAULT_MAX_RETRIES
+        self.retry_backoff = retry_backoff if retry_backoff is not None else DEFAULT_RETRY_BACKOFF
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+
+    @property
+    def session(self):
+        """Return the pooled session, recreating it after a fork"""
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._lock:
+                if self._session is None or self._session_pid != pid:
+                    self._session = self._build_session()
+                    self._session_pid = pid
+        return self._session
+
+    def _build_session(self):
+        session = requests.Session()
+        adapter = self._adapter(IDEMPOTENT_METHODS)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # Bulk gets are reads sent as POST, so they keep the full retry policy
+        session.mount(f"{self.base_url}{self._state_path('/bulk')}", self._adapter(IDEMPOTENT_METHODS | {"POST"}))
+        return session
+
+    def _adapter(self, retried_methods):
+        """Pooled adapter; connection errors are always retried, read errors and statuses only for retried_methods"""
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.retry_backoff,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=retried_methods,
+            raise_on_status=False,
+        )
+        return HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+            pool_block=False,
+        )
+
+    def close(self):
+        """Release pooled connections"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._session_pid = None
+
+    def _request(self, method, path, operation, json=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if json is not None:
+            kwargs["data"] = codec.dumps(json)
+            kwargs["headers"] = {"Content-Type": codec.CONTENT_TYPE}
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            status = response.status_code
+            return response
+        except requests.RequestException as e:
+            raise DaprError(f"{method} {path} failed: {e}") from e
+        finally:
+            observe_dapr_request(operation, status, time.perf_counter() - started)
+
+    @staticmethod
+    def _check(response, operation, expected=(200, 204)):
+        if response.status_code not in expected:
+            raise DaprError(f"{operation} failed", response.status_code, response.text)
+
+    # State management
+
+    def _state_path(self, suffix=""):
+        return f"/v1.0/state/{self.store_name}{suffix}"
+
+    def get_state(self, key):
+        """Return the value stored under key, or None if it does not exist"""
+        response = self._request("GET", self._state_path(f"/{key}"), "state_get")
+        if response.status_code == 204:  # No content means key doesn't exist
+            return None
+        self._check(response, f"Get state {key}", expected=(200,))
+        return codec.loads(response.content)
+
+    def get_state_with_etag(self, key):
+        """Return (value, etag) for key, or (None, None) if it does not exist"""
+        response = self._request("GET", self._state_path(f"/{key}"), "state_get")
+        if response.status_code == 204:
+            return None, None
+        self._check(response, f"Get state {key}", expected=(200,))
+        return codec.loads(response.content), response.headers.get("ETag")
+
+    def get_bulk_state(self, keys, parallelism=10):
+        """Fetch many keys in one call; returns {key: value} for keys that exist"""
+        return {
+            key: value
+            for key, (value, _) in self.get_bulk_state_with_etags(keys, parallelism).items()
+        }
+
+    def get_bulk_state_with_etags(self, keys, parallelism=10):
+        """Fetch many keys in one call; returns {key: (value, etag)} for keys that exist"""
+        if not keys:
+            return {}
+        response = self._request(
+            "POST",
+            self._state_path("/bulk"),
+            "state_bulk_get",
+            json={"keys": list(keys), "parallelism": parallelism},
+        )
+        self._check(response, "Bulk get state", expected=(200,))
+        return {
+            entry["key"]: (entry["data"], entry.get("etag"))
+            for entry in codec.loads(response.content)
+            if "data" in entry and entry["data"] is not None
+        }
+
+    def save_state(self, key, value):
+        """Save a single key"""
+        self.save_bulk_state([{"key": key, "value": value}])
+
+    def save_bulk_state(self, items):
+        """Save several {"key", "value"} items in one call"""
+        if not items:
+            return
+        response = self._request("POST", self._state_path(), "state_save", json=list(items))
+        if response.status_code == 409:
+            raise EtagMismatchError("Save state failed", response.status_code, response.text)
+        self._check(response, "Save state", expected=(200, 204))
+
+    def transact_state(self, operations):
+        """Apply upsert/delete operations atomically through the transaction API"""
+        if not operations:
+            return
+        response = self._request(
+            "POST",
+            self._state_path("/transaction"),
+            "state_transaction",
+            json={"operations": list(operations)},
+        )
+        # Redis reports a failed etag check inside a transaction as a 500
+        if response.status_code == 409 or (
+            response.status_code == 500 and "etag" in response.text.lower()
+        ):
+            raise EtagMismatchError("State transaction failed", response.status_code, response.text)
+        self._check(response, "State transaction", expected=(200, 204))
+
+    def delete_state(self, key):
+        """Delete a single key"""
+        response = self._request("DELETE", self._state_path(f"/{key}"), "state_delete")
+        self._check(response, f"Delete state {key}", expected=(200, 204))
+
+    # Pub/sub
+
+    def publish(self, topic, data, pubsub_name=None):
+        """Publish an event to a topic on the configured (or given) pub/sub component"""
+        pubsub_name = pubsub_name or self.pubsub_name
+        response = self._request("POST", f"/v1.0/publish/{pubsub_name}/{topic}", "publish", json=data)
+        self._check(response, f"Publish to {topic}", expected=(200, 204))
+
+    def publish_bulk(self, topic, events, pubsub_name=None):
+        """Publish (entry_id, data) events in one call; returns the entry IDs that failed"""
+        if not events:
+            return []
+        pubsub_name = pubsub_name or self.pubsub_name
+        response = self._request(
+            "POST",
+            f"/v1.0-alpha1/publish/bulk/{pubsub_name}/{topic}",
+            "publish_bulk",
+            json=bulk_publish_entries(events),
+        )
+        return bulk_publish_failures(response, topic)
+
+    # Actors
+
+    def invoke_actor(self, actor_type, actor_id, method, data=None):
+        """Call a method on a virtual actor, wherever it is placed; returns the decoded reply or None"""
+        response = self._request(
+            "PUT",
+            f"/v1.0/actors/{actor_type}/{actor_id}/method/{method}",
+            "actor_invoke",
+            json=data if data is not None else {},
+        )
+        self._check(response, f"Invoke {actor_type}/{actor_id}.{method}", expected=(200, 204))
+        return codec.loads(response.content) if response.content else None
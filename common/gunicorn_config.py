@@ -0,0 +1,50 @@
+"""Gunicorn settings shared by the three services.
+
+Run a service with: gunicorn -c common/gunicorn_config.py app:app
+
+Workers use the gthread worker class, so each one serves GUNICORN_THREADS
+requests at a time. The app is preloaded in the master and forked, which
+makes worker startup and restarts faster. Background threads, the sidecar
+session and per-process identifiers are created lazily in each worker, so
+they are never shared across a fork.
+
+On SIGTERM, workers stop accepting connections and get up to
+GUNICORN_GRACEFUL_TIMEOUT seconds to finish in-flight requests, including
+pub/sub deliveries. After that, each worker calls its app module's
+shutdown() to drain queued background work. Deliveries that do not finish
+in time are not acknowledged, so Dapr redelivers them.
+
+A service whose state must live in a single process sets MAX_WORKERS in
+its app module, and the worker count is capped to it.
+"""
+import os
+import sys
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+errorlog = "-"
+
+
+def on_starting(server):
+    """Cap the worker count for services whose app module sets MAX_WORKERS (preload only)"""
+    max_workers = getattr(sys.modules.get("app"), "MAX_WORKERS", None)
+    if max_workers and server.num_workers > max_workers:
+        server.log.warning(f"This service supports at most {max_workers} worker(s); ignoring workers={server.num_workers}")
+        server.num_workers = max_workers
+
+
+def worker_exit(server, worker):
+    """Let the service drain its background work (outbox relay, write-behind queue) before the worker exits"""
+    shutdown = getattr(sys.modules.get("app"), "shutdown", None)
+    if shutdown is not None:
+        try:
+            shutdown()
+        except Exception as e:
+            server.log.error(f"Worker {worker.pid} shutdown failed: {e}")
@@ -0,0 +1,109 @@
+"""Duplicate event suppression for the pub/sub handlers.
+
+Dapr delivers at-least-once, and the order outbox may publish an event more
+than once, so handlers remember the events they have processed. An
+IdempotencyGuard keeps recently processed event keys in a bounded in-memory
+LRU and writes a marker per event to the state store, expired by the store
+after the dedup window. A redelivery to the same process is rejected from
+memory; one to another replica, or after a restart, costs a single bulk read.
+"""
+import logging
+import os
+
+from common.cache import TTLCache
+from common.dapr_client import DaprError, ttl_metadata
+
+logger = logging.getLogger(__name__)
+
+DEDUP_WINDOW_SECONDS = int(os.getenv("EVENT_DEDUP_WINDOW_SECONDS", "86400"))
+DEDUP_CACHE_SIZE = int(os.getenv("EVENT_DEDUP_CACHE_SIZE", "100000"))
+
+
+def event_key(actual_data):
+    """Stable identity of an event: its event_id, else its type and order_id.
+
+    CloudEvent IDs are not used because they change whenever the same event
+    is published again.
+    """
+    event_id = actual_data.get("event_id")
+    if event_id:
+        return str(event_id)
+    return f"{actual_data.get('event_type')}:{actual_data.get('order_id')}"
+
+
+class IdempotencyGuard:
+    """Remembers processed event keys in an LRU backed by expiring state markers"""
+
+    def __init__(self, name, window_seconds=None, cache_size=None):
+        self.name = name
+        self.window_seconds = DEDUP_WINDOW_SECONDS if window_seconds is None else window_seconds
+        self.cache = TTLCache(DEDUP_CACHE_SIZE if cache_size is None else cache_size, self.window_seconds)
+        self.duplicates = 0
+
+    def marker_key(self, key):
+        return f"processed:{self.name}:{key}"
+
+    def marker_items(self, keys):
+        """State items recording keys as processed, for save_bulk_state or a write-behind queue"""
+        return [
+            {"key": self.marker_key(key), "value": 1, "metadata": ttl_metadata(self.window_seconds)}
+            for key in keys
+        ]
+
+    def _unknown(self, keys):
+        return [key for key in dict.fromkeys(keys) if self.cache.get(key) is None]
+
+    def _settle(self, keys, unknown, markers):
+        processed = set(keys) - set(unknown)
+        for key in unknown:
+            if self.marker_key(key) in markers:
+                self.cache.set(key, True)
+                processed.add(key)
+        self.duplicates += sum(1 for key in keys if key in processed)
+        return processed
+
+    def processed(self, dapr, keys):
+        """Return the subset of keys already processed, in one bulk read at most"""
+        unknown = self._unknown(keys)
+        markers = dapr.get_bulk_state([self.marker_key(key) for key in unknown]) if unknown else {}
+        return self._settle(keys, unknown, markers)
+
+    async def processed_async(self, dapr, keys):
+        """Coroutine version of processed for an AsyncDaprClient"""
+        unknown = self._unknown(keys)
+        markers = await dapr.get_bulk_state([self.marker_key(key) for key in unknown]) if unknown else {}
+        return self._settle(keys, unknown, markers)
+
+    def remember(self, keys):
+        """Record keys as processed in memory only"""
+        for key in keys:
+            self.cache.set(key, True)
+
+    def mark(self, dapr, keys):
+        """Record keys as processed in memory and in the state store"""
+        if not keys:
+            return
+        self.remember(keys)
+        try:
+            dapr.save_bulk_state(self.marker_items(keys))
+        except DaprError as e:
+            logger.warning(f"Failed to save {len(keys)} {self.name} dedup markers: {e}")
+
+    async def mark_async(self, dapr, keys):
+        """Coroutine version of mark for an AsyncDaprClient"""
+        if not keys:
+            return
+        self.remember(keys)
+        try:
+            await dapr.save_bulk_state(self.marker_items(keys))
+        except DaprError as e:
+            logger.warning(f"Failed to save {len(keys)} {self.name} dedup markers: {e}")
+
+    def stats(self):
+        cache = self.cache.stats()
+        return {
+            "duplicates": self.duplicates,
+            "window_seconds": self.window_seconds,
+            "cached_keys": cache["size"],
+            "cache_hit_ratio": cache["hit_ratio"],
+        }
@@ -0,0 +1,277 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Each service records three kinds of latency:
+- HTTP request latency per route
+- sidecar call latency per Dapr operation
+- event handler processing time per subscription
+
+It also counts the outcome of every delivered event. The counters and stats
+the services already keep (reservations, caches, dedup, outboxes,
+write-behind queues) are registered as stats sources and exported as gauges
+on scrape. Everything is served on GET /metrics.
+
+Metrics live in the memory of one process, so with several workers each one
+reports its own series.
+"""
+import logging
+import threading
+import time
+from functools import wraps
+
+from common import codec
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets in seconds, from a cache hit up to a timed-out sidecar call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """Histogram of observed values with cumulative buckets, a sum and a count"""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = (("le", _number(bound)),)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def _flatten(prefix, stats):
+    """Yield (name, value) for the numeric leaves of a nested stats dict"""
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from _flatten(name, value)
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+class Registry:
+    """Collection of metrics and stats sources rendered together on scrape"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._stats = {}
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.setdefault(metric.name, metric)
+        return existing
+
+    def counter(self, name, description, labelnames=()):
+        return self._register(Counter(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, description, labelnames, buckets))
+
+    def register_stats(self, prefix, source):
+        """Export the numeric values of source(), a stats dict, as gauges named prefix_<key>"""
+        with self._lock:
+            self._stats[prefix] = source
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            sources = list(self._stats.items())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        for prefix, source in sources:
+            try:
+                stats = source()
+            except Exception as e:
+                logger.warning(f"Failed to collect {prefix} stats: {e}")
+                continue
+            for name, value in _flatten(prefix, stats):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time spent serving HTTP requests", ("method", "route", "status")
+)
+DAPR_REQUEST_SECONDS = REGISTRY.histogram(
+    "dapr_request_duration_seconds", "Time spent in Dapr sidecar calls, retries included", ("operation", "status")
+)
+EVENT_HANDLER_SECONDS = REGISTRY.histogram(
+    "event_handler_duration_seconds", "Time spent processing a pub/sub delivery", ("handler",)
+)
+EVENTS = REGISTRY.counter(
+    "events_total", "Pub/sub events handled, by outcome", ("handler", "status")
+)
+EVENT_HANDLER_ERRORS = REGISTRY.counter(
+    "event_handler_errors_total", "Pub/sub events that failed and were left for redelivery", ("handler",)
+)
+
+
+def observe_dapr_request(operation, status, seconds):
+    """Record one sidecar call; status is the HTTP status or "error" if no response came back"""
+    DAPR_REQUEST_SECONDS.observe(seconds, operation=operation, status=status)
+
+
+def observe_delivery(handler, status_code, body, seconds):
+    """Record a pub/sub delivery from the handler's response status and JSON body.
+
+    A bulk delivery is counted per entry from its statuses; a single event
+    succeeds with a 2xx response and is redelivered otherwise.
+    """
+    EVENT_HANDLER_SECONDS.observe(seconds, handler=handler)
+    if isinstance(body, dict) and isinstance(body.get("statuses"), list):
+        statuses = [entry.get("status", "") for entry in body["statuses"]]
+    else:
+        statuses = ["SUCCESS" if status_code < 300 else "RETRY"]
+    for status in statuses:
+        EVENTS.inc(handler=handler, status=status.lower())
+    failed = sum(1 for status in statuses if status == "RETRY")
+    if failed:
+        EVENT_HANDLER_ERRORS.inc(failed, handler=handler)
+
+
+def instrument_flask(app):
+    """Time every request by route and serve GET /metrics"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started, method=request.method, route=route, status=response.status_code
+            )
+        return response
+
+    def metrics():
+        """Prometheus scrape endpoint"""
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
+
+
+def event_handler(handler):
+    """Decorator recording a Flask pub/sub view's processing time and event outcomes"""
+    from flask import current_app
+
+    def decorate(view):
+        @wraps(view)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            response = current_app.make_response(view(*args, **kwargs))
+            observe_delivery(
+                handler, response.status_code, response.get_json(silent=True), time.perf_counter() - started
+            )
+            return response
+        return timed
+
+    return decorate
+
+
+def asgi_endpoint(route, handler=None):
+    """Decorator timing a native Starlette endpoint under route, named as in Flask so series line up.
+
+    With handler, the endpoint is a pub/sub handler and its deliveries are
+    recorded as well.
+    """
+
+    def decorate(endpoint):
+        @wraps(endpoint)
+        async def timed(request):
+            started = time.perf_counter()
+            response = await endpoint(request)
+            elapsed = time.perf_counter() - started
+            HTTP_REQUEST_SECONDS.observe(elapsed, method=request.method, route=route, status=response.status_code)
+            if handler:
+                try:
+                    body = codec.loads(response.body) if response.body else None
+                except ValueError:
+                    body = None
+                observe_delivery(handler, response.status_code, body, elapsed)
+            return response
+        return timed
+
+    return decorate
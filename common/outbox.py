@@ -0,0 +1,225 @@
+"""Transactional outbox for events that must not be lost.
+
+An event is written to the state store as an outbox record in the same state
+transaction as the entity change that caused it, so either both are saved or
+neither is. A background relay then publishes outbox records in batches
+through the bulk publish API and deletes them once the broker has accepted
+them. Delivery is at-least-once: consumers may see an event twice.
+
+The writing process hands new records straight to its relay, so events go out
+within a batching window. Records whose writer crashed, or whose publish
+failed, are picked up by a periodic sweep; any replica's relay may sweep.
+
+Writers index each record in a BucketedIndex by creation time, and the relay
+only ever deletes the records themselves, so it never writes a document the
+writers share. The sweep only visits buckets whose window closed more than
+stale_after seconds ago, which writers no longer add to. It re-relays the
+records still there, then deletes the buckets and advances a cursor that
+only the relays write.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from common.dapr_client import DaprError, EtagMismatchError, delete_operation, upsert_operation
+from common.state_index import BucketedIndex
+
+logger = logging.getLogger(__name__)
+
+# Index buckets fetched per bulk read while sweeping, and swept per sweep at most
+SWEEP_BUCKETS_PER_READ = 16
+MAX_SWEEP_BUCKETS = 360
+
+
+class Outbox:
+    """Outbox records in the state store plus the relay thread that publishes them"""
+
+    def __init__(self, dapr, name="outbox", partitions=8, batch_size=100, flush_interval=0.02,
+                 sweep_interval=5.0, stale_after=10.0, bucket_seconds=10.0, sweep_lookback=86400.0):
+        self.dapr = dapr
+        self.name = name
+        self.index = BucketedIndex(f"{name}-index", bucket_seconds, partitions, directory=False)
+        self.cursor_key = f"{name}-sweep"
+        self.sweep_lookback = sweep_lookback
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.stale_after = stale_after
+        self.published = 0
+        self.publish_failures = 0
+        self.bulk_calls = 0
+        self.swept = 0
+        self.depth = 0
+        self.oldest_age = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def key(self, record_id):
+        return f"{self.name}:{record_id}"
+
+    def record(self, topic, data):
+        """Build an outbox record for an event"""
+        return {"id": str(uuid.uuid4()), "topic": topic, "data": data, "created_at": time.time()}
+
+    def add(self, record):
+        """State operations and index changes that put record in the outbox, for transact_with_indexes"""
+        return [upsert_operation(self.key(record["id"]), record)], [self.index.add(record["id"], record["created_at"])]
+
+    def notify(self, records):
+        """Hand records committed by this process to the relay for prompt publishing"""
+        self._ensure_started()
+        with self._lock:
+            self._pending.extend(records)
+        self._wake.set()
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    # A forked child inherits the parent's pending records, which
+                    # the parent is already relaying, but not its relay thread
+                    self._pid = os.getpid()
+                    self._lock = threading.Lock()
+                    self._pending = deque()
+                    self._wake = threading.Event()
+                    self._stop = threading.Event()
+                    self._thread = threading.Thread(target=self._run, name=f"{self.name}-relay", daemon=True)
+                    self._thread.start()
+
+    def start(self):
+        """Start the relay without waiting for a first event, so earlier leftovers get swept"""
+        self._ensure_started()
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.sweep_interval
+        while True:
+            self._wake.wait(max(0.0, next_sweep - time.monotonic()))
+            stopping = self._stop.is_set()
+            if not stopping:
+                time.sleep(self.flush_interval)  # Let a burst of events gather into one batch
+            self._wake.clear()
+            try:
+                self._drain()
+                if not stopping and time.monotonic() >= next_sweep:
+                    self._sweep()
+                    next_sweep = time.monotonic() + self.sweep_interval
+            except Exception as e:
+                # Anything not relayed is still in the state store for a later sweep
+                logger.error(f"Outbox relay error: {str(e)}")
+            if stopping:
+                return
+
+    def _drain(self):
+        """Relay the records handed over by notify, one batch at a time"""
+        while True:
+            with self._lock:
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            if not batch:
+                return
+            self._relay(batch)
+
+    def _sweep(self):
+        """Publish records left behind by crashed writers or failed publishes, from the closed buckets"""
+        last = self.index.bucket(time.time() - self.stale_after) - 1
+        swept = 0
+        found = []
+        try:
+            while swept < MAX_SWEEP_BUCKETS:
+                cursor, etag = self.dapr.get_state_with_etag(self.cursor_key)
+                first = cursor["next_bucket"] if cursor else self.index.bucket(time.time() - self.sweep_lookback)
+                buckets = list(range(first, min(last, first + SWEEP_BUCKETS_PER_READ - 1) + 1))
+                if not buckets:
+                    break
+                documents = self.dapr.get_bulk_state([key for bucket in buckets for key in self.index.bucket_keys(bucket)])
+                record_ids = [record_id for document in documents.values() for record_id in document]
+                for start in range(0, len(record_ids), self.batch_size):
+                    batch = record_ids[start:start + self.batch_size]
+                    records = list(self.dapr.get_bulk_state([self.key(record_id) for record_id in batch]).values())
+                    found.extend(records)
+                    if records and not self._relay(records):
+                        # Keep the buckets for the next sweep, by which time their published records are gone
+                        return
+                    self.swept += len(records)
+
+                # Every record of these buckets is published and no writer adds to them any more
+                operations = [delete_operation(key) for key in documents]
+                operations.append(upsert_operation(self.cursor_key, {"next_bucket": buckets[-1] + 1}, etag, first_write=True))
+                try:
+                    self.dapr.transact_state(operations)
+                except EtagMismatchError:
+                    # Another replica swept them at the same time
+                    return
+                swept += len(buckets)
+        except DaprError as e:
+            logger.error(f"Outbox sweep failed: {e}")
+        finally:
+            self.depth = len(found)
+            self.oldest_age = max(0.0, time.time() - min(record["created_at"] for record in found)) if found else 0.0
+
+    def _relay(self, records):
+        """Bulk publish records, grouped by topic, and delete the ones the broker accepted.
+
+        Returns True if every record was published.
+        """
+        by_topic = {}
+        for record in records:
+            by_topic.setdefault(record["topic"], []).append(record)
+
+        delivered = []
+        for topic, topic_records in by_topic.items():
+            try:
+                failed = set(self.dapr.publish_bulk(topic, [(record["id"], record["data"]) for record in topic_records]))
+            except DaprError as e:
+                logger.error(f"Bulk publish of {len(topic_records)} events to {topic} failed: {e}")
+                failed = {record["id"] for record in topic_records}
+            self.bulk_calls += 1
+            self.publish_failures += len(failed)
+            delivered.extend(record for record in topic_records if record["id"] not in failed)
+
+        now = time.time()
+        for record in delivered:
+            lag = now - record["created_at"]
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self._total_lag += lag
+        self.published += len(delivered)
+
+        # Undelivered records stay in the outbox for the next sweep. Index
+        # entries stay too; the sweep drops them with their bucket.
+        try:
+            if delivered:
+                self.dapr.transact_state([delete_operation(self.key(record["id"])) for record in delivered])
+        except DaprError as e:
+            logger.error(f"Failed to delete {len(delivered)} published outbox records: {e}")
+        return len(delivered) == len(records)
+
+    def close(self, timeout=10.0):
+        """Publish whatever this process still has pending and stop the relay"""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        pending = len(self._pending) if self._pid == os.getpid() else 0
+        return {
+            "pending_local": pending,
+            "depth": self.depth,
+            "oldest_age_seconds": round(self.oldest_age, 3),
+            "published": self.published,
+            "publish_failures": self.publish_failures,
+            "bulk_publish_calls": self.bulk_calls,
+            "swept": self.swept,
+            "last_lag_seconds": round(self.last_lag, 3),
+            "max_lag_seconds": round(self.max_lag, 3),
+            "average_lag_seconds": round(self._total_lag / self.published, 3) if self.published else 0.0,
+        }
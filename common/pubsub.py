@@ -0,0 +1,52 @@
+"""Subscription and delivery helpers shared by the pub/sub handlers.
+
+Subscriptions opt into Dapr bulk subscribe, so the sidecar delivers up to
+maxMessagesCount CloudEvents per HTTP request and the handler answers with a
+status per entry. Handlers also accept single-event deliveries, so they keep
+working when bulk subscribe is turned off or unsupported.
+"""
+import os
+
+BULK_SUBSCRIBE = os.getenv("DAPR_BULK_SUBSCRIBE", "true").lower() == "true"
+BULK_MAX_MESSAGES = int(os.getenv("DAPR_BULK_MAX_MESSAGES", "100"))
+BULK_MAX_AWAIT_MS = int(os.getenv("DAPR_BULK_MAX_AWAIT_MS", "40"))
+
+# Per-entry statuses understood by the sidecar
+SUCCESS = "SUCCESS"
+RETRY = "RETRY"
+DROP = "DROP"
+
+
+def subscription(pubsub_name, topic, route, bulk=None):
+    """Build a /dapr/subscribe entry, opting into bulk delivery when enabled"""
+    entry = {"pubsubname": pubsub_name, "topic": topic, "route": route}
+    if BULK_SUBSCRIBE if bulk is None else bulk:
+        entry["bulkSubscribe"] = {
+            "enabled": True,
+            "maxMessagesCount": BULK_MAX_MESSAGES,
+            "maxAwaitDurationMs": BULK_MAX_AWAIT_MS,
+        }
+    return entry
+
+
+def is_bulk_delivery(body):
+    return isinstance(body, dict) and isinstance(body.get("entries"), list)
+
+
+def event_payload(event):
+    """Extract the actual event data from Dapr's CloudEvent format"""
+    if isinstance(event, dict) and "data" in event:
+        return event["data"]
+    return event
+
+
+def bulk_events(body):
+    """Yield (entry_id, event data) for each entry of a bulk delivery; data is None if unusable"""
+    for entry in body["entries"]:
+        data = event_payload(entry.get("event"))
+        yield entry.get("entryId"), data if isinstance(data, dict) else None
+
+
+def bulk_response(statuses):
+    """Response body for a bulk delivery from {entry_id: status}"""
+    return {"statuses": [{"entryId": entry_id, "status": status} for entry_id, status in statuses.items()]}
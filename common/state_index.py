@@ -0,0 +1,370 @@
+"""Secondary indexes kept in the Dapr state store.
+
+A StateIndex is a set of members (typically entity IDs), each with a sort
+score, stored as one or more JSON documents in the state store. Large or
+write-heavy indexes are split into partitions by a hash of the member, so
+concurrent writers rarely touch the same document. Reading an index costs a
+single bulk get no matter how many partitions it has, scan() pages through
+it a few partitions at a time, and listing never requires scanning the
+keyspace.
+
+A StateIndex document grows with its index. Indexes that grow without
+bound use a BucketedIndex instead: its scores are times, and each document
+holds a single time bucket of a single partition. A bucket stops changing
+once its window has passed, so writers only touch small, current documents,
+and a listing reads the buckets it needs, a few at a time.
+
+Index documents are updated in the same state transaction as the entity they
+describe, guarded by ETags; see transact_with_indexes.
+"""
+import asyncio
+import itertools
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timezone
+
+from common.dapr_client import EtagMismatchError, delete_operation, upsert_operation
+
+MAX_RETRIES = int(os.getenv("INDEX_MAX_RETRIES", "8"))
+RETRY_BACKOFF = float(os.getenv("INDEX_RETRY_BACKOFF", "0.01"))
+
+# Buckets listed per directory page of a BucketedIndex; a root document lists the pages
+DIRECTORY_PAGE_SIZE = 1024
+# Buckets (or StateIndex partitions) fetched per bulk read while scanning an index
+SCAN_BUCKETS_PER_READ = int(os.getenv("INDEX_SCAN_BUCKETS_PER_READ", "4"))
+
+
+class IndexConflictError(Exception):
+    """Raised when an indexed write keeps losing write races after all retries"""
+
+
+class StateIndex:
+    """A partitioned, scored member set persisted in the state store; documents are written with ttl, if given"""
+
+    def __init__(self, name, partitions=1, ttl=None):
+        self.name = name
+        self.partitions = partitions
+        self.ttl = ttl
+
+    def partition_keys(self):
+        if self.partitions == 1:
+            return [self.name]
+        return [f"{self.name}:{partition}" for partition in range(self.partitions)]
+
+    def partition(self, member):
+        return zlib.crc32(str(member).encode()) % self.partitions
+
+    def partition_key(self, member):
+        if self.partitions == 1:
+            return self.name
+        return f"{self.name}:{self.partition(member)}"
+
+    def document_key(self, member, score=None):
+        return self.partition_key(member)
+
+    def register(self, member, score):
+        """Index changes recording that member's document was just created; none for a StateIndex"""
+        return []
+
+    def add(self, member, score=0):
+        """Index change adding (or re-scoring) a member, for transact_with_indexes"""
+        return (self, "add", member, score)
+
+    def remove(self, member):
+        """Index change removing a member, for transact_with_indexes"""
+        return (self, "remove", member, None)
+
+    def read(self, dapr):
+        """Return {member: score} for the whole index in one bulk read"""
+        members = {}
+        for document in dapr.get_bulk_state(self.partition_keys()).values():
+            members.update(document)
+        return members
+
+    async def read_async(self, dapr):
+        """Coroutine version of read for an AsyncDaprClient"""
+        members = {}
+        for document in (await dapr.get_bulk_state(self.partition_keys())).values():
+            members.update(document)
+        return members
+
+    def scan(self, dapr, after=None):
+        """Yield (partition, member) in partition order, reading a few partitions at a time.
+
+        after is the last member already seen; the partitions before its own
+        are not read.
+        """
+        first = 0 if after is None else self.partition(after)
+        partition_keys = self.partition_keys()
+        for chunk in _chunks(range(first, self.partitions), SCAN_BUCKETS_PER_READ):
+            keys = [partition_keys[partition] for partition in chunk]
+            documents = dapr.get_bulk_state(keys)
+            for partition, key in zip(chunk, keys):
+                members = sorted(documents.get(key) or {})
+                if after is not None and partition == first:
+                    members = [member for member in members if member > after]
+                for member in members:
+                    yield partition, member
+
+
+class _DirectoryPage(StateIndex):
+    """One page of a BucketedIndex's directory, listing the buckets in use"""
+
+    def __init__(self, root, page):
+        super().__init__(f"{root.name}:{page}")
+        self.root = root
+        self.page = page
+
+    def register(self, member, score):
+        return [self.root.add(str(self.page), self.page)]
+
+
+class BucketedIndex:
+    """A scored member set split into documents by time bucket and member hash.
+
+    Scores are times, as epoch seconds or naive UTC ISO-8601 strings. With
+    directory, the buckets in use are listed in a two-level directory that
+    is only written when a bucket document is created, and scan() lists the
+    index in score order. Without one, readers address buckets themselves.
+    Documents are written with ttl, if given.
+    """
+
+    def __init__(self, name, bucket_seconds, partitions=1, ttl=None, directory=True):
+        self.name = name
+        self.bucket_seconds = bucket_seconds
+        self.partitions = partitions
+        self.ttl = ttl
+        self.directory = StateIndex(f"{name}:dir") if directory else None
+
+    def bucket(self, score):
+        """The bucket a score falls in"""
+        if isinstance(score, str):
+            score = datetime.fromisoformat(score).replace(tzinfo=timezone.utc).timestamp()
+        return int(score // self.bucket_seconds)
+
+    def bucket_keys(self, bucket):
+        if self.partitions == 1:
+            return [f"{self.name}:{bucket}"]
+        return [f"{self.name}:{bucket}:{partition}" for partition in range(self.partitions)]
+
+    def document_key(self, member, score):
+        if self.partitions == 1:
+            return f"{self.name}:{self.bucket(score)}"
+        return f"{self.name}:{self.bucket(score)}:{zlib.crc32(str(member).encode()) % self.partitions}"
+
+    def register(self, member, score):
+        """Directory changes listing the bucket of a newly created document"""
+        if self.directory is None:
+            return []
+        bucket = self.bucket(score)
+        return [_DirectoryPage(self.directory, bucket // DIRECTORY_PAGE_SIZE).add(str(bucket), bucket)]
+
+    def add(self, member, score):
+        """Index change adding a member, for transact_with_indexes"""
+        return (self, "add", member, score)
+
+    def remove(self, member, score):
+        """Index change removing a member; score must be the one it was added with"""
+        return (self, "remove", member, score)
+
+    def read_bucket(self, dapr, bucket):
+        """Return {member: score} for one bucket"""
+        members = {}
+        for document in dapr.get_bulk_state(self.bucket_keys(bucket)).values():
+            members.update(document)
+        return members
+
+    def scan(self, dapr, min_score=None, max_score=None, after=None):
+        """Yield (score, member) in ascending order, reading a few buckets at a time.
+
+        after is the (score, member) of the last entry already seen.
+        """
+        first, last = self._bucket_range(min_score, max_score, after)
+        pages = _in_range(dapr.get_state(self.directory.name), first, last, DIRECTORY_PAGE_SIZE)
+        buckets = (
+            bucket
+            for page in pages
+            for bucket in _in_range(dapr.get_state(f"{self.directory.name}:{page}"), first, last)
+        )
+        for chunk in _chunks(buckets, SCAN_BUCKETS_PER_READ):
+            documents = dapr.get_bulk_state([key for bucket in chunk for key in self.bucket_keys(bucket)])
+            yield from _entries(documents.values(), min_score, max_score, after)
+
+    def _bucket_range(self, min_score, max_score, after):
+        first = None if min_score is None else self.bucket(min_score)
+        if after is not None:
+            after_bucket = self.bucket(after[0])
+            first = after_bucket if first is None else max(first, after_bucket)
+        last = None if max_score is None else self.bucket(max_score)
+        return first, last
+
+
+def _in_range(directory, first, last, size=1):
+    """Sorted directory scores whose span of size buckets overlaps [first, last]"""
+    return sorted(
+        score for score in (directory or {}).values()
+        if (first is None or (score + 1) * size > first) and (last is None or score * size <= last)
+    )
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _entries(documents, min_score, max_score, after):
+    """Sorted (score, member) entries of documents within the score range and past after"""
+    entries = sorted(
+        (score, member)
+        for document in documents
+        for member, score in document.items()
+        if (min_score is None or score >= min_score) and (max_score is None or score <= max_score)
+    )
+    if after is not None:
+        entries = [entry for entry in entries if entry > tuple(after)]
+    return entries
+
+
+def take(entries, limit):
+    """The first limit entries of a scan, and the after cursor for the next page (None on the last one)"""
+    entries = list(itertools.islice(entries, limit + 1))
+    if len(entries) > limit:
+        return entries[:limit], entries[limit - 1]
+    return entries, None
+
+
+def page(members, min_score=None, max_score=None, after=None, limit=None):
+    """Sort {member: score} by (score, member) and return one page of it.
+
+    after is the (score, member) of the last entry on the previous page.
+    Returns (entries, next_after) where next_after is None on the last page.
+    """
+    entries = sorted(
+        (score, member)
+        for member, score in members.items()
+        if (min_score is None or score >= min_score) and (max_score is None or score <= max_score)
+    )
+    if after is not None:
+        entries = [entry for entry in entries if entry > tuple(after)]
+    if limit is not None and len(entries) > limit:
+        return entries[:limit], entries[limit - 1]
+    return entries, None
+
+
+def transact_with_indexes(dapr, prepare, max_retries=None):
+    """Commit a state transaction together with the index updates it implies.
+
+    prepare() is called on every attempt and returns (operations,
+    index_changes, result), or None to abort. The index documents touched by
+    index_changes are read with their ETags, updated, and written in the same
+    transaction as operations; on an ETag conflict the whole attempt is
+    retried. Returns result, or None if prepare aborted.
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    for attempt in range(max_retries + 1):
+        prepared = prepare()
+        if prepared is None:
+            return None
+        operations, index_changes, result = prepared
+
+        index_changes, entries = list(index_changes), {}
+        new_changes = index_changes
+        while new_changes:
+            entries.update(dapr.get_bulk_state_with_etags([key for key in index_keys(new_changes) if key not in entries]))
+            new_changes = registrations(new_changes, entries)
+            index_changes.extend(new_changes)
+        try:
+            dapr.transact_state(list(operations) + index_operations(index_changes, entries))
+            return result
+        except EtagMismatchError:
+            if attempt < max_retries:
+                time.sleep(_backoff(attempt))
+
+    raise IndexConflictError(f"Indexed write conflicted {max_retries + 1} times")
+
+
+async def transact_with_indexes_async(dapr, prepare, max_retries=None):
+    """Coroutine version of transact_with_indexes; prepare may be a coroutine function"""
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    for attempt in range(max_retries + 1):
+        prepared = prepare()
+        if asyncio.iscoroutine(prepared):
+            prepared = await prepared
+        if prepared is None:
+            return None
+        operations, index_changes, result = prepared
+
+        index_changes, entries = list(index_changes), {}
+        new_changes = index_changes
+        while new_changes:
+            entries.update(await dapr.get_bulk_state_with_etags([key for key in index_keys(new_changes) if key not in entries]))
+            new_changes = registrations(new_changes, entries)
+            index_changes.extend(new_changes)
+        try:
+            await dapr.transact_state(list(operations) + index_operations(index_changes, entries))
+            return result
+        except EtagMismatchError:
+            if attempt < max_retries:
+                await asyncio.sleep(_backoff(attempt))
+
+    raise IndexConflictError(f"Indexed write conflicted {max_retries + 1} times")
+
+
+def index_keys(index_changes):
+    """State keys of the index documents touched by index_changes"""
+    return sorted({index.document_key(member, score) for index, _, member, score in index_changes})
+
+
+def registrations(index_changes, entries):
+    """Directory changes for the documents index_changes will create.
+
+    entries maps state keys to (value, etag) as returned by
+    get_bulk_state_with_etags; a document missing from it is created.
+    """
+    changes = []
+    for index, action, member, score in index_changes:
+        if action == "add" and index.document_key(member, score) not in entries:
+            changes.extend(index.register(member, score))
+    return changes
+
+
+def index_operations(index_changes, entries):
+    """Apply index changes to the documents in entries and build their writes.
+
+    entries maps state keys to (value, etag) as returned by
+    get_bulk_state_with_etags and must cover index_keys(index_changes).
+    """
+    documents = {}
+    originals = {}
+    for index, action, member, score in index_changes:
+        key = index.document_key(member, score)
+        if key not in documents:
+            value, etag = entries.get(key, (None, None))
+            documents[key] = dict(value or {})
+            originals[key] = (index, value or {}, etag)
+        if action == "add":
+            documents[key][member] = score
+        else:
+            documents[key].pop(member, None)
+
+    operations = []
+    for key, document in documents.items():
+        index, original, etag = originals[key]
+        if document == original:
+            # Unchanged documents, such as a directory that already lists its bucket, are not rewritten
+            continue
+        if document:
+            operations.append(upsert_operation(key, document, etag, first_write=True, ttl=index.ttl))
+        elif etag is not None:
+            operations.append(delete_operation(key, etag))
+    return operations
+
+
+def _backoff(attempt):
+    return RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
@@ -0,0 +1,133 @@
+"""Structured, queue-based logging for the services.
+
+configure_logging() installs a handler on the root logger that only puts
+records on a bounded in-memory queue. A listener thread formats and writes
+them, so request threads never format messages or block on stderr. Messages
+use lazy %-style arguments, so an argument is only turned into text on the
+listener thread, and only if its level is enabled. When the queue is full,
+records are dropped and counted rather than stalling the caller.
+
+Records are written as one JSON object per line (LOG_FORMAT=json, the
+default) or as plain text (LOG_FORMAT=text). Values passed through
+extra={...} become fields of the JSON object.
+
+Full event payloads are only logged when LOG_EVENT_PAYLOADS is switched on,
+and then only for a LOG_PAYLOAD_SAMPLE_RATE fraction of events.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_EVENT_PAYLOADS = os.getenv("LOG_EVENT_PAYLOADS", "false").lower() == "true"
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+
+# Attributes every LogRecord has; anything else was passed through extra
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single-line JSON object"""
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    """Queues records for a listener thread, restarting it in a forked child"""
+
+    def __init__(self, target, max_size=LOG_QUEUE_SIZE):
+        super().__init__(None)
+        self.target = target
+        self.max_size = max_size
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    # A forked child inherits the queue but not the listener thread
+                    self.queue = queue.Queue(self.max_size)
+                    self._listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+                    self._listener.start()
+                    self._pid = os.getpid()
+
+    def prepare(self, record):
+        # QueueHandler would format the message here, on the calling thread;
+        # the listener formats it instead
+        return record
+
+    def enqueue(self, record):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write out whatever is still queued and stop the listener"""
+        if self._pid == os.getpid() and self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+        super().close()
+
+    def stats(self):
+        pending = self.queue.qsize() if self._pid == os.getpid() else 0
+        return {"pending": pending, "max_pending": self.max_size, "dropped": self.dropped}
+
+
+def configure_logging(service):
+    """Route all logging through a background handler; returns the handler"""
+    target = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "text":
+        target.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s [{service}] %(name)s: %(message)s"))
+    else:
+        target.setFormatter(JsonFormatter(service))
+
+    handler = BackgroundHandler(target)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    # The async Dapr client's HTTP stack logs every request at INFO
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    return handler
+
+
+def log_payload(logger, message, payload, **fields):
+    """Log an event payload when payload logging is switched on and this event is sampled"""
+    if not LOG_EVENT_PAYLOADS or random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    logger.info("%s: %s", message, payload, extra=dict(fields, payload_sampled=True))
@@ -0,0 +1,145 @@
+"""Write-behind queue that batches state saves off the request path.
+
+Callers enqueue (key, value) pairs and return immediately; a background
+flusher thread coalesces them into multi-key state saves, flushing when a
+batch is full or when the oldest queued write has waited flush_interval
+seconds. The queue is bounded, so a slow state store pushes back on callers
+instead of growing memory without limit, and close() drains whatever is
+still queued.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Bounded queue of state writes flushed in batches by a background thread"""
+
+    def __init__(self, dapr, max_batch=100, flush_interval=0.05, max_pending=10000,
+                 put_timeout=1.0, max_retries=3, retry_backoff=0.1):
+        self.dapr = dapr
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _reset(self):
+        # Called on first use and again in a forked child, which inherits the
+        # parent's queue contents and lock state but not its flusher thread
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.max_pending)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="write-behind-flusher", daemon=True)
+        self._thread.start()
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def put(self, key, value, timeout=None, metadata=None):
+        """Queue a write, blocking up to timeout while the queue is full.
+
+        Returns False if the queue stayed full (or is closed); the caller
+        should then save the value itself.
+        """
+        self._ensure_started()
+        if self._stop.is_set():
+            return False
+        timeout = self.put_timeout if timeout is None else timeout
+        try:
+            self._queue.put((key, value, metadata), block=timeout > 0, timeout=timeout if timeout > 0 else None)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _next_batch(self):
+        """Wait for a first write, then gather more until the batch is full or the window ends"""
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0 and not self._stop.is_set():
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        # Later writes to the same key supersede earlier ones within a batch
+        latest = {key: (value, metadata) for key, value, metadata in batch}
+        items = []
+        for key, (value, metadata) in latest.items():
+            item = {"key": key, "value": value}
+            if metadata:
+                item["metadata"] = metadata
+            items.append(item)
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.dapr.save_bulk_state(items)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Dropping {len(items)} queued state writes after {attempt + 1} attempts: {e}")
+                    with self._lock:
+                        self.failed += len(batch)
+                    return
+                time.sleep(self.retry_backoff * (2 ** attempt))
+        with self._lock:
+            self.flushed += len(batch)
+            self.batches += 1
+
+    def close(self, timeout=10.0):
+        """Stop accepting writes and wait up to timeout for the queue to drain"""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"Write-behind queue still had {self._queue.qsize()} writes after {timeout}s drain")
+
+    def stats(self):
+        pending = self._queue.qsize() if self._pid == os.getpid() else 0
+        return {
+            "pending": pending,
+            "max_pending": self.max_pending,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failed": self.failed,
+            "average_batch_size": round(self.flushed / self.batches, 2) if self.batches else 0.0,
+        }
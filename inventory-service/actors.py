@@ -0,0 +1,467 @@
+"""Per-product Dapr actors for inventory (INVENTORY_MODE=actors).
+
+Each product_id is a virtual InventoryActor of this service. Dapr places
+every actor on one replica and gives it turn-based concurrency: calls to the
+same product run one at a time, calls to different products run in parallel
+on whichever replicas host them. Because an actor is the only writer of its
+product's stock, it keeps the product record in memory once activated, and
+each add, reserve or release is a single unguarded state transaction, with
+no read of the product and no ETag retries. Only the index and outbox
+documents a reservation or release touches are read and guarded.
+
+The records are the same inventory:{product_id}, reservation:* and index
+documents the state mode uses, so listings, lookups and the event handlers
+work unchanged. A product whose stock was sharded in state mode is merged
+back into one record on its first write through an actor.
+
+Event-driven reservations are idempotent as in state mode, except that each
+actor records its product's part of the outcome in its own
+reservation-result:{order_id}:{product_id} marker, written in the same
+transaction as the hold. A redelivered order gets each recorded part back,
+so products that were short stay short and a released hold is not taken
+again; only products without a marker are reserved.
+
+The client functions at the bottom mirror reserve_items, add_stock,
+release_reservations and remove_product in reservations.py, so the service
+calls one module or the other depending on the mode. An order's products are
+reserved by parallel actor calls; if any of them fails, the reservations the
+others made are released again. The order's reservation index is written
+once, before the calls, so they do not contend on it. Writes made outside the actors (clearing
+all inventory) must be followed by forget().
+"""
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from common.dapr_client import delete_operation, upsert_operation
+from common.state_index import transact_with_indexes, transact_with_indexes_async
+import reservations
+
+ACTOR_TYPE = "InventoryActor"
+
+# Dapr deactivates actors idle for this long, which bounds the memory they hold
+ACTOR_IDLE_TIMEOUT = os.getenv("INVENTORY_ACTOR_IDLE_TIMEOUT", "1h")
+ACTOR_DRAIN_TIMEOUT = os.getenv("INVENTORY_ACTOR_DRAIN_TIMEOUT", "30s")
+
+# Actor calls in flight at once for the products of orders reserved by this process
+ACTOR_FANOUT = int(os.getenv("INVENTORY_ACTOR_FANOUT", "8"))
+
+logger = logging.getLogger(__name__)
+
+_fanout = None
+_fanout_pid = None
+_fanout_lock = threading.Lock()
+
+
+def _fanout_executor():
+    """Thread pool for the parallel actor calls of an order, recreated after a fork"""
+    global _fanout, _fanout_pid
+    if _fanout_pid != os.getpid():
+        with _fanout_lock:
+            if _fanout_pid != os.getpid():
+                _fanout = ThreadPoolExecutor(max_workers=ACTOR_FANOUT, thread_name_prefix="actor-fanout")
+                _fanout_pid = os.getpid()
+    return _fanout
+
+
+class UnknownActorMethodError(Exception):
+    """Raised when Dapr invokes a method InventoryActor does not have"""
+
+
+class InventoryActor:
+    """One product's stock, held in memory between calls"""
+
+    METHODS = ("add", "reserve", "release", "remove", "forget")
+
+    def __init__(self, dapr, product_id, outbox=None):
+        self.dapr = dapr
+        self.product_id = product_id
+        self.outbox = outbox
+        self.key = f"inventory:{product_id}"
+        self.lock = threading.Lock()
+        self.active = False
+        self.record = None
+        self._migration = ([], [])  # (operations, index changes) folding sharded stock into the record
+
+    def activate(self):
+        """Load the product record from the state store"""
+        record = self.dapr.get_state(self.key)
+        operations, index_changes = [], []
+
+        if reservations.shard_count(record):
+            shard_keys = reservations.shard_keys(self.product_id, record)
+            found = self.dapr.get_bulk_state(shard_keys)
+            record = dict(record, quantity=sum(found.get(key, {}).get("quantity", 0) for key in shard_keys))
+            record.pop("shards")
+            operations = [delete_operation(key) for key in shard_keys]
+            index_changes = [reservations.sharded_index.remove(self.product_id)]
+
+        self.record = record
+        self._migration = (operations, index_changes)
+        self.active = True
+
+    def _commit(self, operations, index_changes=()):
+        """Write operations, plus any pending shard merge, in one transaction"""
+        merge_operations, merge_changes = self._migration
+        operations = merge_operations + operations
+        index_changes = merge_changes + list(index_changes)
+        if index_changes:
+            transact_with_indexes(self.dapr, lambda: (operations, index_changes, True))
+        else:
+            self.dapr.transact_state(operations)
+        self._migration = ([], [])
+
+    def add(self, data):
+        """Add stock, creating the product if needed; returns the record"""
+        record = {
+            "product_id": self.product_id,
+            "quantity": (self.record["quantity"] if self.record else 0) + data["quantity"],
+            "last_updated": datetime.utcnow().isoformat(),
+            "name": data.get("name") if data.get("name") is not None else f"Product {self.product_id}",
+            "price": data.get("price") if data.get("price") is not None else 0.0
+        }
+        # Only a new product touches the shared product index
+        index_changes = [] if self.record else [reservations.product_index.add(self.product_id, 0)]
+        self._commit([upsert_operation(self.key, record)], index_changes)
+        self.record = record
+        return {"record": record}
+
+    def reserve(self, data):
+        """Reserve the quantities of an order's line items for this product.
+
+        With idempotent set, the outcome is recorded in a marker written in
+        the same transaction as the hold, and a redelivered order gets the
+        recorded outcome back instead of reserving again.
+        """
+        order_id = data["order_id"]
+        items = [{"product_id": self.product_id, "quantity": quantity} for quantity in data["quantities"]]
+        reservation_key = reservations.reservation_key(order_id, self.product_id)
+        marker_key = reservations.result_key(order_id, self.product_id)
+        found = self.dapr.get_bulk_state([reservation_key, marker_key] if data.get("idempotent") else [reservation_key])
+
+        if marker_key in found:
+            return {
+                "inventory_status": found[marker_key]["inventory_status"],
+                "record": self.record,
+                "reservation": None,
+                "duplicate": True,
+            }
+
+        records = {self.product_id: dict(self.record)} if self.record else {}
+        inventory_status, all_items_reserved, planned = reservations.plan_items(order_id, items, records)
+        operations = []
+        if data.get("idempotent"):
+            operations.append(reservations.result_marker(order_id, inventory_status, all_items_reserved, self.product_id))
+        reservation = planned.get(self.product_id)
+        if reservation is None:
+            if operations:
+                # Only the outcome is written; the record and any pending shard merge are left alone
+                self.dapr.transact_state(operations)
+            return {"inventory_status": inventory_status, "record": self.record, "reservation": None, "duplicate": False}
+
+        held = found.get(reservation_key)
+        if held is not None:
+            # A further reservation for the same order extends the one it holds
+            reservation = dict(held, quantity=held["quantity"] + reservation["quantity"])
+        record = records[self.product_id]
+        ttl, expiry_changes = reservations.hold(reservation)
+        operations.extend([
+            upsert_operation(self.key, record),
+            upsert_operation(reservation_key, reservation, ttl=ttl),
+        ])
+        self._commit(operations, expiry_changes)
+        self.record = record
+        return {"inventory_status": inventory_status, "record": record, "reservation": reservation, "duplicate": False}
+
+    def release(self, data):
+        """Put the stock reserved by the given orders back; returns the released reservations and the record"""
+        reason = data.get("reason", "released")
+        now = datetime.utcnow().isoformat()
+        keys = [reservations.reservation_key(order_id, self.product_id) for order_id in data["order_ids"]]
+        found = self.dapr.get_bulk_state(keys)
+        held = [found[key] for key in keys if key in found and reservations.releasable(found[key], reason, now)]
+        # A rolled-back reservation never happened, so a redelivered order must reserve again
+        markers = [
+            delete_operation(reservations.result_key(order_id, self.product_id)) for order_id in data["order_ids"]
+        ] if reason == "rolled_back" else []
+        if not held:
+            if markers:
+                self.dapr.transact_state(markers)
+            return {"released": [], "record": self.record}
+
+        released_keys = [reservations.reservation_key(value["order_id"], self.product_id) for value in held]
+        operations = markers + [delete_operation(key) for key in released_keys]
+        index_changes = reservations.forget_changes(released_keys)
+        record = self.record
+        if record is not None:
+            record = dict(record, quantity=record["quantity"] + sum(value["quantity"] for value in held), last_updated=now)
+            operations.append(upsert_operation(self.key, record))
+        outbox_records = [self.outbox.record("inventory-events", reservations.release_event(value, reason))
+                          for value in held] if self.outbox else []
+        for outbox_record in outbox_records:
+            outbox_operations, outbox_index_changes = self.outbox.add(outbox_record)
+            operations.extend(outbox_operations)
+            index_changes.extend(outbox_index_changes)
+
+        self._commit(operations, index_changes)
+        self.record = record
+        if outbox_records:
+            self.outbox.notify(outbox_records)
+        return {"released": held, "record": record}
+
+    def remove(self, data):
+        """Delete the product record and drop it from the product index"""
+        if self.record is None:
+            return {"removed": False}
+        self._commit([delete_operation(self.key)], [reservations.product_index.remove(self.product_id)])
+        self.record = None
+        return {"removed": True}
+
+    def forget(self, data):
+        """Drop the in-memory state, so the next call reloads it"""
+        self.active = False
+        return {}
+
+
+class ActorHost:
+    """The InventoryActor instances active in this process, invoked by the Dapr runtime"""
+
+    def __init__(self, dapr, outbox=None):
+        self.dapr = dapr
+        self.outbox = outbox
+        self._actors = {}
+        self._lock = threading.Lock()
+        self.invocations = 0
+        self.activations = 0
+        self.failures = 0
+
+    def config(self):
+        """Body of GET /dapr/config registering the actor type with Dapr"""
+        return {
+            "entities": [ACTOR_TYPE],
+            "actorIdleTimeout": ACTOR_IDLE_TIMEOUT,
+            "drainOngoingCallTimeout": ACTOR_DRAIN_TIMEOUT,
+            "drainRebalancedActors": True,
+        }
+
+    def invoke(self, actor_id, method, data):
+        """Run one actor method, one call at a time per actor"""
+        if method not in InventoryActor.METHODS:
+            raise UnknownActorMethodError(f"{ACTOR_TYPE} has no method {method}")
+        with self._lock:
+            actor = self._actors.get(actor_id)
+            if actor is None:
+                actor = self._actors[actor_id] = InventoryActor(self.dapr, actor_id, self.outbox)
+            self.invocations += 1
+
+        with actor.lock:
+            if method == "forget":
+                return actor.forget(data)
+            if not actor.active:
+                actor.activate()
+                self.activations += 1
+            try:
+                return getattr(actor, method)(data)
+            except Exception:
+                # The write may or may not have happened; reload before the next call
+                actor.active = False
+                self.failures += 1
+                raise
+
+    def deactivate(self, actor_id):
+        """Forget an actor Dapr deactivated (idle, or moved to another replica)"""
+        with self._lock:
+            self._actors.pop(actor_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active_actors": len(self._actors),
+                "invocations": self.invocations,
+                "activations": self.activations,
+                "failures": self.failures,
+            }
+
+
+def _grouped_lines(items):
+    """{product_id: [(position, quantity)]} for the line items of an order"""
+    lines = {}
+    for position, item in enumerate(items):
+        lines.setdefault(item.get("product_id"), []).append((position, item.get("quantity", 1)))
+    return lines
+
+
+def _reserve_request(order_id, product_lines, idempotent):
+    return {"order_id": order_id, "quantities": [quantity for _, quantity in product_lines], "idempotent": idempotent}
+
+
+def _combined_result(items, lines, replies):
+    """Merge the per-product actor replies into a reserve_items result"""
+    # Line items without a product_id match no product, as in reservations.plan_items
+    inventory_status = [
+        {"product_id": item.get("product_id"), "status": "insufficient", "available_quantity": 0}
+        for item in items
+    ]
+    records = {}
+    reserved = {}
+    duplicates = []
+    for product_id, reply in replies.items():
+        for (position, _), status in zip(lines[product_id], reply["inventory_status"]):
+            inventory_status[position] = status
+        if reply["record"] is not None:
+            records[product_id] = reply["record"]
+        if reply["reservation"] is not None and not reply["duplicate"]:
+            reserved[product_id] = reply["reservation"]
+        duplicates.append(reply["duplicate"])
+    return {
+        "inventory_status": inventory_status,
+        "all_items_reserved": all(status["status"] == "reserved" for status in inventory_status),
+        "records": records,
+        "reservations": reserved,
+        "duplicate": bool(duplicates) and all(duplicates),
+    }
+
+
+def _rollback_request(order_id, replies):
+    """{product_id: release request} undoing the reservations made by the replies that came back"""
+    return {
+        product_id: {"order_ids": [order_id], "reason": "rolled_back"}
+        for product_id, reply in replies.items()
+        if not isinstance(reply, BaseException) and reply["reservation"] is not None and not reply["duplicate"]
+    }
+
+
+def _first_error(order_id, replies):
+    errors = [reply for reply in replies.values() if isinstance(reply, BaseException)]
+    if errors:
+        logger.warning(f"Rolling back the reservations of order {order_id}: {len(errors)} actor calls failed")
+        return errors[0]
+    return None
+
+
+def _order_index_changes(order_id, requests):
+    """Index changes listing the products about to be reserved in the order's reservation index.
+
+    Products that end up not reserved are dropped from it when the order's
+    reservations are committed or released.
+    """
+    reserved_at = datetime.utcnow().isoformat()
+    return [reservations.order_index(order_id).add(product_id, reserved_at) for product_id in requests]
+
+
+def reserve_items(dapr, order_id, items, idempotent=False):
+    """Actor version of reservations.reserve_items: parallel actor calls, one per product in the order.
+
+    If any call fails, the reservations the others made are released and
+    the first error is raised.
+    """
+    lines = _grouped_lines(items)
+    requests = {
+        product_id: _reserve_request(order_id, product_lines, idempotent)
+        for product_id, product_lines in lines.items() if product_id
+    }
+    if requests:
+        transact_with_indexes(dapr, lambda: ([], _order_index_changes(order_id, requests), None))
+    replies = _invoke_all(dapr, "reserve", requests)
+    error = _first_error(order_id, replies)
+    if error is not None:
+        for product_id, reply in _invoke_all(dapr, "release", _rollback_request(order_id, replies)).items():
+            if isinstance(reply, BaseException):
+                logger.error(f"Failed to roll back the reservation of {product_id} for order {order_id}: {reply}")
+        raise error
+    return _combined_result(items, lines, replies)
+
+
+async def reserve_items_async(dapr, order_id, items, idempotent=False):
+    """Coroutine version of reserve_items for an AsyncDaprClient"""
+    lines = _grouped_lines(items)
+    requests = {
+        product_id: _reserve_request(order_id, product_lines, idempotent)
+        for product_id, product_lines in lines.items() if product_id
+    }
+    if requests:
+        await transact_with_indexes_async(dapr, lambda: ([], _order_index_changes(order_id, requests), None))
+    replies = await _invoke_all_async(dapr, "reserve", requests)
+    error = _first_error(order_id, replies)
+    if error is not None:
+        rollback = await _invoke_all_async(dapr, "release", _rollback_request(order_id, replies))
+        for product_id, reply in rollback.items():
+            if isinstance(reply, BaseException):
+                logger.error(f"Failed to roll back the reservation of {product_id} for order {order_id}: {reply}")
+        raise error
+    return _combined_result(items, lines, replies)
+
+
+def _invoke_all(dapr, method, requests):
+    """Call method on the actor of every product in requests, in parallel; failed calls map to their exception"""
+    if len(requests) <= 1:
+        replies = {}
+        for product_id, data in requests.items():
+            try:
+                replies[product_id] = dapr.invoke_actor(ACTOR_TYPE, product_id, method, data)
+            except Exception as e:
+                replies[product_id] = e
+        return replies
+    executor = _fanout_executor()
+    futures = {
+        product_id: executor.submit(dapr.invoke_actor, ACTOR_TYPE, product_id, method, data)
+        for product_id, data in requests.items()
+    }
+    replies = {}
+    for product_id, future in futures.items():
+        try:
+            replies[product_id] = future.result()
+        except Exception as e:
+            replies[product_id] = e
+    return replies
+
+
+async def _invoke_all_async(dapr, method, requests):
+    """Coroutine version of _invoke_all"""
+    replies = await asyncio.gather(
+        *[dapr.invoke_actor(ACTOR_TYPE, product_id, method, data) for product_id, data in requests.items()],
+        return_exceptions=True
+    )
+    return dict(zip(requests, replies))
+
+
+def add_stock(dapr, product_id, quantity, name=None, price=None):
+    """Actor version of reservations.add_stock"""
+    reply = dapr.invoke_actor(ACTOR_TYPE, product_id, "add", {"quantity": quantity, "name": name, "price": price})
+    return reply["record"]
+
+
+def release_reservations(dapr, reservation_keys, reason):
+    """Actor version of reservations.release_reservations: one actor call per product.
+
+    The actor host writes the inventory_released events to its own outbox.
+    """
+    found = dapr.get_bulk_state(reservation_keys)
+    missing = [key for key in reservation_keys if key not in found]
+    if missing:
+        reservations.forget_reservations(dapr, missing)
+    order_ids = {}
+    for reservation in found.values():
+        order_ids.setdefault(reservation["product_id"], []).append(reservation["order_id"])
+
+    released, records = [], {}
+    for product_id, product_order_ids in order_ids.items():
+        reply = dapr.invoke_actor(ACTOR_TYPE, product_id, "release", {"order_ids": product_order_ids, "reason": reason})
+        released.extend(reply["released"])
+        if reply["record"] is not None:
+            records[product_id] = reply["record"]
+    return released, records
+
+
+def remove_product(dapr, product_id):
+    """Actor version of reservations.remove_product"""
+    return dapr.invoke_actor(ACTOR_TYPE, product_id, "remove")["removed"]
+
+
+def forget(dapr, product_ids):
+    """Make the actors of the given products reload their state on their next call"""
+    for product_id in product_ids:
+        dapr.invoke_actor(ACTOR_TYPE, product_id, "forget")
@@ -1,16 +1,123 @@
 from flask import Flask, request, jsonify
-import json
-import logging
-import requests
+import os
+import uuid
 from datetime import datetime
 
+from common import codec, metrics
+from common.cache import TTLCache
+from common.dapr_client import DaprClient, DaprError, delete_operation
+from common.idempotency import IdempotencyGuard, event_key
+from common.outbox import Outbox
+from common.pubsub import (
+    DROP,
+    RETRY,
+    SUCCESS,
+    bulk_events,
+    bulk_response,
+    event_payload,
+    is_bulk_delivery,
+    subscription,
+)
+from common.state_index import IndexConflictError, take
+from common.structured_logging import configure_logging, log_payload
+import actors
+import ledger
+import reservations
+
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+log_handler = configure_logging("inventory-service")
+app.json = codec.json_provider(app)
+metrics.instrument_flask(app)
 
 # Dapr sidecar endpoint
-DAPR_HTTP_PORT = 3501
+DAPR_HTTP_PORT = int(os.getenv("DAPR_HTTP_PORT", "3501"))
 DAPR_URL = f"http://localhost:{DAPR_HTTP_PORT}"
 
+# Shared, pooled client for all sidecar calls
+dapr = DaprClient(DAPR_URL)
+
+# How stock is written: "state" uses optimistic transactions against the
+# state store (reservations.py); "actors" makes each product a Dapr actor
+# that owns its stock in memory (actors.py); "ledger" appends each change to
+# a per-product ledger that is compacted into the record (ledger.py)
+INVENTORY_MODE = os.getenv("INVENTORY_MODE", "state").lower()
+ACTOR_MODE = INVENTORY_MODE == "actors"
+LEDGER_MODE = INVENTORY_MODE == "ledger"
+stock = actors if ACTOR_MODE else ledger if LEDGER_MODE else reservations
+
+# inventory_released events are written to an outbox together with the release
+outbox = Outbox(
+    dapr,
+    name="inventory-outbox",
+    partitions=int(os.getenv("OUTBOX_INDEX_PARTITIONS", "32")),
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("OUTBOX_FLUSH_INTERVAL", "0.02")),
+    sweep_interval=float(os.getenv("OUTBOX_SWEEP_INTERVAL", "5")),
+    stale_after=float(os.getenv("OUTBOX_STALE_AFTER", "10")),
+    bucket_seconds=float(os.getenv("OUTBOX_INDEX_BUCKET_SECONDS", "10"))
+)
+actor_host = actors.ActorHost(dapr, outbox)
+
+# Actor state lives in process memory, and Dapr sees the app as one host,
+# so a second worker would serve the same actors from stale copies
+MAX_WORKERS = 1 if ACTOR_MODE else None
+
+# Page sizes for GET /inventory/list and the batch size for clearing inventory
+DEFAULT_PAGE_SIZE = int(os.getenv("INVENTORY_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("INVENTORY_MAX_PAGE_SIZE", "1000"))
+CLEAR_BATCH_SIZE = int(os.getenv("INVENTORY_CLEAR_BATCH_SIZE", "1000"))
+
+# Sharded stock for hot products: upper bound on shards, and how often they are evened out
+MAX_SHARDS = int(os.getenv("INVENTORY_MAX_SHARDS", "64"))
+shard_rebalancer = reservations.ShardRebalancer(dapr, float(os.getenv("INVENTORY_REBALANCE_INTERVAL", "5")))
+
+# Ledger mode: how often every product's pending changes are folded into its
+# record, and how many products are read per bulk read while doing so
+ledger_compactor = ledger.LedgerCompactor(
+    dapr,
+    interval=float(os.getenv("INVENTORY_LEDGER_COMPACT_INTERVAL", "30")),
+    batch_size=int(os.getenv("INVENTORY_LEDGER_COMPACT_BATCH_SIZE", "200"))
+)
+
+# Expired reservations are swept back into stock; order status updates commit
+# an order's reservations (so they never expire) or release them
+reservation_sweeper = reservations.ReservationSweeper(
+    dapr,
+    lambda reservation_keys, reason: release_reservations(reservation_keys, reason),
+    interval=float(os.getenv("RESERVATION_SWEEP_INTERVAL", "5")),
+    batch_size=int(os.getenv("RESERVATION_SWEEP_BATCH_SIZE", "100"))
+)
+COMMIT_STATUSES = set(os.getenv("RESERVATION_COMMIT_STATUSES", "confirmed,paid,shipped,delivered,completed").split(","))
+RELEASE_STATUSES = set(os.getenv("RESERVATION_RELEASE_STATUSES", "cancelled,canceled").split(","))
+
+# Order events already handled, so redeliveries are acknowledged without reprocessing
+order_event_guard = IdempotencyGuard("inventory-order-events")
+
+# Read-through cache for inventory lookups, keyed by product_id
+inventory_cache = TTLCache(
+    max_size=int(os.getenv("INVENTORY_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("INVENTORY_CACHE_TTL", "2"))
+)
+
+# Optional cross-replica cache invalidation. The broadcast pub/sub component
+# gives every replica its own consumer group, so each one sees every change.
+CACHE_BROADCAST = os.getenv("INVENTORY_CACHE_BROADCAST", "false").lower() == "true"
+BROADCAST_PUBSUB = "redis-broadcast"
+CACHE_TOPIC = "inventory-cache"
+_replica_ids = {}
+
+metrics.REGISTRY.register_stats("inventory_reservations", reservations.stats.snapshot)
+metrics.REGISTRY.register_stats("inventory_cache", inventory_cache.stats)
+metrics.REGISTRY.register_stats("inventory_dedup", order_event_guard.stats)
+metrics.REGISTRY.register_stats("inventory_sharding", shard_rebalancer.stats)
+metrics.REGISTRY.register_stats("inventory_expiry", reservation_sweeper.stats)
+metrics.REGISTRY.register_stats("inventory_outbox", outbox.stats)
+metrics.REGISTRY.register_stats("log_queue", log_handler.stats)
+if ACTOR_MODE:
+    metrics.REGISTRY.register_stats("inventory_actors", actor_host.stats)
+if LEDGER_MODE:
+    metrics.REGISTRY.register_stats("inventory_ledger", ledger_compactor.stats)
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -31,31 +138,29 @@ def add_inventory():
         product_id = inventory_data["product_id"]
         quantity = inventory_data["quantity"]
         
-        # Get current inventory
-        current_inventory = get_inventory_item(product_id)
-        if current_inventory:
-            new_quantity = current_inventory["quantity"] + quantity
-        else:
-            new_quantity = quantity
-        
-        # Create inventory record
-        inventory_item = {
-            "product_id": product_id,
-            "quantity": new_quantity,
-            "last_updated": datetime.utcnow().isoformat(),
-            "name": inventory_data.get("name", f"Product {product_id}"),
-            "price": inventory_data.get("price", 0.0)
-        }
-        
-        # Save to state store
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore"
-        state_data = [{"key": f"inventory:{product_id}", "value": inventory_item}]
-        
-        response = requests.post(state_url, json=state_data)
-        if response.status_code != 204:
-            app.logger.error(f"Failed to save inventory: {response.text}")
+        # Add to current inventory, guarded against concurrent reservations
+        try:
+            inventory_item = stock.add_stock(
+                dapr,
+                product_id,
+                quantity,
+                name=inventory_data.get("name"),
+                price=inventory_data.get("price")
+            )
+        except reservations.ReservationConflictError as e:
+            app.logger.warning(f"Inventory update for {product_id} gave up after conflicts: {e}")
+            return jsonify({"error": "Inventory is busy, please retry"}), 409
+        except ledger.LedgerGapError as e:
+            app.logger.error(f"Inventory ledger of {product_id} is broken: {e}")
+            return jsonify({"error": str(e)}), 409
+        except DaprError as e:
+            app.logger.error(f"Failed to save inventory: {e}")
             return jsonify({"error": "Failed to save inventory"}), 500
         
+        remember_inventory({product_id: inventory_item})
+        broadcast_inventory_change([product_id])
+        
+        new_quantity = inventory_item["quantity"]
         app.logger.info(f"Inventory updated for product {product_id}: {new_quantity}")
         return jsonify(inventory_item), 201
         
@@ -63,23 +168,48 @@ def add_inventory():
         app.logger.error(f"Error adding inventory: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+def remember_inventory(records):
+    """Refresh the cache with inventory records this replica just wrote"""
+    for product_id, record in records.items():
+        inventory_cache.set(product_id, record)
+
+def replica_id():
+    """Identifies this process's cache; each gunicorn worker forked from a preloaded app has its own"""
+    return _replica_ids.setdefault(os.getpid(), str(uuid.uuid4()))
+
+def inventory_change_event(product_ids=None):
+    """Cache invalidation event for the given products, or for everything if None"""
+    return {
+        "event_type": "inventory_changed",
+        "origin": replica_id(),
+        "product_ids": product_ids
+    }
+
+def broadcast_inventory_change(product_ids=None):
+    """Tell the other replicas to drop cached copies of the given products"""
+    if not CACHE_BROADCAST:
+        return
+    try:
+        dapr.publish(CACHE_TOPIC, inventory_change_event(product_ids), pubsub_name=BROADCAST_PUBSUB)
+    except DaprError as e:
+        app.logger.warning(f"Failed to broadcast inventory cache invalidation: {e}")
+
 def get_inventory_item(product_id):
-    """Helper function to get inventory item"""
+    """Helper function to get inventory item, served from the read-through cache"""
     try:
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore/inventory:{product_id}"
-        response = requests.get(state_url)
-        
-        if response.status_code == 204:  # No content means key doesn't exist
-            return None
-        
-        if response.status_code == 200:
-            return response.json()
-        
-        return None
+        return inventory_cache.get_or_load(product_id, lambda key: get_inventory_items([key]).get(key))
+    except ledger.LedgerGapError:
+        raise
     except Exception as e:
         app.logger.error(f"Error getting inventory item: {str(e)}")
         return None
 
+def get_inventory_items(product_ids):
+    """Helper function to get several inventory items in one bulk read, summing sharded stock"""
+    if LEDGER_MODE:
+        return ledger.load_inventory(dapr, product_ids)
+    return reservations.load_inventory(dapr, product_ids)
+
 @app.route('/inventory/<product_id>', methods=['GET'])
 def get_inventory(product_id):
     """Get inventory for a specific product"""
@@ -91,48 +221,61 @@ def get_inventory(product_id):
         
         return jsonify(inventory_item)
         
+    except ledger.LedgerGapError as e:
+        app.logger.error(f"Inventory ledger of {product_id} is broken: {e}")
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         app.logger.error(f"Error retrieving inventory: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+def clear_inventory_state():
+    """Delete every indexed inventory record and held reservation; returns the cleared records"""
+    product_ids = sorted(reservations.product_index.read(dapr))
+    if not product_ids:
+        return []
+    
+    if LEDGER_MODE:
+        records, operations = ledger.close_ledgers(dapr, product_ids)
+    else:
+        records, operations = get_inventory_items(product_ids), []
+    
+    keys = []
+    for product_id in product_ids:
+        keys.append(f"inventory:{product_id}")
+        keys.extend(reservations.shard_keys(product_id, records.get(product_id)))
+    # Holds are found through the expiry index; committed reservations stay with their orders
+    holds, expiry_documents = reservations.held_reservations(dapr)
+    for key in holds:
+        keys.extend([key, reservations.order_index(reservations.reservation_ids(key)[0]).name])
+    keys = list(dict.fromkeys(keys))
+    keys.extend(expiry_documents)
+    keys.extend(reservations.product_index.partition_keys())
+    keys.extend(reservations.sharded_index.partition_keys())
+    
+    # One transactional bulk delete (split only for very large catalogs)
+    operations.extend(delete_operation(key) for key in keys)
+    for start in range(0, len(operations), CLEAR_BATCH_SIZE):
+        dapr.transact_state(operations[start:start + CLEAR_BATCH_SIZE])
+    if ACTOR_MODE:
+        actors.forget(dapr, product_ids)
+    
+    inventory_cache.clear()
+    broadcast_inventory_change()
+    
+    return [records[product_id] for product_id in product_ids if product_id in records]
+
 @app.route('/inventory/clear', methods=['DELETE'])
 def clear_all_inventory():
     """Clear all inventory items and reservations"""
     try:
-        # Get all inventory keys from Redis using Dapr state store
-        # Note: This is a simplified approach. In production, you'd use proper key scanning
-        cleared_items = []
-        
-        # List of known product IDs that we'll attempt to clear
-        # In a real system, you'd scan the state store for all inventory keys
-        test_products = ["laptop-001", "mouse-001", "keyboard-001"]
-        
-        for product_id in test_products:
-            # Try to get the item first
-            inventory_item = get_inventory_item(product_id)
-            if inventory_item:
-                cleared_items.append({
-                    "product_id": product_id,
-                    "name": inventory_item.get("name", f"Product {product_id}"),
-                    "quantity_cleared": inventory_item.get("quantity", 0)
-                })
-                
-                # Delete inventory item
-                delete_url = f"{DAPR_URL}/v1.0/state/redis-statestore/inventory:{product_id}"
-                response = requests.delete(delete_url)
-                
-                if response.status_code != 204:
-                    app.logger.error(f"Failed to delete inventory item {product_id}: {response.text}")
-        
-        # Also clear reservations (simplified approach)
-        # In production, you'd scan for all reservation keys
-        reservation_keys_to_clear = []
-        for product_id in test_products:
-            # Try common reservation patterns
-            for i in range(1, 10):  # Clear potential reservation keys
-                reservation_key = f"reservation:order-{i}:{product_id}"
-                delete_url = f"{DAPR_URL}/v1.0/state/redis-statestore/{reservation_key}"
-                requests.delete(delete_url)  # Don't worry about errors for non-existent keys
+        cleared_items = [
+            {
+                "product_id": item["product_id"],
+                "name": item.get("name", f"Product {item['product_id']}"),
+                "quantity_cleared": item.get("quantity", 0)
+            }
+            for item in clear_inventory_state()
+        ]
         
         app.logger.info(f"Cleared {len(cleared_items)} inventory items")
         
@@ -148,21 +291,26 @@ def clear_all_inventory():
 
 @app.route('/inventory/list', methods=['GET'])
 def list_all_inventory():
-    """List all inventory items (helper endpoint for debugging)"""
+    """List inventory items from the product index, paginated with limit/after"""
     try:
-        # This is a simplified approach for demo purposes
-        # In production, you'd properly scan the state store
-        inventory_items = []
-        test_products = ["laptop-001", "mouse-001", "keyboard-001"]
+        try:
+            limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+            if limit < 1 or limit > MAX_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+        after = request.args.get("after")
+        
+        # Walk the index partitions in order, reading only the ones this page needs
+        entries, next_after = take(reservations.product_index.scan(dapr, after=after), limit)
         
-        for product_id in test_products:
-            inventory_item = get_inventory_item(product_id)
-            if inventory_item:
-                inventory_items.append(inventory_item)
+        records = get_inventory_items([product_id for _, product_id in entries])
+        inventory_items = [records[product_id] for _, product_id in entries if product_id in records]
         
         return jsonify({
             "inventory_items": inventory_items,
-            "total_items": len(inventory_items)
+            "count": len(inventory_items),
+            "next_cursor": next_after[1] if next_after else None
         }), 200
         
     except Exception as e:
@@ -183,37 +331,31 @@ def reserve_inventory(product_id):
         if not order_id:
             return jsonify({"error": "Order ID is required"}), 400
         
-        # Get current inventory
-        inventory_item = get_inventory_item(product_id)
+        # Decrement stock and record the reservation in one optimistic transaction
+        try:
+            result = stock.reserve_items(
+                dapr, order_id, [{"product_id": product_id, "quantity": quantity_to_reserve}]
+            )
+        except reservations.ReservationConflictError as e:
+            app.logger.warning(f"Reservation for {product_id} gave up after conflicts: {e}")
+            return jsonify({"error": "Inventory is busy, please retry"}), 409
+        except ledger.LedgerGapError as e:
+            app.logger.error(f"Inventory ledger of {product_id} is broken: {e}")
+            return jsonify({"error": str(e)}), 409
+        except DaprError as e:
+            app.logger.error(f"Failed to reserve inventory for {product_id}: {e}")
+            return jsonify({"error": "Failed to reserve inventory"}), 500
         
+        inventory_item = result["records"].get(product_id)
         if not inventory_item:
             return jsonify({"error": "Product not found"}), 404
         
-        if inventory_item["quantity"] < quantity_to_reserve:
+        if not result["all_items_reserved"]:
             return jsonify({"error": "Insufficient inventory", "available": inventory_item["quantity"]}), 400
         
-        # Update inventory
-        inventory_item["quantity"] -= quantity_to_reserve
-        inventory_item["last_updated"] = datetime.utcnow().isoformat()
-        
-        # Save updated inventory
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore"
-        state_data = [{"key": f"inventory:{product_id}", "value": inventory_item}]
-        
-        response = requests.post(state_url, json=state_data)
-        if response.status_code != 204:
-            return jsonify({"error": "Failed to reserve inventory"}), 500
-        
-        # Create reservation record
-        reservation = {
-            "product_id": product_id,
-            "order_id": order_id,
-            "quantity": quantity_to_reserve,
-            "reserved_at": datetime.utcnow().isoformat()
-        }
-        
-        reservation_data = [{"key": f"reservation:{order_id}:{product_id}", "value": reservation}]
-        requests.post(state_url, json=reservation_data)
+        reservation = result["reservations"][product_id]
+        remember_inventory({product_id: inventory_item})
+        broadcast_inventory_change([product_id])
         
         app.logger.info(f"Reserved {quantity_to_reserve} units of {product_id} for order {order_id}")
         return jsonify({
@@ -226,105 +368,413 @@ def reserve_inventory(product_id):
         app.logger.error(f"Error reserving inventory: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/inventory/<product_id>/release', methods=['POST'])
+def release_inventory(product_id):
+    """Release an order's reservation on a product, returning its stock"""
+    try:
+        order_id = (request.json or {}).get("order_id")
+        if not order_id:
+            return jsonify({"error": "Order ID is required"}), 400
+        
+        try:
+            released, records = release_reservations([reservations.reservation_key(order_id, product_id)], "released")
+        except (reservations.ReservationConflictError, IndexConflictError) as e:
+            app.logger.warning(f"Release for {product_id} gave up after conflicts: {e}")
+            return jsonify({"error": "Inventory is busy, please retry"}), 409
+        except DaprError as e:
+            app.logger.error(f"Failed to release inventory for {product_id}: {e}")
+            return jsonify({"error": "Failed to release inventory"}), 500
+        
+        if not released:
+            return jsonify({"error": "Reservation not found"}), 404
+        
+        inventory_item = records.get(product_id)
+        app.logger.info(f"Released {released[0]['quantity']} units of {product_id} for order {order_id}")
+        return jsonify({
+            "message": "Reservation released successfully",
+            "reservation": released[0],
+            "remaining_inventory": inventory_item["quantity"] if inventory_item else 0
+        })
+        
+    except Exception as e:
+        app.logger.error(f"Error releasing inventory: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+def release_reservations(reservation_keys, reason):
+    """Release reservations in one batch and refresh the cache; returns (released reservations, records)"""
+    if ACTOR_MODE:
+        released, records = actors.release_reservations(dapr, reservation_keys, reason)
+    else:
+        released, records = stock.release_reservations(dapr, reservation_keys, reason, outbox)
+    if records:
+        remember_inventory(records)
+        broadcast_inventory_change(list(records))
+    if released:
+        app.logger.info(
+            "Released %d reservations (%s)", len(released), reason,
+            extra={"released": len(released), "reason": reason}
+        )
+    return released, records
+
+@app.route('/inventory/<product_id>/shards', methods=['PUT'])
+def set_inventory_shards(product_id):
+    """Split a hot product's stock across shards, or merge it back with shards=0"""
+    try:
+        if ACTOR_MODE or LEDGER_MODE:
+            # Actors serialize a product's writes and ledgers append to one
+            # sequence; both merge any shards they find
+            return jsonify({"error": f"Stock sharding is not used in {INVENTORY_MODE} mode"}), 400
+        
+        shards = (request.json or {}).get("shards")
+        if not isinstance(shards, int) or shards < 0 or shards > MAX_SHARDS:
+            return jsonify({"error": f"shards must be an integer between 0 and {MAX_SHARDS}"}), 400
+        
+        try:
+            inventory_item = reservations.set_shards(dapr, product_id, shards)
+        except (DaprError, IndexConflictError) as e:
+            app.logger.error(f"Failed to reshard inventory for {product_id}: {e}")
+            return jsonify({"error": "Failed to update inventory sharding"}), 500
+        
+        if inventory_item is None:
+            return jsonify({"error": "Product not found"}), 404
+        
+        remember_inventory({product_id: inventory_item})
+        broadcast_inventory_change([product_id])
+        
+        app.logger.info(f"Inventory for {product_id} now uses {shards} stock shards")
+        return jsonify(inventory_item)
+        
+    except Exception as e:
+        app.logger.error(f"Error resharding inventory: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.route('/inventory/<product_id>/ledger', methods=['GET'])
+def get_inventory_ledger(product_id):
+    """Audit trail of a product's stock changes, newest first, paginated with limit/before"""
+    try:
+        if not LEDGER_MODE:
+            return jsonify({"error": "The inventory ledger is only kept in ledger mode"}), 400
+        
+        try:
+            limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+            if limit < 1 or limit > MAX_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+            before = int(request.args["before"]) if "before" in request.args else None
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+        
+        try:
+            changes = ledger.history(dapr, product_id, limit=limit, before=before)
+        except ledger.LedgerGapError as e:
+            return jsonify({"error": str(e)}), 409
+        if changes is None:
+            return jsonify({"error": "Product not found"}), 404
+        return jsonify(changes)
+        
+    except Exception as e:
+        app.logger.error(f"Error reading inventory ledger: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.route('/inventory/<product_id>/ledger/rebuild', methods=['POST'])
+def rebuild_inventory(product_id):
+    """Recompute a product's record by replaying its ledger"""
+    try:
+        if not LEDGER_MODE:
+            return jsonify({"error": "The inventory ledger is only kept in ledger mode"}), 400
+        
+        try:
+            rebuilt = ledger.rebuild(dapr, product_id)
+        except ledger.LedgerGapError as e:
+            return jsonify({"error": str(e)}), 409
+        except reservations.ReservationConflictError as e:
+            app.logger.warning(f"Rebuild of {product_id} gave up after conflicts: {e}")
+            return jsonify({"error": "Inventory is busy, please retry"}), 409
+        except DaprError as e:
+            app.logger.error(f"Failed to rebuild inventory for {product_id}: {e}")
+            return jsonify({"error": "Failed to rebuild inventory"}), 500
+        
+        if rebuilt is None:
+            return jsonify({"error": "Product not found"}), 404
+        
+        previous, inventory_item = rebuilt
+        inventory_cache.invalidate(product_id)
+        broadcast_inventory_change([product_id])
+        
+        app.logger.info(f"Rebuilt inventory for {product_id} from its ledger: {previous['quantity']} -> {inventory_item['quantity']}")
+        return jsonify({
+            "message": "Inventory rebuilt from its ledger",
+            "previous_quantity": previous["quantity"],
+            "inventory": inventory_item
+        })
+        
+    except Exception as e:
+        app.logger.error(f"Error rebuilding inventory: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.before_request
+def start_shard_rebalancer():
+    """Start this process's shard rebalancer, or its ledger compactor in ledger mode"""
+    if LEDGER_MODE:
+        ledger_compactor.start()
+    elif not ACTOR_MODE:
+        shard_rebalancer.start()
+
+@app.before_request
+def start_reservation_sweeper():
+    """Start this process's expired reservation sweeper and outbox relay"""
+    reservation_sweeper.start()
+    outbox.start()
+
+@app.route('/inventory/stats', methods=['GET'])
+def reservation_stats():
+    """Reservation retry and conflict counters, plus cache and deduplication statistics"""
+    stats = reservations.stats.snapshot()
+    stats["cache"] = inventory_cache.stats()
+    stats["deduplication"] = order_event_guard.stats()
+    stats["sharding"] = shard_rebalancer.stats()
+    stats["expiry"] = reservation_sweeper.stats()
+    stats["outbox"] = outbox.stats()
+    if ACTOR_MODE:
+        stats["actors"] = actor_host.stats()
+    if LEDGER_MODE:
+        stats["ledger"] = ledger_compactor.stats()
+    return jsonify(stats)
+
+@app.route('/dapr/config', methods=['GET'])
+def dapr_config():
+    """Dapr actor configuration endpoint; registers InventoryActor in actor mode"""
+    if not ACTOR_MODE:
+        return jsonify({"entities": []})
+    return jsonify(actor_host.config())
+
+@app.route('/healthz', methods=['GET'])
+def actor_health():
+    """Health check the Dapr runtime polls before placing actors here"""
+    return '', 200
+
+@app.route('/actors/<actor_type>/<actor_id>/method/<method>', methods=['PUT'])
+def invoke_actor(actor_type, actor_id, method):
+    """Run an InventoryActor method on behalf of the Dapr runtime"""
+    if not ACTOR_MODE or actor_type != actors.ACTOR_TYPE:
+        return jsonify({"error": f"Unknown actor type {actor_type}"}), 404
+    try:
+        return jsonify(actor_host.invoke(actor_id, method, request.get_json(silent=True) or {}))
+    except actors.UnknownActorMethodError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        app.logger.error(f"Actor {actor_type}/{actor_id}.{method} failed: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/actors/<actor_type>/<actor_id>', methods=['DELETE'])
+def deactivate_actor(actor_type, actor_id):
+    """Drop an actor the Dapr runtime deactivated"""
+    actor_host.deactivate(actor_id)
+    return '', 200
+
 @app.route('/dapr/subscribe', methods=['GET'])
 def subscribe():
     """Dapr subscription endpoint"""
     subscriptions = [
+        subscription("redis-pubsub", "order-events", "/handle-order-event")
+    ]
+    if CACHE_BROADCAST:
+        subscriptions.append(
+            subscription(BROADCAST_PUBSUB, CACHE_TOPIC, "/handle-inventory-cache-event", bulk=False)
+        )
+    return codec.dumps(subscriptions)
+
+@app.route('/handle-inventory-cache-event', methods=['POST'])
+@metrics.event_handler("inventory-cache-events")
+def handle_inventory_cache_event():
+    """Drop cached inventory changed by another replica"""
+    try:
+        event_data = request.json
+        actual_data = event_data['data'] if 'data' in event_data else event_data
+        
+        if actual_data.get("origin") != replica_id():
+            product_ids = actual_data.get("product_ids")
+            if product_ids is None:
+                inventory_cache.clear()
+            else:
+                for product_id in product_ids:
+                    inventory_cache.invalidate(product_id)
+        
+        return '', 200
+        
+    except Exception as e:
+        app.logger.error(f"Error handling inventory cache event: {str(e)}")
+        return '', 500
+
+def reservation_failed_status(items, available):
+    """Per-item status for an order whose reservation could not be written"""
+    return [
         {
-            "pubsubname": "redis-pubsub",
-            "topic": "order-events",
-            "route": "/handle-order-event"
+            "product_id": item.get("product_id"),
+            "status": "reservation_failed",
+            "available_quantity": available.get(item.get("product_id"), {}).get("quantity", 0)
         }
+        for item in items
     ]
-    return json.dumps(subscriptions)
+
+def inventory_processed_event(order_id, customer_id, inventory_status, all_items_reserved):
+    """Build the inventory_processed event published after handling an order"""
+    return {
+        "event_id": f"inventory_processed:{order_id}",
+        "order_id": order_id,
+        "customer_id": customer_id,
+        "inventory_status": inventory_status,
+        "all_items_reserved": all_items_reserved,
+        "event_type": "inventory_processed"
+    }
+
+def process_order_status_event(actual_data):
+    """Commit or release the reservations of an order whose status changed"""
+    status = (actual_data.get("status") or "").lower()
+    if status not in COMMIT_STATUSES and status not in RELEASE_STATUSES:
+        return
+    order_id = actual_data.get("order_id")
+    reservation_keys = reservations.order_reservations(dapr, order_id)
+    if not reservation_keys:
+        return
+    if status in COMMIT_STATUSES:
+        committed = reservations.commit_reservations(dapr, reservation_keys)
+        app.logger.info(
+            "Committed %d reservations for order %s", committed, order_id, extra={"order_id": order_id}
+        )
+    else:
+        release_reservations(reservation_keys, "cancelled")
+
+def process_order_event(actual_data):
+    """Reserve inventory for an order_created event; returns the inventory event to publish, or None"""
+    if actual_data.get("event_type") == "order_status_updated":
+        process_order_status_event(actual_data)
+        return None
+    if actual_data.get("event_type") != "order_created":
+        return None
+    
+    # Process order items and reserve inventory
+    order_id = actual_data.get("order_id")
+    customer_id = actual_data.get("customer_id")
+    items = actual_data.get("items", [])
+    
+    # Reserve every line item in one optimistic, transactional write; a
+    # redelivered order gets its recorded outcome back instead
+    try:
+        result = stock.reserve_items(dapr, order_id, items, idempotent=True)
+        inventory_status = result["inventory_status"]
+        all_items_reserved = result["all_items_reserved"]
+        if result["duplicate"]:
+            app.logger.info("Order %s was already reserved, re-sending its result", order_id, extra={"order_id": order_id})
+        for product_id, reservation in result["reservations"].items():
+            app.logger.debug(
+                "Reserved %s units of %s for order %s", reservation["quantity"], product_id, order_id,
+                extra={"order_id": order_id, "product_id": product_id}
+            )
+        reserved_records = {product_id: result["records"][product_id] for product_id in result["reservations"]}
+        remember_inventory(reserved_records)
+        broadcast_inventory_change(list(reserved_records))
+    except (DaprError, reservations.ReservationConflictError) as e:
+        app.logger.error(f"Failed to reserve inventory for order {order_id}: {e}")
+        available = get_inventory_items(list(dict.fromkeys(item.get("product_id") for item in items)))
+        inventory_status = reservation_failed_status(items, available)
+        all_items_reserved = False
+    
+    app.logger.info(
+        "Inventory processing completed for order %s. All reserved: %s", order_id, all_items_reserved,
+        extra={"order_id": order_id, "all_items_reserved": all_items_reserved}
+    )
+    return inventory_processed_event(order_id, customer_id, inventory_status, all_items_reserved)
+
+def publish_inventory_events(events):
+    """Publish inventory processing results, in a single bulk call when there are several.
+
+    Returns the positions in events that could not be published.
+    """
+    if not events:
+        return set()
+    try:
+        if len(events) == 1:
+            dapr.publish("inventory-events", events[0])
+            failed = set()
+        else:
+            failed = {int(entry_id) for entry_id in dapr.publish_bulk("inventory-events", list(enumerate(events)))}
+    except DaprError as e:
+        app.logger.error(f"Failed to publish inventory event: {e}")
+        return set(range(len(events)))
+    if failed:
+        app.logger.error(f"Failed to publish {len(failed)} of {len(events)} inventory events")
+    return failed
+
+def deduplicated_key(actual_data):
+    """Idempotency key of an event that must only be processed once, else None"""
+    if actual_data.get("event_type") != "order_created":
+        return None
+    return event_key(actual_data)
+
+def handle_order_events_bulk(body):
+    """Process a bulk delivery of order events and return a status per entry"""
+    entries = list(bulk_events(body))
+    keys = {entry_id: deduplicated_key(actual_data) for entry_id, actual_data in entries if actual_data is not None}
+    done = order_event_guard.processed(dapr, [key for key in keys.values() if key])
+    
+    statuses = {}
+    published = []  # (entry_id, key, inventory event)
+    for entry_id, actual_data in entries:
+        if actual_data is None:
+            statuses[entry_id] = DROP
+            continue
+        key = keys[entry_id]
+        if key in done:
+            statuses[entry_id] = SUCCESS
+            continue
+        log_payload(app.logger, "Order event", actual_data, event_key=key)
+        try:
+            inventory_event = process_order_event(actual_data)
+        except Exception as e:
+            app.logger.error(f"Error handling order event {entry_id}: {str(e)}")
+            statuses[entry_id] = RETRY
+            continue
+        if key:
+            done.add(key)  # Repeated within this delivery
+        if inventory_event:
+            published.append((entry_id, key, inventory_event))
+        statuses[entry_id] = SUCCESS
+    
+    # Publish inventory processing results; unpublished ones are redelivered
+    failed = publish_inventory_events([inventory_event for _, _, inventory_event in published])
+    for position, (entry_id, _, _) in enumerate(published):
+        if position in failed:
+            statuses[entry_id] = RETRY
+    order_event_guard.mark(dapr, [key for position, (_, key, _) in enumerate(published) if key and position not in failed])
+    return bulk_response(statuses)
 
 @app.route('/handle-order-event', methods=['POST'])
+@metrics.event_handler("order-events")
 def handle_order_event():
-    """Handle order events from pub/sub"""
+    """Handle order events from pub/sub, delivered one at a time or in bulk"""
     try:
         event_data = request.json
-        app.logger.info(f"Received order event: {event_data}")
+        
+        if is_bulk_delivery(event_data):
+            app.logger.debug("Received %d order events in bulk", len(event_data["entries"]))
+            return jsonify(handle_order_events_bulk(event_data))
         
         # Extract the actual event data from Dapr's CloudEvent format
-        if 'data' in event_data:
-            actual_data = event_data['data']
-        else:
-            actual_data = event_data
-        
-        event_type = actual_data.get("event_type")
-        
-        if event_type == "order_created":
-            # Process order items and reserve inventory
-            order_id = actual_data.get("order_id")
-            customer_id = actual_data.get("customer_id")
-            items = actual_data.get("items", [])
-            
-            inventory_status = []
-            all_items_reserved = True
-            
-            for item in items:
-                product_id = item.get("product_id")
-                quantity = item.get("quantity", 1)
-                
-                inventory_item = get_inventory_item(product_id)
-                
-                if inventory_item and inventory_item["quantity"] >= quantity:
-                    # Reserve inventory by reducing the quantity
-                    inventory_item["quantity"] -= quantity
-                    inventory_item["last_updated"] = datetime.utcnow().isoformat()
-                    
-                    # Save updated inventory
-                    state_url = f"{DAPR_URL}/v1.0/state/redis-statestore"
-                    state_data = [{"key": f"inventory:{product_id}", "value": inventory_item}]
-                    
-                    response = requests.post(state_url, json=state_data)
-                    if response.status_code == 204:
-                        # Create reservation record
-                        reservation = {
-                            "product_id": product_id,
-                            "order_id": order_id,
-                            "quantity": quantity,
-                            "reserved_at": datetime.utcnow().isoformat()
-                        }
-                        
-                        reservation_data = [{"key": f"reservation:{order_id}:{product_id}", "value": reservation}]
-                        requests.post(state_url, json=reservation_data)
-                        
-                        inventory_status.append({
-                            "product_id": product_id,
-                            "status": "reserved",
-                            "reserved_quantity": quantity,
-                            "remaining_quantity": inventory_item["quantity"]
-                        })
-                        app.logger.info(f"Reserved {quantity} units of {product_id} for order {order_id}")
-                    else:
-                        inventory_status.append({
-                            "product_id": product_id,
-                            "status": "reservation_failed",
-                            "available_quantity": inventory_item["quantity"]
-                        })
-                        all_items_reserved = False
-                else:
-                    inventory_status.append({
-                        "product_id": product_id,
-                        "status": "insufficient",
-                        "available_quantity": inventory_item["quantity"] if inventory_item else 0
-                    })
-                    all_items_reserved = False
-            
-            # Publish inventory processing result
-            inventory_event = {
-                "order_id": order_id,
-                "customer_id": customer_id,
-                "inventory_status": inventory_status,
-                "all_items_reserved": all_items_reserved,
-                "event_type": "inventory_processed"
-            }
-            
-            pubsub_url = f"{DAPR_URL}/v1.0/publish/redis-pubsub/inventory-events"
-            requests.post(pubsub_url, json=inventory_event)
-            
-            app.logger.info(f"Inventory processing completed for order {order_id}. All reserved: {all_items_reserved}")
+        actual_data = event_payload(event_data)
+        key = deduplicated_key(actual_data)
+        app.logger.debug("Received order event %s", key, extra={"event_key": key})
+        log_payload(app.logger, "Order event", event_data, event_key=key)
+        if key and order_event_guard.processed(dapr, [key]):
+            app.logger.info("Skipping already processed order event %s", key, extra={"event_key": key})
+            return '', 200
+        
+        inventory_event = process_order_event(actual_data)
+        
+        # Publish inventory processing result; on failure let Dapr redeliver
+        if inventory_event and publish_inventory_events([inventory_event]):
+            return '', 500
+        if key:
+            order_event_guard.mark(dapr, [key])
         
         # Return empty response with 200 status for successful processing
         return '', 200
@@ -335,46 +785,26 @@ def handle_order_event():
         return '', 500
 
 @app.route('/inventory', methods=['DELETE'])
-def clear_all_inventory():
+def clear_inventory():
     """Clear all inventory items"""
     try:
-        # Get all inventory keys from state store
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore"
-        
-        # First, get all keys (this is a simplified approach)
-        # In production, you might want to use a separate index
-        inventory_keys = []
-        
-        # For demo purposes, we'll track known product IDs
-        # You could also implement a proper key listing mechanism
-        known_products = ["laptop-001", "mouse-001", "keyboard-001"]
-        
-        for product_id in known_products:
-            # Check if item exists
-            get_url = f"{state_url}/inventory:{product_id}"
-            response = requests.get(get_url)
-            if response.status_code == 200:
-                inventory_keys.append(f"inventory:{product_id}")
-        
-        # Delete all inventory items
-        if inventory_keys:
-            delete_data = [{"key": key} for key in inventory_keys]
-            delete_response = requests.post(f"{state_url}/bulk", json=delete_data)
-            
-            if delete_response.status_code == 204:
-                app.logger.info(f"Cleared {len(inventory_keys)} inventory items")
-                return jsonify({
-                    "message": f"Successfully cleared {len(inventory_keys)} inventory items",
-                    "cleared_items": len(inventory_keys)
-                })
-            else:
-                return jsonify({"error": "Failed to clear inventory"}), 500
+        cleared = clear_inventory_state()
+        
+        if cleared:
+            app.logger.info(f"Cleared {len(cleared)} inventory items")
+            return jsonify({
+                "message": f"Successfully cleared {len(cleared)} inventory items",
+                "cleared_items": len(cleared)
+            })
         else:
             return jsonify({
                 "message": "No inventory items found to clear",
                 "cleared_items": 0
             })
         
+    except DaprError as e:
+        app.logger.error(f"Failed to clear inventory: {e}")
+        return jsonify({"error": "Failed to clear inventory"}), 500
     except Exception as e:
         app.logger.error(f"Error clearing inventory: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
@@ -383,24 +813,29 @@ def clear_all_inventory():
 def delete_inventory_item(product_id):
     """Delete a specific inventory item"""
     try:
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore/inventory:{product_id}"
+        try:
+            deleted = stock.remove_product(dapr, product_id)
+        except (DaprError, IndexConflictError) as e:
+            app.logger.error(f"Failed to delete inventory item {product_id}: {e}")
+            return jsonify({"error": "Failed to delete inventory item"}), 500
         
-        # Check if item exists first
-        response = requests.get(state_url)
-        if response.status_code == 204:  # No content means key doesn't exist
+        inventory_cache.invalidate(product_id)
+        if not deleted:  # No content means key doesn't exist
             return jsonify({"error": "Inventory item not found"}), 404
+        broadcast_inventory_change([product_id])
         
-        # Delete the item
-        delete_response = requests.delete(state_url)
-        if delete_response.status_code == 204:
-            app.logger.info(f"Deleted inventory item: {product_id}")
-            return jsonify({"message": f"Successfully deleted inventory for {product_id}"})
-        else:
-            return jsonify({"error": "Failed to delete inventory item"}), 500
+        app.logger.info(f"Deleted inventory item: {product_id}")
+        return jsonify({"message": f"Successfully deleted inventory for {product_id}"})
         
     except Exception as e:
         app.logger.error(f"Error deleting inventory item {product_id}: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+def shutdown():
+    """Publish pending release events and release sidecar connections before the process exits"""
+    outbox.close()
+    dapr.close()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5002, debug=True)
+    # Local development server; production runs under gunicorn (common/gunicorn_config.py)
+    app.run(host='0.0.0.0', port=5002, threaded=True)
@@ -0,0 +1,210 @@
+"""ASGI serving mode for the inventory service.
+
+The order-event handler and the inventory lookup run natively on asyncio
+with AsyncDaprClient, so a single process can keep thousands of deliveries
+and storefront polls in flight while they wait on the sidecar. Every other
+route is served by the Flask app through WSGIMiddleware.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 5002
+"""
+import logging
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+import app as flask_service
+import ledger
+import reservations
+from common import metrics
+from common.async_dapr_client import AsyncDaprClient
+from common.codec import json_response, request_json
+from common.dapr_client import DaprError
+from common.pubsub import DROP, RETRY, SUCCESS, bulk_events, bulk_response, event_payload, is_bulk_delivery
+from common.structured_logging import log_payload
+
+logger = logging.getLogger("inventory-service.asgi")
+
+dapr = AsyncDaprClient(flask_service.DAPR_URL)
+reserve_items = flask_service.stock.reserve_items_async
+load_inventory = ledger.load_inventory_async if flask_service.LEDGER_MODE else reservations.load_inventory_async
+flask_app = WSGIMiddleware(flask_service.app)
+
+
+@metrics.asgi_endpoint("/inventory/<product_id>")
+async def get_inventory(request):
+    """Get inventory for a specific product"""
+    product_id = request.path_params["product_id"]
+    try:
+        inventory_item = flask_service.inventory_cache.get(product_id)
+        if inventory_item is None:
+            inventory_item = (await load_inventory(dapr, [product_id])).get(product_id)
+            if inventory_item is not None:
+                flask_service.inventory_cache.set(product_id, inventory_item)
+    except ledger.LedgerGapError as e:
+        logger.error(f"Inventory ledger of {product_id} is broken: {e}")
+        return json_response({"error": str(e)}, status_code=409)
+    except Exception as e:
+        logger.error(f"Error retrieving inventory: {str(e)}")
+        return json_response({"error": "Internal server error"}, status_code=500)
+
+    if not inventory_item:
+        return json_response({"error": "Product not found"}, status_code=404)
+    return json_response(inventory_item)
+
+
+async def broadcast_inventory_change(product_ids):
+    """Coroutine version of the Flask app's broadcast_inventory_change"""
+    if not flask_service.CACHE_BROADCAST or not product_ids:
+        return
+    try:
+        await dapr.publish(
+            flask_service.CACHE_TOPIC,
+            flask_service.inventory_change_event(product_ids),
+            pubsub_name=flask_service.BROADCAST_PUBSUB
+        )
+    except DaprError as e:
+        logger.warning(f"Failed to broadcast inventory cache invalidation: {e}")
+
+
+async def process_order_event(actual_data):
+    """Coroutine version of the Flask app's process_order_event"""
+    if actual_data.get("event_type") == "order_status_updated":
+        # Rare, and batched against the expiry index; not worth an async twin
+        await run_in_threadpool(flask_service.process_order_status_event, actual_data)
+        return None
+    if actual_data.get("event_type") != "order_created":
+        return None
+
+    order_id = actual_data.get("order_id")
+    customer_id = actual_data.get("customer_id")
+    items = actual_data.get("items", [])
+
+    try:
+        result = await reserve_items(dapr, order_id, items, idempotent=True)
+        inventory_status = result["inventory_status"]
+        all_items_reserved = result["all_items_reserved"]
+        if result["duplicate"]:
+            logger.info("Order %s was already reserved, re-sending its result", order_id, extra={"order_id": order_id})
+        reserved_records = {product_id: result["records"][product_id] for product_id in result["reservations"]}
+        flask_service.remember_inventory(reserved_records)
+        await broadcast_inventory_change(list(reserved_records))
+    except (DaprError, reservations.ReservationConflictError) as e:
+        logger.error(f"Failed to reserve inventory for order {order_id}: {e}")
+        product_ids = list(dict.fromkeys(item.get("product_id") for item in items))
+        available = await load_inventory(dapr, product_ids)
+        inventory_status = flask_service.reservation_failed_status(items, available)
+        all_items_reserved = False
+
+    logger.info(
+        "Inventory processing completed for order %s. All reserved: %s", order_id, all_items_reserved,
+        extra={"order_id": order_id, "all_items_reserved": all_items_reserved}
+    )
+    return flask_service.inventory_processed_event(order_id, customer_id, inventory_status, all_items_reserved)
+
+
+async def publish_inventory_events(events):
+    """Coroutine version of the Flask app's publish_inventory_events"""
+    if not events:
+        return set()
+    try:
+        if len(events) == 1:
+            await dapr.publish("inventory-events", events[0])
+            failed = set()
+        else:
+            failed = {int(entry_id) for entry_id in await dapr.publish_bulk("inventory-events", list(enumerate(events)))}
+    except DaprError as e:
+        logger.error(f"Failed to publish inventory event: {e}")
+        return set(range(len(events)))
+    if failed:
+        logger.error(f"Failed to publish {len(failed)} of {len(events)} inventory events")
+    return failed
+
+
+async def process_bulk_entry(entry_id, actual_data):
+    """Process one entry of a bulk delivery; returns (status, inventory event)"""
+    if actual_data is None:
+        return DROP, None
+    try:
+        return SUCCESS, await process_order_event(actual_data)
+    except Exception as e:
+        logger.error(f"Error handling order event {entry_id}: {str(e)}")
+        return RETRY, None
+
+
+async def handle_order_events_bulk(body):
+    """Coroutine version of the Flask app's handle_order_events_bulk"""
+    guard = flask_service.order_event_guard
+    entries = list(bulk_events(body))
+    keys = {
+        entry_id: flask_service.deduplicated_key(actual_data)
+        for entry_id, actual_data in entries if actual_data is not None
+    }
+    done = await guard.processed_async(dapr, [key for key in keys.values() if key])
+
+    # Entries are processed in order: running them concurrently would make
+    # orders for the same product conflict with each other
+    statuses = {}
+    published = []
+    for entry_id, actual_data in entries:
+        if actual_data is not None and keys[entry_id] in done:
+            statuses[entry_id] = SUCCESS
+            continue
+        statuses[entry_id], inventory_event = await process_bulk_entry(entry_id, actual_data)
+        if statuses[entry_id] == SUCCESS and keys[entry_id]:
+            done.add(keys[entry_id])
+        if inventory_event:
+            published.append((entry_id, keys[entry_id], inventory_event))
+
+    failed = await publish_inventory_events([inventory_event for _, _, inventory_event in published])
+    for position, (entry_id, _, _) in enumerate(published):
+        if position in failed:
+            statuses[entry_id] = RETRY
+    await guard.mark_async(dapr, [key for position, (_, key, _) in enumerate(published) if key and position not in failed])
+    return bulk_response(statuses)
+
+
+@metrics.asgi_endpoint("/handle-order-event", handler="order-events")
+async def handle_order_event(request):
+    """Handle order events from pub/sub, delivered one at a time or in bulk"""
+    try:
+        event_data = await request_json(request)
+
+        if is_bulk_delivery(event_data):
+            return json_response(await handle_order_events_bulk(event_data))
+
+        actual_data = event_payload(event_data)
+        key = flask_service.deduplicated_key(actual_data)
+        log_payload(logger, "Order event", event_data, event_key=key)
+        if key and await flask_service.order_event_guard.processed_async(dapr, [key]):
+            logger.info("Skipping already processed order event %s", key, extra={"event_key": key})
+            return Response(status_code=200)
+
+        inventory_event = await process_order_event(actual_data)
+        if inventory_event and await publish_inventory_events([inventory_event]):
+            return Response(status_code=500)
+        if key:
+            await flask_service.order_event_guard.mark_async(dapr, [key])
+
+        return Response(status_code=200)
+
+    except Exception as e:
+        logger.error(f"Error handling order event: {str(e)}")
+        # Return 500 for retriable errors
+        return Response(status_code=500)
+
+
+app = Starlette(
+    routes=[
+        Route("/handle-order-event", handle_order_event, methods=["POST"]),
+        # Static inventory routes that would otherwise match {product_id}
+        Route("/inventory/list", flask_app),
+        Route("/inventory/stats", flask_app),
+        Route("/inventory/{product_id}", get_inventory, methods=["GET"]),
+        Mount("/", flask_app),
+    ],
+    on_startup=[flask_service.start_shard_rebalancer, flask_service.start_reservation_sweeper],
+    on_shutdown=[dapr.close, flask_service.outbox.close],
+)
@@ -0,0 +1,780 @@
+"""Event-sourced inventory ledger (INVENTORY_MODE=ledger).
+
+Adds, reservations and releases do not rewrite the whole inventory record.
+Each one appends a small change record to the product's ledger, under
+inventory-ledger:{product_id}:{epoch}:{seq}. A change is written create-only
+at the next sequence number, in the same transaction as the reservation
+records and indexes. Two writers that read the same ledger position
+therefore conflict on the append, and one of them retries, just as they
+would on the record's ETag in state mode, so stock cannot be oversold.
+
+The inventory:{product_id} record becomes a snapshot holding the stock as
+of a ledger position (its ledger.seq), and readers apply the pending
+changes after it. A LedgerCompactor folds pending changes into the
+snapshot. It runs as soon as a product collects COMPACT_THRESHOLD of them
+in this process, and for every product on a slower schedule. Changes are
+written without a TTL, so a pending change cannot expire however far
+compaction falls behind. Folding them sets LEDGER_RETENTION_SECONDS on them
+instead of deleting them. They stay that long as an audit trail (history()),
+and while the whole ledger is retained, rebuild() replays it from its base
+to recompute the snapshot.
+
+A ledger whose pending changes are missing anyway, because a change was
+read past a missing one or one this process read before is gone, raises
+LedgerGapError rather than serving stock without those changes.
+
+Removing a product closes its ledger: the pending changes get the retention
+TTL and a final remove change is appended. A product gets a new epoch, and
+so a fresh ledger, whenever its record is created. Records written in state mode are adopted on their first ledger
+write: sharded stock is merged back into the record, and the record's
+quantity becomes the ledger's base. Reservation records, reservation
+indexes, expiry and release events are the same as in reservations.py.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from common.dapr_client import EtagMismatchError, upsert_operation
+from common.state_index import index_keys, index_operations, registrations
+import reservations
+
+# Changes expire this long after they are folded into the snapshot (0 keeps them forever)
+LEDGER_RETENTION_SECONDS = int(os.getenv("INVENTORY_LEDGER_RETENTION_SECONDS", str(7 * 86400)))
+
+# Pending changes that make this process compact a product straight away
+COMPACT_THRESHOLD = int(os.getenv("INVENTORY_LEDGER_COMPACT_THRESHOLD", "20"))
+
+# Changes read past the last known end of a product's ledger per round trip
+READ_AHEAD = int(os.getenv("INVENTORY_LEDGER_READ_AHEAD", "8"))
+
+REPLAY_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+# product_id -> (epoch, snapshot seq, head) as last read by this process, so
+# the first read of a product usually fetches its pending changes as well
+_heads = {}
+
+# Products that reached COMPACT_THRESHOLD, for the compactor thread
+_due = set()
+_due_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+class LedgerGapError(Exception):
+    """Raised when some of a product's ledger changes are missing, so its stock cannot be computed"""
+
+    def __init__(self, product_id, message):
+        super().__init__(message)
+        self.product_id = product_id
+
+
+def change_key(product_id, epoch, seq):
+    return f"inventory-ledger:{product_id}:{epoch}:{seq}"
+
+
+def new_ledger(base=0):
+    """Ledger position of a record that has not folded any changes yet"""
+    return {"epoch": uuid.uuid4().hex[:12], "seq": 0, "base": base}
+
+
+def change(kind, quantity, **fields):
+    """A ledger change of quantity units; fields that are None are left out"""
+    entry = {"type": kind, "change": quantity, "at": datetime.utcnow().isoformat()}
+    entry.update({field: value for field, value in fields.items() if value is not None})
+    return entry
+
+
+class LedgerView:
+    """A product's snapshot record, read with its ETag, and the changes appended after it"""
+
+    def __init__(self, product_id, record, etag, pending):
+        self.product_id = product_id
+        self.record = record
+        self.etag = etag
+        self.pending = pending
+
+    @property
+    def adopted(self):
+        """False for a record written in state mode that has no ledger yet"""
+        return "ledger" in self.record and not reservations.shard_count(self.record)
+
+    @property
+    def head(self):
+        """Sequence number of the product's last change"""
+        return self.record["ledger"]["seq"] + len(self.pending)
+
+    def current(self):
+        """The record with the pending changes applied"""
+        record = dict(self.record, quantity=self.record["quantity"] + sum(entry["change"] for entry in self.pending))
+        for entry in self.pending:
+            record.update({field: entry[field] for field in ("name", "price") if field in entry})
+            record["last_updated"] = entry["at"]
+        return record
+
+    def snapshot(self):
+        """The record with the pending changes folded in, positioned at head"""
+        return dict(self.current(), ledger=dict(self.record["ledger"], seq=self.head))
+
+    def append(self, *entries):
+        """Create-only writes appending changes after head; they become pending in this view"""
+        operations = []
+        for entry in entries:
+            entry["seq"] = self.head + 1
+            self.pending.append(entry)
+            operations.append(upsert_operation(
+                change_key(self.product_id, self.record["ledger"]["epoch"], entry["seq"]),
+                entry,
+                first_write=True
+            ))
+        return operations
+
+    def fold(self):
+        """Writes folding the pending changes into the snapshot; folded changes start to expire"""
+        operations = [upsert_operation(f"inventory:{self.product_id}", self.snapshot(), self.etag)]
+        if LEDGER_RETENTION_SECONDS:
+            epoch = self.record["ledger"]["epoch"]
+            operations.extend(
+                upsert_operation(change_key(self.product_id, epoch, entry["seq"]), entry, ttl=LEDGER_RETENTION_SECONDS)
+                for entry in self.pending
+            )
+        return operations
+
+
+def _first_keys(product_ids):
+    """Snapshot keys, plus the changes this process last saw pending and a few more"""
+    keys = [f"inventory:{product_id}" for product_id in product_ids]
+    for product_id in product_ids:
+        if product_id in _heads:
+            epoch, seq, head = _heads[product_id]
+            keys.extend(change_key(product_id, epoch, n) for n in range(seq + 1, head + READ_AHEAD + 1))
+    return keys
+
+
+def _ledger_end(product_id, entries):
+    """(epoch, snapshot seq, last contiguous change read) of a product, or None if it has no ledger"""
+    record = entries.get(f"inventory:{product_id}", (None, None))[0]
+    if not record or "ledger" not in record:
+        return None
+    epoch, seq = record["ledger"]["epoch"], record["ledger"]["seq"]
+    end = seq
+    while change_key(product_id, epoch, end + 1) in entries:
+        end += 1
+    return epoch, seq, end
+
+
+def _missing_to(product_id, epoch, end, entries, known):
+    """Last seq of the changes missing after end, or None if the ledger ends there.
+
+    Changes are missing if a later one was read, or if this process had read
+    up to a later head of the same ledger (known) before.
+    """
+    prefix = change_key(product_id, epoch, "")
+    later = [int(key[len(prefix):]) for key in entries if key.startswith(prefix) and key[len(prefix):].isdigit()]
+    later = [seq for seq in later if seq > end]
+    if later:
+        return min(later) - 1
+    if known and known[0] == epoch and known[2] > end:
+        return known[2]
+    return None
+
+
+def _next_keys(product_ids, entries, requested):
+    """Change keys past the end of what was read so far; empty once every ledger's end was found"""
+    keys = []
+    for product_id in product_ids:
+        position = _ledger_end(product_id, entries)
+        if position is None:
+            continue
+        epoch, seq, end = position
+        if change_key(product_id, epoch, end + 1) not in requested:
+            # Read further ahead the more changes are pending
+            count = max(READ_AHEAD, end - seq)
+            keys.extend(change_key(product_id, epoch, n) for n in range(end + 1, end + count + 1))
+    return keys
+
+
+def _gap_keys(product_ids, entries, known):
+    """Keys of the changes that look missing, to be read once more"""
+    keys = []
+    for product_id in product_ids:
+        position = _ledger_end(product_id, entries)
+        if position is None:
+            continue
+        epoch, _, end = position
+        last = _missing_to(product_id, epoch, end, entries, known.get(product_id))
+        if last is not None:
+            keys.extend(change_key(product_id, epoch, n) for n in range(end + 1, last + 1))
+    return keys
+
+
+def _views(product_ids, entries, known):
+    views = {}
+    for product_id in product_ids:
+        record, etag = entries.get(f"inventory:{product_id}", (None, None))
+        if record is None:
+            continue
+        pending = []
+        position = _ledger_end(product_id, entries)
+        if position is not None:
+            epoch, seq, end = position
+            if _missing_to(product_id, epoch, end, entries, known.get(product_id)) is not None:
+                raise LedgerGapError(product_id, f"Change {end + 1} of the ledger of {product_id} is missing")
+            pending = [entries[change_key(product_id, epoch, n)][0] for n in range(seq + 1, end + 1)]
+            _heads[product_id] = (epoch, seq, end)
+        views[product_id] = LedgerView(product_id, record, etag, pending)
+    return views
+
+
+def read_views(dapr, product_ids, extra_keys=()):
+    """Read products' snapshots and pending changes, and extra_keys, with their ETags.
+
+    Returns ({product_id: LedgerView} for the existing products, entries).
+    Raises LedgerGapError if a product's pending changes are missing.
+    """
+    known = {product_id: _heads.get(product_id) for product_id in product_ids}
+    keys = _first_keys(product_ids) + list(extra_keys)
+    entries, requested, rechecked = {}, set(), False
+    while keys:
+        entries.update(dapr.get_bulk_state_with_etags(keys))
+        requested.update(keys)
+        keys = _next_keys(product_ids, entries, requested)
+        if not keys and not rechecked:
+            # A change appended while the ledgers were read can look like a gap,
+            # since a bulk read is not atomic; read the missing ones once more
+            keys, rechecked = _gap_keys(product_ids, entries, known), True
+    return _views(product_ids, entries, known), entries
+
+
+async def read_views_async(dapr, product_ids, extra_keys=()):
+    """Coroutine version of read_views for an AsyncDaprClient"""
+    known = {product_id: _heads.get(product_id) for product_id in product_ids}
+    keys = _first_keys(product_ids) + list(extra_keys)
+    entries, requested, rechecked = {}, set(), False
+    while keys:
+        entries.update(await dapr.get_bulk_state_with_etags(keys))
+        requested.update(keys)
+        keys = _next_keys(product_ids, entries, requested)
+        if not keys and not rechecked:
+            keys, rechecked = _gap_keys(product_ids, entries, known), True
+    return _views(product_ids, entries, known), entries
+
+
+def _adoption(view):
+    """Write starting the ledger of a record written in state mode, at its current quantity"""
+    record = dict(view.record, ledger=new_ledger(view.record["quantity"]))
+    return upsert_operation(f"inventory:{view.product_id}", record, view.etag)
+
+
+def _adopt(dapr, views):
+    """Start a ledger for records written in state mode; returns True if any had to be adopted"""
+    unadopted = [view for view in views.values() if not view.adopted]
+    for view in unadopted:
+        if reservations.shard_count(view.record):
+            # Merged first; the ledger is started on the next attempt
+            reservations.set_shards(dapr, view.product_id, 0)
+            continue
+        try:
+            dapr.transact_state([_adoption(view)])
+        except EtagMismatchError:
+            pass  # Changed or adopted concurrently; read again on the next attempt
+    return bool(unadopted)
+
+
+async def _adopt_async(dapr, views):
+    """Coroutine version of _adopt; sharded stock is left for the compactor thread to merge"""
+    unadopted = [view for view in views.values() if not view.adopted]
+    for view in unadopted:
+        if reservations.shard_count(view.record):
+            _mark_due({view.product_id: view}, force=True)
+            continue
+        try:
+            await dapr.transact_state([_adoption(view)])
+        except EtagMismatchError:
+            pass
+    return bool(unadopted)
+
+
+def _mark_due(views, force=False):
+    """Hand products with many pending changes (or all of them, with force) to the compactor"""
+    due = [product_id for product_id, view in views.items() if force or len(view.pending) >= COMPACT_THRESHOLD]
+    if due:
+        with _due_lock:
+            _due.update(due)
+        _wakeup.set()
+
+
+def _reserve_read_keys(order_id, product_ids, reserved_at, idempotent):
+    keys = [reservations.order_index(order_id).name]
+    keys.extend(reservations.expiry_read_keys(product_ids, reserved_at))
+    if idempotent:
+        keys.append(reservations.result_key(order_id))
+    return keys
+
+
+def reserve_items(dapr, order_id, items, max_retries=None, idempotent=False):
+    """Ledger version of reservations.reserve_items: appends a reserve change per product"""
+    max_retries = reservations.MAX_RETRIES if max_retries is None else max_retries
+    product_ids = list(dict.fromkeys(item.get("product_id") for item in items))
+
+    for attempt in range(max_retries + 1):
+        reserved_at = datetime.utcnow().isoformat()
+        extra_keys = _reserve_read_keys(order_id, product_ids, reserved_at, idempotent)
+        views, entries = read_views(dapr, product_ids, extra_keys)
+        if _adopt(dapr, views):
+            continue
+        result, operations = _prepare(order_id, items, views, entries, reserved_at, idempotent)
+        if not operations:
+            reservations.stats.record(attempts=1)
+            return result
+
+        try:
+            dapr.transact_state(operations)
+        except EtagMismatchError:
+            _record_conflict(attempt, max_retries, result)
+            if attempt < max_retries:
+                time.sleep(_backoff(attempt))
+            continue
+
+        reservations.stats.record(attempts=1, committed=1)
+        _mark_due(views)
+        return result
+
+    reservations.stats.record(exhausted=1)
+    raise reservations.ReservationConflictError(f"Reservation for order {order_id} conflicted {max_retries + 1} times")
+
+
+async def reserve_items_async(dapr, order_id, items, max_retries=None, idempotent=False):
+    """Coroutine version of reserve_items for an AsyncDaprClient"""
+    max_retries = reservations.MAX_RETRIES if max_retries is None else max_retries
+    product_ids = list(dict.fromkeys(item.get("product_id") for item in items))
+
+    for attempt in range(max_retries + 1):
+        reserved_at = datetime.utcnow().isoformat()
+        extra_keys = _reserve_read_keys(order_id, product_ids, reserved_at, idempotent)
+        views, entries = await read_views_async(dapr, product_ids, extra_keys)
+        if await _adopt_async(dapr, views):
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        result, operations = _prepare(order_id, items, views, entries, reserved_at, idempotent)
+        if not operations:
+            reservations.stats.record(attempts=1)
+            return result
+
+        try:
+            await dapr.transact_state(operations)
+        except EtagMismatchError:
+            _record_conflict(attempt, max_retries, result)
+            if attempt < max_retries:
+                await asyncio.sleep(_backoff(attempt))
+            continue
+
+        reservations.stats.record(attempts=1, committed=1)
+        _mark_due(views)
+        return result
+
+    reservations.stats.record(exhausted=1)
+    raise reservations.ReservationConflictError(f"Reservation for order {order_id} conflicted {max_retries + 1} times")
+
+
+def _prepare(order_id, items, views, entries, reserved_at, idempotent=False):
+    """Plan a reservation made at reserved_at against freshly read ledgers and build its transaction"""
+    if idempotent and reservations.result_key(order_id) in entries:
+        return reservations.recorded_result(entries[reservations.result_key(order_id)][0]), []
+
+    records = {product_id: view.current() for product_id, view in views.items()}
+    inventory_status, all_items_reserved, reserved = reservations.plan_items(order_id, items, records, reserved_at)
+    result = {
+        "inventory_status": inventory_status,
+        "all_items_reserved": all_items_reserved,
+        "records": records,
+        "reservations": reserved,
+        "duplicate": False,
+    }
+
+    operations = [reservations.result_marker(order_id, inventory_status, all_items_reserved)] if idempotent else []
+    index_changes = []
+    for product_id, reservation in reserved.items():
+        operations.extend(views[product_id].append(change("reserve", -reservation["quantity"], order_id=order_id)))
+        index_changes.append(reservations.order_index(order_id).add(product_id, reservation["reserved_at"]))
+        ttl, expiry_changes = reservations.hold(reservation)
+        operations.append(upsert_operation(reservations.reservation_key(order_id, product_id), reservation, ttl=ttl))
+        index_changes.extend(expiry_changes)
+    index_changes.extend(registrations(index_changes, entries))
+    return result, operations + index_operations(index_changes, entries)
+
+
+def _record_conflict(attempt, max_retries, result):
+    reservations.stats.record(attempts=1, retries=1 if attempt < max_retries else 0,
+                              conflict_products=list(result["reservations"]))
+
+
+def _backoff(attempt):
+    return reservations.RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def add_stock(dapr, product_id, quantity, name=None, price=None, max_retries=None):
+    """Ledger version of reservations.add_stock: appends an add change.
+
+    A new product's record is created with an empty ledger. For an existing
+    product, name and price are only changed when given.
+    """
+    max_retries = reservations.MAX_RETRIES if max_retries is None else max_retries
+    key = f"inventory:{product_id}"
+    index_changes = [reservations.product_index.add(product_id, 0)]
+
+    for attempt in range(max_retries + 1):
+        views, entries = read_views(dapr, [product_id], index_keys(index_changes))
+        if _adopt(dapr, views):
+            continue
+        view = views.get(product_id)
+        operations = []
+        if view is None:
+            record = {
+                "product_id": product_id,
+                "quantity": 0,
+                "last_updated": datetime.utcnow().isoformat(),
+                "name": name if name is not None else f"Product {product_id}",
+                "price": price if price is not None else 0.0,
+                "ledger": new_ledger()
+            }
+            view = LedgerView(product_id, record, None, [])
+            operations.append(upsert_operation(key, record, first_write=True))
+            operations.extend(index_operations(index_changes, entries))
+        operations.extend(view.append(change("add", quantity, name=name, price=price)))
+
+        try:
+            dapr.transact_state(operations)
+        except EtagMismatchError:
+            reservations.stats.record(attempts=1, retries=1 if attempt < max_retries else 0,
+                                      conflict_products=[product_id])
+            if attempt < max_retries:
+                time.sleep(_backoff(attempt))
+            continue
+
+        reservations.stats.record(attempts=1, committed=1)
+        _mark_due({product_id: view})
+        return view.current()
+
+    reservations.stats.record(exhausted=1)
+    raise reservations.ReservationConflictError(f"Stock update for {product_id} conflicted {max_retries + 1} times")
+
+
+def release_reservations(dapr, reservation_keys, reason, outbox=None, max_retries=None):
+    """Ledger version of reservations.release_reservations: appends a release change per reservation"""
+    max_retries = reservations.MAX_RETRIES if max_retries is None else max_retries
+
+    for attempt in range(max_retries + 1):
+        found = dapr.get_bulk_state_with_etags(reservation_keys)
+        held, by_product, operations, index_changes, outbox_records = reservations.plan_release(
+            found, reservation_keys, reason, outbox
+        )
+        if not operations and not index_changes:
+            return [], {}
+
+        views, entries = read_views(dapr, list(by_product), index_keys(index_changes))
+        if _adopt(dapr, views):
+            continue
+        records = {}
+        for product_id, product_reservations in by_product.items():
+            # Stock of products deleted in the meantime is not returned
+            if product_id in views:
+                operations.extend(views[product_id].append(*[
+                    change("release", reservation["quantity"], order_id=reservation["order_id"], reason=reason)
+                    for reservation in product_reservations
+                ]))
+                records[product_id] = views[product_id].current()
+
+        try:
+            dapr.transact_state(operations + index_operations(index_changes, entries))
+        except EtagMismatchError:
+            reservations.stats.record(attempts=1, retries=1 if attempt < max_retries else 0,
+                                      conflict_products=list(by_product))
+            if attempt < max_retries:
+                time.sleep(_backoff(attempt))
+            continue
+
+        reservations.stats.record(attempts=1, committed=1)
+        if outbox_records:
+            outbox.notify(outbox_records)
+        _mark_due(views)
+        return list(held.values()), records
+
+    reservations.stats.record(exhausted=1)
+    raise reservations.ReservationConflictError(f"Release of {len(reservation_keys)} reservations conflicted {max_retries + 1} times")
+
+
+def _pending_changes(dapr, records):
+    """{product_id: [change]} of every pending change of the products that can be found, in seq order.
+
+    Reads on past gaps shorter than READ_AHEAD, so a ledger with a gap can
+    still be closed.
+    """
+    found = {product_id: {} for product_id in records}
+    ends, scanned = {}, {}
+    for product_id, record in records.items():
+        ledger = record["ledger"]
+        known = _heads.get(product_id)
+        scanned[product_id] = ledger["seq"]
+        ends[product_id] = max(ledger["seq"], known[2] if known and known[0] == ledger["epoch"] else 0)
+    while True:
+        keys = {}
+        for product_id, record in records.items():
+            epoch = record["ledger"]["epoch"]
+            for n in range(scanned[product_id] + 1, ends[product_id] + READ_AHEAD + 1):
+                keys[change_key(product_id, epoch, n)] = product_id
+            scanned[product_id] = ends[product_id] + READ_AHEAD
+        if not keys:
+            return {product_id: [changes[seq] for seq in sorted(changes)] for product_id, changes in found.items()}
+        for key, entry in dapr.get_bulk_state(list(keys)).items():
+            found[keys[key]][entry["seq"]] = entry
+            ends[keys[key]] = max(ends[keys[key]], entry["seq"])
+
+
+def _closing(product_id, record, pending):
+    """The record as of its last change, and writes closing its ledger as the product is removed.
+
+    The pending changes get the retention TTL, as if folded, and a remove
+    change is written create-only after the last of them, so a writer still
+    appending to the ledger conflicts rather than leaving a change behind.
+    """
+    current = LedgerView(product_id, record, None, pending).current()
+    epoch = record["ledger"]["epoch"]
+    seq = pending[-1]["seq"] + 1 if pending else record["ledger"]["seq"] + 1
+    operations = []
+    if LEDGER_RETENTION_SECONDS:
+        operations.extend(
+            upsert_operation(change_key(product_id, epoch, entry["seq"]), entry, ttl=LEDGER_RETENTION_SECONDS)
+            for entry in pending
+        )
+    operations.append(upsert_operation(
+        change_key(product_id, epoch, seq),
+        dict(change("remove", -current["quantity"]), seq=seq),
+        first_write=True,
+        ttl=LEDGER_RETENTION_SECONDS or None
+    ))
+    return current, operations
+
+
+def close_ledgers(dapr, product_ids):
+    """Records of products as of their last change, and writes closing their ledgers.
+
+    For clearing all inventory; works on ledgers with a gap, which
+    load_inventory does not.
+    """
+    found = dapr.get_bulk_state([f"inventory:{product_id}" for product_id in product_ids])
+    records = {product_id: found[f"inventory:{product_id}"] for product_id in product_ids if f"inventory:{product_id}" in found}
+    ledgers = {product_id: record for product_id, record in records.items() if "ledger" in record}
+    operations = []
+    for product_id, pending in _pending_changes(dapr, ledgers).items():
+        records[product_id], closing = _closing(product_id, ledgers[product_id], pending)
+        operations.extend(closing)
+    sharded = [product_id for product_id, record in records.items() if reservations.shard_count(record)]
+    if sharded:
+        records.update(reservations.load_inventory(dapr, sharded))
+    return records, operations
+
+
+def remove_product(dapr, product_id):
+    """Delete a product's record and close its ledger; also repairs a product whose ledger has a gap"""
+    def closing(record):
+        if "ledger" not in record:
+            return []
+        return _closing(product_id, record, _pending_changes(dapr, {product_id: record})[product_id])[1]
+
+    return reservations.remove_product(dapr, product_id, closing)
+
+
+def _loaded(views):
+    """{product_id: record} with pending changes applied, and the products whose stock is still sharded"""
+    records = {product_id: view.current() for product_id, view in views.items()}
+    return records, [product_id for product_id, record in records.items() if reservations.shard_count(record)]
+
+
+def load_inventory(dapr, product_ids):
+    """Ledger version of reservations.load_inventory: snapshots with their pending changes applied"""
+    records, sharded = _loaded(read_views(dapr, product_ids)[0])
+    if sharded:
+        records.update(reservations.load_inventory(dapr, sharded))
+    return records
+
+
+async def load_inventory_async(dapr, product_ids):
+    """Coroutine version of load_inventory for an AsyncDaprClient"""
+    records, sharded = _loaded((await read_views_async(dapr, product_ids))[0])
+    if sharded:
+        records.update(await reservations.load_inventory_async(dapr, sharded))
+    return records
+
+
+def compact(dapr, product_ids):
+    """Fold the pending changes of products into their snapshots.
+
+    Records written in state mode are adopted on the way. Returns (products
+    compacted, changes folded). A product written concurrently by another
+    compaction is skipped until the next pass, and one whose ledger has a
+    gap is logged and skipped.
+    """
+    try:
+        views = read_views(dapr, product_ids)[0]
+    except LedgerGapError as e:
+        logger.error(f"Not compacting {e.product_id}: {e}")
+        others = [product_id for product_id in product_ids if product_id != e.product_id]
+        return compact(dapr, others) if others else (0, 0)
+    _adopt(dapr, views)
+    compacted = folded = 0
+    for view in views.values():
+        if not view.adopted or not view.pending:
+            continue
+        try:
+            dapr.transact_state(view.fold())
+        except EtagMismatchError:
+            continue
+        compacted += 1
+        folded += len(view.pending)
+    return compacted, folded
+
+
+def history(dapr, product_id, limit=100, before=None):
+    """A page of a product's ledger changes, newest first.
+
+    before is the seq the page ends below (the next_before of the previous
+    page). Returns None if the product has no ledger. Changes that have
+    expired are missing from the page.
+    """
+    view = read_views(dapr, [product_id])[0].get(product_id)
+    if view is None or "ledger" not in view.record:
+        return None
+    epoch = view.record["ledger"]["epoch"]
+    end = min(view.head, before - 1) if before else view.head
+    start = max(1, end - limit + 1)
+    keys = [change_key(product_id, epoch, seq) for seq in range(end, start - 1, -1)]
+    found = dapr.get_bulk_state(keys) if keys else {}
+    return {
+        "product_id": product_id,
+        "epoch": epoch,
+        "base": view.record["ledger"]["base"],
+        "snapshot_seq": view.record["ledger"]["seq"],
+        "head": view.head,
+        "changes": [found[key] for key in keys if key in found],
+        "next_before": start if start > 1 else None,
+    }
+
+
+def rebuild(dapr, product_id):
+    """Recompute a product's snapshot by replaying its whole ledger from its base.
+
+    Returns (the record before, the rebuilt record), or None if the product
+    has no ledger. Raises LedgerGapError if some of its changes have
+    expired, and reservations.ReservationConflictError if the snapshot was rewritten
+    while replaying.
+    """
+    view = read_views(dapr, [product_id])[0].get(product_id)
+    if view is None or "ledger" not in view.record:
+        return None
+    ledger = view.record["ledger"]
+    keys = [change_key(product_id, ledger["epoch"], seq) for seq in range(1, view.head + 1)]
+    found = {}
+    for start in range(0, len(keys), REPLAY_BATCH_SIZE):
+        found.update(dapr.get_bulk_state(keys[start:start + REPLAY_BATCH_SIZE]))
+    missing = [key for key in keys if key not in found]
+    if missing:
+        raise LedgerGapError(product_id, f"{len(missing)} of the {len(keys)} changes of {product_id} have expired, from {missing[0]}")
+
+    replayed = LedgerView(
+        product_id,
+        dict(view.record, quantity=ledger["base"], ledger=dict(ledger, seq=0)),
+        view.etag,
+        [found[key] for key in keys]
+    )
+    rebuilt = replayed.snapshot()
+    try:
+        dapr.transact_state([upsert_operation(f"inventory:{product_id}", rebuilt, view.etag)])
+    except EtagMismatchError:
+        raise reservations.ReservationConflictError(f"Snapshot of {product_id} changed while its ledger was replayed")
+    if rebuilt["quantity"] != view.current()["quantity"]:
+        logger.warning(
+            "Rebuilt %s from its ledger: quantity %s, snapshot said %s",
+            product_id, rebuilt["quantity"], view.current()["quantity"], extra={"product_id": product_id}
+        )
+    return view.current(), rebuilt
+
+
+class LedgerCompactor:
+    """Background thread that folds pending ledger changes into the product snapshots.
+
+    Products that collect COMPACT_THRESHOLD pending changes in this process
+    are compacted right away. Every interval seconds all products are
+    checked, batch_size per bulk read, which also folds the changes other
+    replicas left behind.
+    """
+
+    def __init__(self, dapr, interval, batch_size):
+        self.dapr = dapr
+        self.interval = interval
+        self.batch_size = batch_size
+        self.passes = 0
+        self.compacted = 0
+        self.folded = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the thread in this process if it is not running yet (also after a fork)"""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="ledger-compactor", daemon=True).start()
+
+    def compact(self, product_ids):
+        compacted, folded = compact(self.dapr, product_ids)
+        self.compacted += compacted
+        self.folded += folded
+        return folded
+
+    def compact_due(self):
+        """Compact the products marked due in this process; returns how many changes were folded"""
+        with _due_lock:
+            due = sorted(_due)
+            _due.clear()
+        return self.compact(due) if due else 0
+
+    def run_once(self):
+        """Compact every product once; returns how many changes were folded"""
+        product_ids = sorted(reservations.product_index.read(self.dapr))
+        folded = sum(self.compact(product_ids[start:start + self.batch_size])
+                     for start in range(0, len(product_ids), self.batch_size))
+        self.passes += 1
+        return folded
+
+    def _run(self):
+        next_pass = time.monotonic() + self.interval
+        while True:
+            _wakeup.wait(max(0.0, next_pass - time.monotonic()))
+            _wakeup.clear()
+            try:
+                self.compact_due()
+                if time.monotonic() >= next_pass:
+                    next_pass = time.monotonic() + self.interval
+                    self.run_once()
+            except Exception as e:
+                logger.error(f"Ledger compaction failed: {e}")
+
+    def stats(self):
+        with _due_lock:
+            due = len(_due)
+        return {
+            "retention_seconds": LEDGER_RETENTION_SECONDS,
+            "compact_threshold": COMPACT_THRESHOLD,
+            "compaction_passes": self.passes,
+            "products_compacted": self.compacted,
+            "changes_folded": self.folded,
+            "products_due": due,
+        }
@@ -0,0 +1,997 @@
+"""Optimistic-concurrency inventory reservations.
+
+Stock is decremented with a read-modify-write guarded by the ETags returned
+from the state store. The inventory updates and the reservation records for
+one request are committed together through the Dapr state transaction API
+with first-write-wins concurrency, so two workers reserving the same product
+cannot both succeed against the same stock level. A conflicting write is
+retried a bounded number of times with jittered backoff.
+
+The same transactions maintain the key indexes: a partitioned index of
+product IDs for listing and clearing inventory, and per order an index of
+the products it holds reservations on. Only that order's own writes touch
+its index, and committing or releasing the reservations removes them from
+it, so the index never outgrows the order.
+
+Hot products can be switched to sharded stock: their quantity is split
+across several inventory-shard records, a reservation takes stock from one
+randomly chosen shard that can cover it, and readers sum the shards. Orders
+for the same product then only conflict when they pick the same shard. The
+product record itself keeps the name, price and shard count, and is not
+rewritten by reservations. Shards drift apart as they are drawn down, so
+they are periodically rebalanced. Releasing a reservation puts its stock
+back into the shards it was drawn from.
+
+Event-driven reservations are idempotent per order: the transaction also
+writes an expiring reservation-result marker holding the outcome, and a
+redelivered order event finds the marker and gets the recorded outcome back
+instead of reserving the stock a second time.
+
+Reservations are holds that expire: each one gets an expires_at, is written
+with a state-store TTL, and is tracked in an expiry index, all in the
+reservation transaction. The expiry index is bucketed by expires_at, and
+each bucket document belongs to one product (or one stock shard), so holds
+on different products never share a document. A per-bucket directory lists
+the documents and is only written when one is created. Committing and
+releasing leave the index alone, so a bucket stops changing once its window
+has passed. A ReservationSweeper walks the buckets that have fully expired,
+releases the holds in them that are still due back into stock in batched
+transactions, then deletes the buckets. Each release writes an
+inventory_released event to the service's outbox in the same transaction.
+Committing an order's reservations clears their expiry and TTL.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from common.dapr_client import EtagMismatchError, delete_operation, upsert_operation
+from common.idempotency import DEDUP_WINDOW_SECONDS
+from common.state_index import (
+    BucketedIndex, StateIndex, index_keys, index_operations, registrations, transact_with_indexes
+)
+
+MAX_RETRIES = int(os.getenv("RESERVATION_MAX_RETRIES", "5"))
+RETRY_BACKOFF = float(os.getenv("RESERVATION_RETRY_BACKOFF", "0.01"))
+INDEX_PARTITIONS = int(os.getenv("INVENTORY_INDEX_PARTITIONS", "16"))
+
+# Reservations are released after RESERVATION_TTL_SECONDS unless committed
+# (0 keeps them until released). The state store drops a reservation record
+# RESERVATION_TTL_GRACE_SECONDS later still, in case it was never swept.
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "1800"))
+RESERVATION_TTL_GRACE_SECONDS = int(os.getenv("RESERVATION_TTL_GRACE_SECONDS", "86400"))
+EXPIRY_BUCKET_SECONDS = int(os.getenv("RESERVATION_EXPIRY_BUCKET_SECONDS", "60"))
+
+# Each expiry bucket's directory is split by expiry index name, so products
+# that start a bucket at the same time rarely write the same document
+EXPIRY_DIRECTORY_PARTITIONS = int(os.getenv("RESERVATION_EXPIRY_DIRECTORY_PARTITIONS", "32"))
+
+# Expiry buckets read per bulk read while sweeping, and swept per pass at most
+SWEEP_BUCKETS_PER_READ = 16
+MAX_SWEEP_BUCKETS = 360
+EXPIRY_SWEEP_CURSOR = "inventory-index:reservation-expiry-sweep"
+
+logger = logging.getLogger(__name__)
+
+# Members are product IDs; all share score 0 so listings sort by product ID
+product_index = StateIndex("inventory-index:products", INDEX_PARTITIONS)
+
+# Products whose stock is split into shards, for the rebalancer
+sharded_index = StateIndex("inventory-index:sharded")
+
+
+def reservation_key(order_id, product_id):
+    return f"reservation:{order_id}:{product_id}"
+
+
+def reservation_ids(key):
+    """(order_id, product_id) of a reservation key"""
+    _, order_id, product_id = key.split(":", 2)
+    return order_id, product_id
+
+
+def record_ttl():
+    """State-store TTL of reservation records and the indexes that point at them, None if holds do not expire"""
+    return RESERVATION_TTL_SECONDS + RESERVATION_TTL_GRACE_SECONDS if RESERVATION_TTL_SECONDS > 0 else None
+
+
+def order_index(order_id):
+    """Index of the product IDs an order holds uncommitted reservations on, scored by reserved_at.
+
+    It expires with the order's reservation records.
+    """
+    return StateIndex(f"inventory-index:order-reservations:{order_id}", ttl=record_ttl())
+
+
+class ExpiryIndex(BucketedIndex):
+    """The holds on one product or stock shard, keyed by reservation key and bucketed by expires_at.
+
+    Creating one of its bucket documents lists it in expiry_directory.
+    """
+
+    def __init__(self, name):
+        super().__init__(name, EXPIRY_BUCKET_SECONDS, ttl=record_ttl(), directory=False)
+
+    def register(self, member, score):
+        return [expiry_directory.add(self.name, score)]
+
+
+# Per expiry bucket, the ExpiryIndex names with holds in that bucket
+expiry_directory = BucketedIndex("inventory-index:reservation-expiry-dir", EXPIRY_BUCKET_SECONDS,
+                                 partitions=EXPIRY_DIRECTORY_PARTITIONS, ttl=record_ttl(), directory=False)
+
+
+def expiry_index(product_id, shard=None):
+    """Expiry index of a product's holds; holds on sharded stock are kept per shard drawn from"""
+    name = f"inventory-index:reservation-expiry:{product_id}"
+    return ExpiryIndex(name if shard is None else f"{name}:shard:{shard}")
+
+
+def shard_count(record):
+    """Number of stock shards of a product record, 0 if its stock is not sharded"""
+    return (record or {}).get("shards") or 0
+
+
+def shard_key(product_id, shard):
+    return f"inventory-shard:{product_id}:{shard}"
+
+
+def shard_keys(product_id, record):
+    """State keys of a product's stock shards"""
+    return [shard_key(product_id, shard) for shard in range(shard_count(record))]
+
+
+def hold(reservation):
+    """Give a new reservation its expiry.
+
+    Sets expires_at and returns (the TTL for its record, the expiry index
+    changes), or (None, []) when reservations do not expire. The changes
+    need registrations() for the bucket documents they create.
+    """
+    if RESERVATION_TTL_SECONDS <= 0:
+        return None, []
+    reservation["expires_at"] = expiry_of(reservation["reserved_at"])
+    key = reservation_key(reservation["order_id"], reservation["product_id"])
+    shards = reservation.get("shards")
+    index = expiry_index(reservation["product_id"], min(int(shard) for shard in shards) if shards else None)
+    return record_ttl(), [index.add(key, reservation["expires_at"])]
+
+
+def expiry_of(reserved_at):
+    """expires_at of a hold made at reserved_at"""
+    return (datetime.fromisoformat(reserved_at) + timedelta(seconds=RESERVATION_TTL_SECONDS)).isoformat()
+
+
+def expiry_read_keys(product_ids, reserved_at):
+    """Expiry documents, and their directory, that holds made at reserved_at on these products would update"""
+    if RESERVATION_TTL_SECONDS <= 0:
+        return []
+    return [key for product_id in product_ids for key in _expiry_keys(expiry_index(product_id), reserved_at)]
+
+
+def shard_expiry_read_keys(product_id, record, reserved_at):
+    """Expiry documents that holds made at reserved_at on a product's stock shards would update"""
+    if RESERVATION_TTL_SECONDS <= 0:
+        return []
+    return [
+        key for shard in range(shard_count(record))
+        for key in _expiry_keys(expiry_index(product_id, shard), reserved_at)
+    ]
+
+
+def _expiry_keys(index, reserved_at):
+    """The bucket document of an expiry index a hold made at reserved_at goes to, and its directory document"""
+    expires_at = expiry_of(reserved_at)
+    return [index.document_key(None, expires_at), expiry_directory.document_key(index.name, expires_at)]
+
+
+def split_evenly(total, shards):
+    """Split a quantity into shards parts that differ by at most one"""
+    return [total // shards + (1 if shard < total % shards else 0) for shard in range(shards)]
+
+
+class ReservationConflictError(Exception):
+    """Raised when a reservation keeps losing write races after all retries"""
+
+
+class ReservationStats:
+    """Thread-safe counters describing reservation contention"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.committed = 0
+        self.conflicts = 0
+        self.retries = 0
+        self.exhausted = 0
+        self.conflicts_by_product = {}
+
+    def record(self, attempts=0, committed=0, retries=0, exhausted=0, conflict_products=()):
+        with self._lock:
+            self.attempts += attempts
+            self.committed += committed
+            self.retries += retries
+            self.exhausted += exhausted
+            for product_id in conflict_products:
+                self.conflicts += 1
+                self.conflicts_by_product[product_id] = self.conflicts_by_product.get(product_id, 0) + 1
+
+    def snapshot(self, top=10):
+        with self._lock:
+            hot_products = sorted(self.conflicts_by_product.items(), key=lambda kv: kv[1], reverse=True)[:top]
+            return {
+                "attempts": self.attempts,
+                "committed": self.committed,
+                "conflicts": self.conflicts,
+                "retries": self.retries,
+                "exhausted": self.exhausted,
+                "hot_products": [{"product_id": p, "conflicts": c} for p, c in hot_products],
+            }
+
+
+stats = ReservationStats()
+
+
+def reserve_items(dapr, order_id, items, max_retries=None, idempotent=False):
+    """Reserve stock for the given line items of an order.
+
+    Returns a dict with the per-item inventory_status, all_items_reserved, the
+    committed inventory records and the reservation records, both keyed by
+    product_id. Items with insufficient stock are reported and skipped;
+    everything else is committed atomically. Raises ReservationConflictError
+    if the write keeps conflicting.
+
+    With idempotent set, an order that was already processed is not reserved
+    again: the result has duplicate set, its recorded inventory_status and
+    all_items_reserved, and no records or reservations.
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    product_ids = list(dict.fromkeys(item.get("product_id") for item in items))
+    keys = {product_id: f"inventory:{product_id}" for product_id in product_ids}
+
+    read_keys = list(keys.values()) + [order_index(order_id).name]
+    if idempotent:
+        read_keys.append(result_key(order_id))
+
+    for attempt in range(max_retries + 1):
+        # Holds are bucketed by expiry, so every attempt reads the buckets of its own reserved_at
+        reserved_at = datetime.utcnow().isoformat()
+        entries = dapr.get_bulk_state_with_etags(read_keys + expiry_read_keys(product_ids, reserved_at))
+        entries.update(dapr.get_bulk_state_with_etags(_shard_read_keys(keys, entries, reserved_at)))
+        result, operations = _prepare(order_id, items, keys, entries, reserved_at, idempotent)
+        if not operations:
+            stats.record(attempts=1)
+            return result
+
+        try:
+            dapr.transact_state(operations)
+        except EtagMismatchError:
+            _record_conflict(attempt, max_retries, result)
+            if attempt < max_retries:
+                time.sleep(_backoff(attempt))
+            continue
+
+        stats.record(attempts=1, committed=1)
+        return result
+
+    stats.record(exhausted=1)
+    raise ReservationConflictError(f"Reservation for order {order_id} conflicted {max_retries + 1} times")
+
+
+async def reserve_items_async(dapr, order_id, items, max_retries=None, idempotent=False):
+    """Coroutine version of reserve_items for an AsyncDaprClient"""
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    product_ids = list(dict.fromkeys(item.get("product_id") for item in items))
+    keys = {product_id: f"inventory:{product_id}" for product_id in product_ids}
+
+    read_keys = list(keys.values()) + [order_index(order_id).name]
+    if idempotent:
+        read_keys.append(result_key(order_id))
+
+    for attempt in range(max_retries + 1):
+        # Holds are bucketed by expiry, so every attempt reads the buckets of its own reserved_at
+        reserved_at = datetime.utcnow().isoformat()
+        entries = await dapr.get_bulk_state_with_etags(read_keys + expiry_read_keys(product_ids, reserved_at))
+        entries.update(await dapr.get_bulk_state_with_etags(_shard_read_keys(keys, entries, reserved_at)))
+        result, operations = _prepare(order_id, items, keys, entries, reserved_at, idempotent)
+        if not operations:
+            stats.record(attempts=1)
+            return result
+
+        try:
+            await dapr.transact_state(operations)
+        except EtagMismatchError:
+            _record_conflict(attempt, max_retries, result)
+            if attempt < max_retries:
+                await asyncio.sleep(_backoff(attempt))
+            continue
+
+        stats.record(attempts=1, committed=1)
+        return result
+
+    stats.record(exhausted=1)
+    raise ReservationConflictError(f"Reservation for order {order_id} conflicted {max_retries + 1} times")
+
+
+def result_key(order_id, product_id=None):
+    """State key of the marker recording the outcome of an order's reservation, or of its part on one product"""
+    if product_id is None:
+        return f"reservation-result:{order_id}"
+    return f"reservation-result:{order_id}:{product_id}"
+
+
+def recorded_result(recorded):
+    """reserve_items result for an order whose outcome was recorded by an earlier delivery"""
+    return {
+        "inventory_status": recorded["inventory_status"],
+        "all_items_reserved": recorded["all_items_reserved"],
+        "records": {},
+        "reservations": {},
+        "duplicate": True,
+    }
+
+
+def result_marker(order_id, inventory_status, all_items_reserved, product_id=None):
+    """Write recording an order's outcome; fails with an ETag conflict if a concurrent delivery got there first"""
+    return upsert_operation(
+        result_key(order_id, product_id),
+        {"inventory_status": inventory_status, "all_items_reserved": all_items_reserved},
+        first_write=True,
+        ttl=DEDUP_WINDOW_SECONDS
+    )
+
+
+def _prepare(order_id, items, keys, entries, reserved_at, idempotent=False):
+    """Plan a reservation made at reserved_at against freshly read entries and build its transaction"""
+    if idempotent and result_key(order_id) in entries:
+        return recorded_result(entries[result_key(order_id)][0]), []
+
+    records = {product_id: entries[key][0] for product_id, key in keys.items() if key in entries}
+    etags = {product_id: entries[key][1] for product_id, key in keys.items() if key in entries}
+    shards = {
+        product_id: [entries.get(key, ({"quantity": 0}, None)) for key in shard_keys(product_id, record)]
+        for product_id, record in records.items() if shard_count(record)
+    }
+    for product_id, product_shards in shards.items():
+        records[product_id]["quantity"] = sum(value["quantity"] for value, _ in product_shards)
+
+    inventory_status, all_items_reserved, reservations = plan_items(order_id, items, records, reserved_at)
+    result = {
+        "inventory_status": inventory_status,
+        "all_items_reserved": all_items_reserved,
+        "records": records,
+        "reservations": reservations,
+        "duplicate": False,
+    }
+
+    operations = [result_marker(order_id, inventory_status, all_items_reserved)] if idempotent else []
+    index_changes = []
+    for product_id, reservation in reservations.items():
+        if product_id in shards:
+            # Draw down the chosen shards only; the product record is left alone
+            reservation["shards"] = _allocate(shards[product_id], reservation["quantity"])
+            for shard, quantity in reservation["shards"].items():
+                value, etag = shards[product_id][shard]
+                operations.append(upsert_operation(
+                    shard_key(product_id, shard),
+                    {"quantity": value["quantity"] - quantity, "last_updated": reservation["reserved_at"]},
+                    etag
+                ))
+        else:
+            operations.append(upsert_operation(keys[product_id], records[product_id], etags[product_id]))
+        index_changes.append(order_index(order_id).add(product_id, reservation["reserved_at"]))
+        ttl, expiry_changes = hold(reservation)
+        operations.append(upsert_operation(reservation_key(order_id, product_id), reservation, ttl=ttl))
+        index_changes.extend(expiry_changes)
+    index_changes.extend(registrations(index_changes, entries))
+    return result, operations + index_operations(index_changes, entries)
+
+
+def _shard_read_keys(keys, entries, reserved_at=None):
+    """Shard keys to read for the sharded products among entries, and the per-shard expiry keys of holds made at reserved_at"""
+    read_keys = []
+    for product_id, key in keys.items():
+        record = entries.get(key, (None, None))[0]
+        if shard_count(record):
+            read_keys.extend(shard_keys(product_id, record))
+            if reserved_at is not None:
+                read_keys.extend(shard_expiry_read_keys(product_id, record, reserved_at))
+    return read_keys
+
+
+def _allocate(product_shards, quantity):
+    """Pick the shards to take quantity from: one random shard that covers it, else the fullest ones"""
+    covering = [shard for shard, (value, _) in enumerate(product_shards) if value["quantity"] >= quantity]
+    if covering:
+        return {random.choice(covering): quantity}
+    allocation = {}
+    for shard in sorted(range(len(product_shards)), key=lambda s: product_shards[s][0]["quantity"], reverse=True):
+        take = min(quantity, product_shards[shard][0]["quantity"])
+        if take > 0:
+            allocation[shard] = take
+            quantity -= take
+        if quantity == 0:
+            break
+    return allocation
+
+
+def _record_conflict(attempt, max_retries, result):
+    stats.record(attempts=1, retries=1 if attempt < max_retries else 0,
+                 conflict_products=list(result["reservations"]))
+
+
+def _backoff(attempt):
+    return RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def add_stock(dapr, product_id, quantity, name=None, price=None, max_retries=None):
+    """Add quantity to a product's stock with the same ETag guard as reservations.
+
+    Returns the committed inventory record. Raises ReservationConflictError if
+    the write keeps conflicting.
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    key = f"inventory:{product_id}"
+    index_changes = [product_index.add(product_id, 0)]
+
+    for attempt in range(max_retries + 1):
+        entries = dapr.get_bulk_state_with_etags([key] + index_keys(index_changes))
+        current, etag = entries.get(key, (None, None))
+        inventory_item = {
+            "product_id": product_id,
+            "quantity": (current["quantity"] if current else 0) + quantity,
+            "last_updated": datetime.utcnow().isoformat(),
+            "name": name if name is not None else f"Product {product_id}",
+            "price": price if price is not None else 0.0
+        }
+        stored_item = inventory_item
+        shard_operations = []
+
+        if shard_count(current):
+            # New stock goes to the emptiest shard; the rebalancer spreads it out
+            inventory_item["shards"] = current["shards"]
+            levels = _read_shards(dapr, product_id, current)
+            target = min(range(len(levels)), key=lambda shard: levels[shard][0]["quantity"])
+            shard_operations.append(upsert_operation(
+                shard_key(product_id, target),
+                {"quantity": levels[target][0]["quantity"] + quantity, "last_updated": inventory_item["last_updated"]},
+                levels[target][1],
+                first_write=True
+            ))
+            inventory_item["quantity"] = sum(value["quantity"] for value, _ in levels) + quantity
+            stored_item = dict(inventory_item, quantity=0)
+
+        try:
+            dapr.transact_state(
+                [upsert_operation(key, stored_item, etag, first_write=True)]
+                + shard_operations
+                + index_operations(index_changes, entries)
+            )
+        except EtagMismatchError:
+            stats.record(attempts=1, retries=1 if attempt < max_retries else 0,
+                         conflict_products=[product_id])
+            if attempt < max_retries:
+                time.sleep(_backoff(attempt))
+            continue
+
+        stats.record(attempts=1, committed=1)
+        return inventory_item
+
+    stats.record(exhausted=1)
+    raise ReservationConflictError(f"Stock update for {product_id} conflicted {max_retries + 1} times")
+
+
+def releasable(reservation, reason, now):
+    """True if a reservation may be released; expiry only releases holds that are still past due"""
+    if reason != "expired":
+        return True
+    return bool(reservation.get("expires_at")) and reservation["expires_at"] <= now
+
+
+def release_event(reservation, reason):
+    """Build the inventory_released event written when a reservation's stock is returned"""
+    return {
+        "event_id": f"inventory_released:{reservation['order_id']}:{reservation['product_id']}:{reservation['reserved_at']}",
+        "order_id": reservation["order_id"],
+        "product_id": reservation["product_id"],
+        "quantity": reservation["quantity"],
+        "reason": reason,
+        "released_at": datetime.utcnow().isoformat(),
+        "event_type": "inventory_released"
+    }
+
+
+def plan_release(found, reservation_keys, reason, outbox=None):
+    """Work out which of the reservations read with their ETags to release.
+
+    Returns (held reservations by key, {product_id: [held reservation]}, the
+    operations deleting them and writing their outbox records, the index
+    changes, the outbox records). Index entries whose reservation is
+    already gone are dropped as well.
+    """
+    now = datetime.utcnow().isoformat()
+    held = {key: value for key, (value, _) in found.items() if releasable(value, reason, now)}
+    by_product = {}
+    for reservation in held.values():
+        by_product.setdefault(reservation["product_id"], []).append(reservation)
+
+    operations = [delete_operation(key, found[key][1]) for key in held]
+    index_changes = forget_changes([key for key in reservation_keys if key in held or key not in found])
+    outbox_records = [outbox.record("inventory-events", release_event(value, reason)) for value in held.values()] if outbox else []
+    for record in outbox_records:
+        outbox_operations, outbox_index_changes = outbox.add(record)
+        operations.extend(outbox_operations)
+        index_changes.extend(outbox_index_changes)
+    return held, by_product, operations, index_changes, outbox_records
+
+
+def release_reservations(dapr, reservation_keys, reason, outbox=None, max_retries=None):
+    """Return the stock of several reservations and delete them in one transaction.
+
+    Stock drawn from shards goes back to the same shards, or to the emptiest
+    one if the product was resharded since. With reason "expired", only holds
+    that are still past their expiry are released. With an outbox, an
+    inventory_released event per reservation is written in the same
+    transaction. Returns (released reservations, {product_id: updated
+    record}); products deleted in the meantime have no record. Raises
+    ReservationConflictError if the write keeps conflicting.
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+
+    for attempt in range(max_retries + 1):
+        found = dapr.get_bulk_state_with_etags(reservation_keys)
+        held, by_product, operations, index_changes, outbox_records = plan_release(
+            found, reservation_keys, reason, outbox
+        )
+        if not operations and not index_changes:
+            return [], {}
+        keys = {product_id: f"inventory:{product_id}" for product_id in by_product}
+
+        entries = dapr.get_bulk_state_with_etags(list(keys.values()) + index_keys(index_changes))
+        entries.update(dapr.get_bulk_state_with_etags(_shard_read_keys(keys, entries)))
+        records = {}
+        for product_id, product_reservations in by_product.items():
+            record, restock_operations = _restock(product_id, entries, product_reservations)
+            operations.extend(restock_operations)
+            if record is not None:
+                records[product_id] = record
+
+        try:
+            dapr.transact_state(operations + index_operations(index_changes, entries))
+        except EtagMismatchError:
+            stats.record(attempts=1, retries=1 if attempt < max_retries else 0, conflict_products=list(by_product))
+            if attempt < max_retries:
+                time.sleep(_backoff(attempt))
+            continue
+
+        stats.record(attempts=1, committed=1)
+        if outbox_records:
+            outbox.notify(outbox_records)
+        return list(held.values()), records
+
+    stats.record(exhausted=1)
+    raise ReservationConflictError(f"Release of {len(reservation_keys)} reservations conflicted {max_retries + 1} times")
+
+
+def _restock(product_id, entries, held):
+    """Writes putting held reservations' stock back; returns (updated record or None, operations)"""
+    key = f"inventory:{product_id}"
+    if key not in entries:
+        return None, []
+    record, etag = entries[key]
+    quantity = sum(reservation["quantity"] for reservation in held)
+    now = datetime.utcnow().isoformat()
+    if not shard_count(record):
+        record = dict(record, quantity=record["quantity"] + quantity, last_updated=now)
+        return record, [upsert_operation(key, record, etag)]
+
+    levels = [entries.get(k, ({"quantity": 0}, None)) for k in shard_keys(product_id, record)]
+    returned = {}
+    leftover = 0
+    for reservation in held:
+        # JSON turns the shard numbers of the reservation's allocation into strings
+        allocation = {int(shard): taken for shard, taken in (reservation.get("shards") or {}).items()
+                      if int(shard) < len(levels)}
+        for shard, taken in allocation.items():
+            returned[shard] = returned.get(shard, 0) + taken
+        leftover += reservation["quantity"] - sum(allocation.values())
+    if leftover > 0:
+        emptiest = min(range(len(levels)), key=lambda shard: levels[shard][0]["quantity"])
+        returned[emptiest] = returned.get(emptiest, 0) + leftover
+
+    operations = [
+        upsert_operation(shard_key(product_id, shard),
+                         {"quantity": levels[shard][0]["quantity"] + taken, "last_updated": now},
+                         levels[shard][1], first_write=True)
+        for shard, taken in returned.items()
+    ]
+    total = sum(value["quantity"] for value, _ in levels) + quantity
+    return dict(record, quantity=total), operations
+
+
+def expiry_cursor(dapr):
+    """(the first expiry bucket not swept yet, the sweep cursor's ETag)"""
+    cursor, etag = dapr.get_state_with_etag(EXPIRY_SWEEP_CURSOR)
+    if cursor:
+        return cursor["next_bucket"], etag
+    # Nothing swept yet: start from the oldest bucket whose records may still be stored
+    return expiry_directory.bucket(time.time() - RESERVATION_TTL_SECONDS - RESERVATION_TTL_GRACE_SECONDS), None
+
+
+def read_expiry_buckets(dapr, buckets):
+    """Return (the keys of the holds expiring in buckets, the state keys of their expiry and directory documents)"""
+    directory = dapr.get_bulk_state([key for bucket in buckets for key in expiry_directory.bucket_keys(bucket)])
+    document_keys = sorted({
+        ExpiryIndex(name).document_key(name, score)
+        for document in directory.values() for name, score in document.items()
+    })
+    documents = dapr.get_bulk_state(document_keys) if document_keys else {}
+    holds = sorted({key for document in documents.values() for key in document})
+    return holds, list(directory) + list(documents)
+
+
+def held_reservations(dapr):
+    """Return (the keys of every hold not swept yet, the state keys of the expiry documents listing them)"""
+    first, _ = expiry_cursor(dapr)
+    last = expiry_directory.bucket(time.time() + RESERVATION_TTL_SECONDS)
+    holds, documents = [], []
+    for start in range(first, last + 1, SWEEP_BUCKETS_PER_READ):
+        buckets = range(start, min(last, start + SWEEP_BUCKETS_PER_READ - 1) + 1)
+        bucket_holds, bucket_documents = read_expiry_buckets(dapr, buckets)
+        holds.extend(bucket_holds)
+        documents.extend(bucket_documents)
+    return sorted(set(holds)), documents
+
+
+def order_reservations(dapr, order_id):
+    """Keys of the reservations an order holds that have not been committed or released yet"""
+    return sorted(reservation_key(order_id, product_id) for product_id in order_index(order_id).read(dapr))
+
+
+def commit_reservations(dapr, reservation_keys):
+    """Keep reservations for good: drop their expiry and their record's TTL. Returns how many were committed"""
+    def prepare():
+        found = dapr.get_bulk_state_with_etags(reservation_keys)
+        operations = []
+        for key, (reservation, etag) in found.items():
+            committed = dict(reservation)
+            committed.pop("expires_at", None)
+            operations.append(upsert_operation(key, committed, etag, ttl=-1))
+        return operations, forget_changes(reservation_keys), len(found)
+
+    return transact_with_indexes(dapr, prepare) or 0
+
+
+def forget_changes(reservation_keys):
+    """Index changes dropping reservations from their order's index.
+
+    Expiry buckets are left alone; the sweeper skips holds that are gone.
+    """
+    changes = []
+    for key in reservation_keys:
+        order_id, product_id = reservation_ids(key)
+        changes.append(order_index(order_id).remove(product_id))
+    return changes
+
+
+def forget_reservations(dapr, reservation_keys):
+    """Drop the index entries of reservations that no longer exist"""
+    transact_with_indexes(dapr, lambda: ([], forget_changes(reservation_keys), None))
+
+
+def remove_product(dapr, product_id, extra_operations=None):
+    """Delete a product's inventory record and drop it from the product index.
+
+    extra_operations(record) returns more writes for the same transaction.
+    Returns False if the product does not exist.
+    """
+    key = f"inventory:{product_id}"
+
+    def prepare():
+        current, etag = dapr.get_state_with_etag(key)
+        if current is None:
+            return None
+        operations = [delete_operation(key, etag)] + [delete_operation(k) for k in shard_keys(product_id, current)]
+        if extra_operations is not None:
+            operations.extend(extra_operations(current))
+        index_changes = [product_index.remove(product_id)]
+        if shard_count(current):
+            index_changes.append(sharded_index.remove(product_id))
+        return operations, index_changes, True
+
+    return transact_with_indexes(dapr, prepare) is True
+
+
+def _read_shards(dapr, product_id, record):
+    """Return [(value, etag)] for each stock shard of a product; missing shards hold nothing"""
+    entries = dapr.get_bulk_state_with_etags(shard_keys(product_id, record))
+    return [entries.get(shard_key(product_id, shard), ({"quantity": 0}, None))
+            for shard in range(shard_count(record))]
+
+
+def load_inventory(dapr, product_ids):
+    """Return {product_id: record} for existing products, with sharded stock summed into quantity"""
+    keys = [f"inventory:{product_id}" for product_id in product_ids]
+    found = dapr.get_bulk_state(keys)
+    records = {product_id: found[key] for product_id, key in zip(product_ids, keys) if key in found}
+    shards = dapr.get_bulk_state([k for product_id, record in records.items() for k in shard_keys(product_id, record)])
+    return _sum_shards(records, shards)
+
+
+async def load_inventory_async(dapr, product_ids):
+    """Coroutine version of load_inventory for an AsyncDaprClient"""
+    keys = [f"inventory:{product_id}" for product_id in product_ids]
+    found = await dapr.get_bulk_state(keys)
+    records = {product_id: found[key] for product_id, key in zip(product_ids, keys) if key in found}
+    shards = await dapr.get_bulk_state([k for product_id, record in records.items() for k in shard_keys(product_id, record)])
+    return _sum_shards(records, shards)
+
+
+def _sum_shards(records, shards):
+    for product_id, record in records.items():
+        if shard_count(record):
+            record["quantity"] = sum(shards.get(key, {}).get("quantity", 0) for key in shard_keys(product_id, record))
+    return records
+
+
+def set_shards(dapr, product_id, shards):
+    """Split a product's stock across shards records, or merge it back with shards=0.
+
+    Existing stock is redistributed evenly. Returns the updated record (with
+    the summed quantity), or None if the product does not exist.
+    """
+    key = f"inventory:{product_id}"
+
+    def prepare():
+        current, etag = dapr.get_state_with_etag(key)
+        if current is None:
+            return None
+        entries = dapr.get_bulk_state_with_etags(shard_keys(product_id, current))
+        total = (sum(entries.get(k, ({"quantity": 0}, None))[0]["quantity"] for k in shard_keys(product_id, current))
+                 if shard_count(current) else current["quantity"])
+
+        record = dict(current, last_updated=datetime.utcnow().isoformat())
+        record.pop("shards", None)
+        if shards:
+            record["shards"] = shards
+        operations = [upsert_operation(key, dict(record, quantity=0 if shards else total), etag)]
+
+        # Rewrite the shard records
+        old_shards = shard_keys(product_id, current)
+        new_shards = shard_keys(product_id, record)
+        for k, quantity in zip(new_shards, split_evenly(total, shards) if shards else []):
+            operations.append(upsert_operation(
+                k, {"quantity": quantity, "last_updated": record["last_updated"]},
+                entries.get(k, (None, None))[1], first_write=True
+            ))
+        operations.extend(delete_operation(k, entries[k][1]) for k in old_shards[len(new_shards):] if k in entries)
+
+        index_changes = [sharded_index.add(product_id, 0) if shards else sharded_index.remove(product_id)]
+        return operations, index_changes, dict(record, quantity=total)
+
+    return transact_with_indexes(dapr, prepare)
+
+
+def rebalance(dapr, product_id):
+    """Even out a sharded product's stock across its shards.
+
+    Returns True if the shards were rewritten; a concurrent reservation makes
+    the attempt a no-op, to be retried on the next pass.
+    """
+    record = dapr.get_state(f"inventory:{product_id}")
+    if not shard_count(record):
+        return False
+    levels = _read_shards(dapr, product_id, record)
+    quantities = [value["quantity"] for value, _ in levels]
+    if max(quantities) - min(quantities) <= 1:
+        return False
+
+    now = datetime.utcnow().isoformat()
+    operations = [
+        upsert_operation(shard_key(product_id, shard), {"quantity": quantity, "last_updated": now},
+                         levels[shard][1], first_write=True)
+        for shard, quantity in enumerate(split_evenly(sum(quantities), len(levels)))
+        if quantity != quantities[shard]
+    ]
+    try:
+        dapr.transact_state(operations)
+    except EtagMismatchError:
+        return False
+    return True
+
+
+def plan_items(order_id, items, records, reserved_at=None):
+    """Apply the line items to the fetched records in memory.
+
+    Returns (inventory_status, all_items_reserved, reservations); records
+    are updated in place. reserved_at defaults to now.
+    """
+    reserved_at = reserved_at or datetime.utcnow().isoformat()
+    inventory_status = []
+    all_items_reserved = True
+    reservations = {}
+
+    for item in items:
+        product_id = item.get("product_id")
+        quantity = item.get("quantity", 1)
+        inventory_item = records.get(product_id)
+
+        if inventory_item and inventory_item["quantity"] >= quantity:
+            # Reserve inventory by reducing the quantity
+            inventory_item["quantity"] -= quantity
+            inventory_item["last_updated"] = reserved_at
+
+            # Create (or extend, for repeated line items) the reservation record
+            reservation = reservations.setdefault(product_id, {
+                "product_id": product_id,
+                "order_id": order_id,
+                "quantity": 0,
+                "reserved_at": reserved_at
+            })
+            reservation["quantity"] += quantity
+
+            inventory_status.append({
+                "product_id": product_id,
+                "status": "reserved",
+                "reserved_quantity": quantity,
+                "remaining_quantity": inventory_item["quantity"]
+            })
+        else:
+            inventory_status.append({
+                "product_id": product_id,
+                "status": "insufficient",
+                "available_quantity": inventory_item["quantity"] if inventory_item else 0
+            })
+            all_items_reserved = False
+
+    return inventory_status, all_items_reserved, reservations
+
+
+class ReservationSweeper:
+    """Background thread that releases expired reservations in batches.
+
+    Each pass takes the expiry buckets whose window has passed, from the
+    sweep cursor on, releases their holds that are still due, then deletes
+    the buckets and advances the cursor in one ETag-guarded transaction.
+    release(reservation_keys, reason) returns (released reservations,
+    records), like release_reservations. Several replicas may sweep at once;
+    only one of them releases a given hold.
+    """
+
+    def __init__(self, dapr, release, interval, batch_size):
+        self.dapr = dapr
+        self.release = release
+        self.interval = interval
+        self.batch_size = batch_size
+        self.passes = 0
+        self.released = 0
+        self.failed_batches = 0
+        self.buckets_swept = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the thread in this process if it is not running yet (also after a fork)"""
+        if self.interval <= 0 or RESERVATION_TTL_SECONDS <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="reservation-sweeper", daemon=True).start()
+
+    def run_once(self):
+        """Release the holds of the fully expired buckets, batch_size per transaction; returns how many were released"""
+        first, etag = expiry_cursor(self.dapr)
+        last = min(expiry_directory.bucket(time.time()) - 1, first + MAX_SWEEP_BUCKETS - 1)
+        cursor = done = first
+        released = 0
+        for start in range(first, last + 1, SWEEP_BUCKETS_PER_READ):
+            buckets = range(start, min(last, start + SWEEP_BUCKETS_PER_READ - 1) + 1)
+            keys, documents = read_expiry_buckets(self.dapr, buckets)
+            if documents:
+                count, complete = self._release(keys)
+                released += count
+                if not complete:
+                    # The buckets stay for the next pass, which skips the holds already released
+                    break
+                moved, etag = self._advance(buckets[-1] + 1, etag, documents)
+                if not moved:
+                    break
+                cursor = buckets[-1] + 1
+            done = buckets[-1] + 1
+        if done > cursor:
+            # Empty buckets only move the cursor, once per pass
+            moved, _ = self._advance(done, etag, [])
+            if moved:
+                cursor = done
+        self.passes += 1
+        self.released += released
+        self.buckets_swept += cursor - first
+        return released
+
+    def _release(self, keys):
+        """Release expired holds in batches; returns (how many were released, whether every batch went through)"""
+        released = 0
+        complete = True
+        for start in range(0, len(keys), self.batch_size):
+            try:
+                released += len(self.release(keys[start:start + self.batch_size], "expired")[0])
+            except ReservationConflictError as e:
+                complete = False
+                self.failed_batches += 1
+                logger.warning(f"Releasing expired reservations gave up after conflicts: {e}")
+        return released, complete
+
+    def _advance(self, next_bucket, etag, documents):
+        """Delete swept expiry documents and move the cursor.
+
+        Returns (False, None) if another replica moved the cursor first,
+        else (True, the cursor's new ETag, or None if it has moved on since).
+        """
+        operations = [delete_operation(key) for key in documents]
+        operations.append(upsert_operation(EXPIRY_SWEEP_CURSOR, {"next_bucket": next_bucket}, etag, first_write=True))
+        try:
+            self.dapr.transact_state(operations)
+        except EtagMismatchError:
+            return False, None
+        cursor, etag = self.dapr.get_state_with_etag(EXPIRY_SWEEP_CURSOR)
+        return True, etag if cursor and cursor["next_bucket"] == next_bucket else None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Reservation sweep failed: {e}")
+
+    def stats(self):
+        return {
+            "ttl_seconds": RESERVATION_TTL_SECONDS,
+            "sweeps": self.passes,
+            "expired_released": self.released,
+            "failed_batches": self.failed_batches,
+            "buckets_swept": self.buckets_swept,
+        }
+
+
+class ShardRebalancer:
+    """Background thread that periodically evens out the shards of every sharded product"""
+
+    def __init__(self, dapr, interval):
+        self.dapr = dapr
+        self.interval = interval
+        self.passes = 0
+        self.rebalanced = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the thread in this process if it is not running yet (also after a fork)"""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="shard-rebalancer", daemon=True).start()
+
+    def run_once(self):
+        """Rebalance every sharded product once; returns how many were rewritten"""
+        rebalanced = sum(1 for product_id in sharded_index.read(self.dapr) if rebalance(self.dapr, product_id))
+        self.passes += 1
+        self.rebalanced += rebalanced
+        return rebalanced
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Shard rebalancing failed: {e}")
+
+    def stats(self):
+        return {"rebalance_passes": self.passes, "products_rebalanced": self.rebalanced}
@@ -1,33 +1,170 @@
-from flask import Flask, request, jsonify
-import json
-import logging
-import requests
-from datetime import datetime
+from flask import Flask, Response, request, jsonify, stream_with_context
+import os
+from datetime import datetime, timezone
+
+from common import codec, metrics
+from common.dapr_client import DaprClient
+from common.idempotency import IdempotencyGuard, event_key
+from common.pubsub import (
+    DROP,
+    RETRY,
+    SUCCESS,
+    bulk_events,
+    bulk_response,
+    event_payload,
+    is_bulk_delivery,
+    subscription,
+)
+from common.state_index import transact_with_indexes
+from common.structured_logging import configure_logging, log_payload
+from common.write_behind import WriteBehindQueue
+import channels
+from coalescer import HeldStore, NotificationCoalescer, settle
+from delivery import DeliveryPool
+from notification_store import NotificationStore
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+log_handler = configure_logging("notification-service")
+app.json = codec.json_provider(app)
+metrics.instrument_flask(app)
 
 # Dapr sidecar endpoint
-DAPR_HTTP_PORT = 3502
+DAPR_HTTP_PORT = int(os.getenv("DAPR_HTTP_PORT", "3502"))
 DAPR_URL = f"http://localhost:{DAPR_HTTP_PORT}"
 
-# In-memory storage for notifications (in production, use a proper database)
-notifications = []
+# Shared, pooled client for all sidecar calls
+dapr = DaprClient(DAPR_URL)
+
+# Bounded in-memory notification store, indexed by recipient. It is the only
+# copy the listing endpoints read, so the service runs as a single gunicorn
+# worker and scales with threads instead.
+notifications = NotificationStore()
+MAX_WORKERS = 1
+
+# Notifications are persisted write-behind, in batched multi-key saves
+notification_writer = WriteBehindQueue(
+    dapr,
+    max_batch=int(os.getenv("NOTIFICATION_FLUSH_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("NOTIFICATION_FLUSH_INTERVAL", "0.05")),
+    max_pending=int(os.getenv("NOTIFICATION_WRITE_QUEUE_SIZE", "10000")),
+    put_timeout=float(os.getenv("NOTIFICATION_ENQUEUE_TIMEOUT", "1"))
+)
+
+# Events already turned into notifications, so redeliveries do not notify twice
+event_guard = IdempotencyGuard("notification-events")
+
+# An order's confirmation and inventory result are merged into one
+# notification when they arrive within NOTIFICATION_COALESCE_WINDOW seconds
+# of each other (0 sends each on its own). A held notification is saved to
+# the state store before its event is acknowledged; copies left by a process
+# that died holding them are resent NOTIFICATION_HELD_STALE_AFTER seconds on.
+COALESCE_WINDOW = float(os.getenv("NOTIFICATION_COALESCE_WINDOW", "2"))
+held_notifications = HeldStore(
+    dapr,
+    stale_after=COALESCE_WINDOW + float(os.getenv("NOTIFICATION_HELD_STALE_AFTER", "30"))
+)
+coalescer = NotificationCoalescer(
+    lambda notification: create_notification(**notification),
+    window=COALESCE_WINDOW,
+    max_pending=int(os.getenv("NOTIFICATION_COALESCE_MAX_PENDING", "10000")),
+    store=held_notifications,
+    sweep_interval=float(os.getenv("NOTIFICATION_HELD_SWEEP_INTERVAL", "10"))
+)
+
+# Notifications are delivered through NOTIFICATION_CHANNELS by per-channel
+# worker pools, so delivery speed is tuned apart from event intake. Deliveries
+# that keep failing are dead-lettered and published to NOTIFICATION_DEAD_LETTER_TOPIC.
+NOTIFICATION_DEAD_LETTER_TOPIC = os.getenv("NOTIFICATION_DEAD_LETTER_TOPIC", "notification-dead-letters")
+DELIVERY_DRAIN_TIMEOUT = float(os.getenv("NOTIFICATION_DELIVERY_DRAIN_TIMEOUT", "10"))
+
+def record_delivery_status(notification, status):
+    """Record a notification's delivery outcome in the store and the state store"""
+    updated = notifications.set_status(notification["id"], status)
+    persist_notification(updated or dict(notification, status=status))
+
+def publish_dead_letter(entry):
+    """Publish a dead-lettered delivery so it outlives this process"""
+    try:
+        dapr.publish(NOTIFICATION_DEAD_LETTER_TOPIC, entry)
+    except Exception as e:
+        app.logger.error(f"Failed to publish dead letter for notification {entry['notification_id']}: {str(e)}")
+
+delivery = DeliveryPool(
+    channels.configured_channels(),
+    on_status=record_delivery_status,
+    on_dead_letter=publish_dead_letter,
+    max_attempts=int(os.getenv("NOTIFICATION_DELIVERY_MAX_ATTEMPTS", "5")),
+    retry_backoff=float(os.getenv("NOTIFICATION_DELIVERY_RETRY_BACKOFF", "0.5")),
+    queue_size=int(os.getenv("NOTIFICATION_DELIVERY_QUEUE_SIZE", "10000")),
+    dead_letter_size=int(os.getenv("NOTIFICATION_DEAD_LETTER_SIZE", "1000"))
+)
+
+metrics.REGISTRY.register_stats("notification_writer", notification_writer.stats)
+metrics.REGISTRY.register_stats("notification_coalescer", coalescer.stats)
+metrics.REGISTRY.register_stats("notification_delivery", delivery.stats)
+metrics.REGISTRY.register_stats("notification_dedup", event_guard.stats)
+metrics.REGISTRY.register_stats("log_queue", log_handler.stats)
+
+# Page sizes for the notification listing endpoints
+DEFAULT_PAGE_SIZE = int(os.getenv("NOTIFICATION_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("NOTIFICATION_MAX_PAGE_SIZE", "1000"))
+
+@app.before_request
+def start_coalescer():
+    """Start this process's coalescer so that notifications left held by a dead process get resent"""
+    coalescer.start()
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
     return jsonify({"status": "healthy", "service": "notification-service"})
 
+def parse_timestamp(value):
+    """Normalise an ISO-8601 query parameter to the naive UTC format of sent_at"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.isoformat()
+
+def parse_page_args(args):
+    """Parse the pagination and filter query parameters shared by the listing endpoints"""
+    limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    after = args.get("after")
+    return {
+        "limit": limit,
+        "after": int(after) if after else None,
+        "notification_type": args.get("type"),
+        "order_id": args.get("order_id"),
+        "since": parse_timestamp(args["since"]) if args.get("since") else None,
+        "until": parse_timestamp(args["until"]) if args.get("until") else None
+    }
+
+def stream_page(page, next_cursor, total, **fields):
+    """Stream a page of notifications as one JSON document, record by record"""
+    def generate():
+        yield "{"
+        for name, value in fields.items():
+            yield f"{codec.dumps(name).decode()}: {codec.dumps(value).decode()}, "
+        yield '"notifications": ['
+        for index, record in enumerate(page):
+            yield ("," if index else "") + codec.dumps(record.to_dict()).decode()
+        yield f'], "count": {len(page)}, "next_cursor": {codec.dumps(next_cursor).decode()}, "total": {total}}}'
+    
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
 @app.route('/notifications', methods=['GET'])
 def get_notifications():
-    """Get all notifications"""
+    """Get notifications, paginated with limit/after and filterable by type, time range and order_id"""
     try:
-        # In production, you'd implement pagination and filtering
-        return jsonify({
-            "notifications": notifications,
-            "total": len(notifications)
-        })
+        try:
+            page_args = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+        
+        page, next_cursor = notifications.query(**page_args)
+        return stream_page(page, next_cursor, notifications.count())
         
     except Exception as e:
         app.logger.error(f"Error retrieving notifications: {str(e)}")
@@ -44,108 +181,232 @@ def send_notification():
             if field not in notification_data:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
         
-        notification = {
-            "id": len(notifications) + 1,
-            "recipient": notification_data["recipient"],
-            "message": notification_data["message"],
-            "type": notification_data["type"],
-            "sent_at": datetime.utcnow().isoformat(),
-            "status": "sent"
-        }
-        
-        notifications.append(notification)
+        notification = create_notification(
+            notification_data["recipient"],
+            notification_data["message"],
+            notification_data["type"]
+        )
         
-        # Store notification in Dapr state store
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore"
-        state_data = [{"key": f"notification:{notification['id']}", "value": notification}]
-        
-        response = requests.post(state_url, json=state_data)
-        if response.status_code != 204:
-            app.logger.error(f"Failed to save notification: {response.text}")
-        
-        app.logger.info(f"Notification sent to {notification['recipient']}: {notification['message']}")
+        app.logger.info(f"Notification queued for {notification['recipient']}: {notification['message']}")
         return jsonify(notification), 201
         
     except Exception as e:
         app.logger.error(f"Error sending notification: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+def record_notification(recipient, message, notification_type, related_data=None):
+    """Add a notification to the in-memory store, queued for delivery, and return it"""
+    return notifications.add(recipient, message, notification_type, related_data or {}, status="queued")
+
+def persist_notification(notification):
+    """Queue a notification for the state store, saving inline if the queue stays full"""
+    key = f"notification:{notification['id']}"
+    if notification_writer.put(key, notification):
+        return
+    try:
+        dapr.save_state(key, notification)
+    except Exception as e:
+        app.logger.error(f"Failed to save notification to state store: {str(e)}")
+
 def create_notification(recipient, message, notification_type, related_data=None):
     """Helper function to create notifications"""
-    notification = {
-        "id": len(notifications) + 1,
-        "recipient": recipient,
-        "message": message,
-        "type": notification_type,
-        "sent_at": datetime.utcnow().isoformat(),
-        "status": "sent",
-        "related_data": related_data or {}
-    }
+    notification = record_notification(recipient, message, notification_type, related_data)
     
-    notifications.append(notification)
+    # Store in state store, before delivery can record a later status
+    persist_notification(notification)
+    delivery.submit(notification)
     
-    # Store in state store
+    return notification
+
+def notify(notification, key):
+    """Create the notification for event key, or hold it to merge with the rest of its order.
+
+    A held notification is saved before this returns, so its event can be
+    acknowledged straight away; the coalescer sends it from then on.
+    """
+    ready, hold = coalescer.submit(notification, key)
+    if hold is not None:
+        save_hold(hold)
+    for ready_notification, ready_hold in ready:
+        try:
+            create_notification(**ready_notification)
+        except Exception:
+            if ready_hold is not None:
+                # Its event was acknowledged, so the coalescer retries it
+                coalescer.retry(ready_hold)
+            raise
+        coalescer.sent(ready_hold)
+
+def save_hold(hold):
+    """Save a held notification to the state store; raises unless it was sent in the meantime"""
     try:
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore"
-        state_data = [{"key": f"notification:{notification['id']}", "value": notification}]
-        requests.post(state_url, json=state_data)
+        transact_with_indexes(dapr, lambda: held_notifications.add(hold) + (True,))
     except Exception as e:
-        app.logger.error(f"Failed to save notification to state store: {str(e)}")
-    
-    return notification
+        settle(hold.stored, e)
+        if coalescer.cancel(hold):
+            raise
+        app.logger.warning(f"Failed to save held notification for order {hold.order_id}, but it was already sent: {str(e)}")
+        return
+    settle(hold.stored)
+
+def mark_events_processed(keys, timeout=None):
+    """Record events as handled; the markers are persisted through the write-behind queue"""
+    event_guard.remember(keys)
+    for item in event_guard.marker_items(keys):
+        notification_writer.put(item["key"], item["value"], timeout=timeout, metadata=item["metadata"])
+
+@app.route('/notifications/stats', methods=['GET'])
+def notification_stats():
+    """Write-behind persistence queue, deduplication, coalescing and delivery statistics"""
+    stats = notification_writer.stats()
+    stats["deduplication"] = event_guard.stats()
+    stats["coalescing"] = coalescer.stats()
+    stats["delivery"] = delivery.stats()
+    return jsonify(stats)
+
+@app.route('/notifications/dead-letters', methods=['GET'])
+def get_dead_letters():
+    """Most recent deliveries that were given up on, newest first"""
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Invalid query parameter: limit"}), 400
+    entries = list(delivery.dead_letters)[::-1][:max(limit, 0)]
+    return jsonify({"dead_letters": entries, "count": len(entries), "total": len(delivery.dead_letters)})
+
+@app.route('/notifications/dead-letters/retry', methods=['POST'])
+def retry_dead_letters():
+    """Queue every dead-lettered delivery again"""
+    retried = delivery.retry_dead_letters()
+    app.logger.info(f"Requeued {retried} dead-lettered deliveries")
+    return jsonify({"retried": retried})
 
 @app.route('/dapr/subscribe', methods=['GET'])
 def subscribe():
     """Dapr subscription endpoint"""
     subscriptions = [
-        {
-            "pubsubname": "redis-pubsub",
-            "topic": "order-events",
-            "route": "/handle-order-event"
-        },
-        {
-            "pubsubname": "redis-pubsub",
-            "topic": "inventory-events",
-            "route": "/handle-inventory-event"
-        }
+        subscription("redis-pubsub", "order-events", "/handle-order-event"),
+        subscription("redis-pubsub", "inventory-events", "/handle-inventory-event")
     ]
-    return json.dumps(subscriptions)
+    return codec.dumps(subscriptions)
+
+def order_event_notification(actual_data):
+    """Build the notification for an order event, or None if it needs none"""
+    event_type = actual_data.get("event_type")
+    order_id = actual_data.get("order_id")
+    customer_id = actual_data.get("customer_id")
+    
+    if event_type == "order_created":
+        message = f"Your order {order_id} has been created successfully! Total amount: ${actual_data.get('total_amount', 0):.2f}"
+        return {
+            "recipient": customer_id,
+            "message": message,
+            "notification_type": "order_confirmation",
+            "related_data": {"order_id": order_id, "total_amount": actual_data.get("total_amount")}
+        }
+    
+    if event_type == "order_status_updated":
+        status = actual_data.get("status")
+        message = f"Your order {order_id} status has been updated to: {status}"
+        return {
+            "recipient": customer_id,
+            "message": message,
+            "notification_type": "order_update",
+            "related_data": {"order_id": order_id, "status": status}
+        }
+    
+    return None
+
+def inventory_event_notification(actual_data):
+    """Build the notification for an inventory event, or None if it needs none"""
+    event_type = actual_data.get("event_type")
+    order_id = actual_data.get("order_id")
+    customer_id = actual_data.get("customer_id", "unknown_customer")
+    
+    if event_type != "inventory_processed":
+        return None
+    
+    inventory_status = actual_data.get("inventory_status", [])
+    all_items_reserved = actual_data.get("all_items_reserved", False)
+    
+    if all_items_reserved:
+        reserved_items = [f"{item['product_id']} ({item['reserved_quantity']} units)" 
+                        for item in inventory_status if item["status"] == "reserved"]
+        message = f"Great news! All items for order {order_id} have been reserved: {', '.join(reserved_items)}"
+        notification_type = "inventory_reserved"
+    else:
+        # Find items that couldn't be reserved
+        problem_items = []
+        for item in inventory_status:
+            if item["status"] == "insufficient":
+                problem_items.append(f"{item['product_id']} (need more, only {item['available_quantity']} available)")
+            elif item["status"] == "reservation_failed":
+                problem_items.append(f"{item['product_id']} (reservation failed)")
+        
+        message = f"Order {order_id} has inventory issues: {', '.join(problem_items)}"
+        notification_type = "inventory_insufficient"
+    
+    return {
+        "recipient": customer_id,
+        "message": message,
+        "notification_type": notification_type,
+        "related_data": {"order_id": order_id, "inventory_status": inventory_status}
+    }
+
+def handle_events_bulk(body, build_notification, description):
+    """Create the notifications for a bulk delivery and return a status per entry"""
+    entries = list(bulk_events(body))
+    keys = {entry_id: event_key(actual_data) for entry_id, actual_data in entries if actual_data is not None}
+    done = event_guard.processed(dapr, list(keys.values()))
+    
+    statuses = {}
+    handled = []
+    for entry_id, actual_data in entries:
+        if actual_data is None:
+            statuses[entry_id] = DROP
+            continue
+        if keys[entry_id] in done:
+            statuses[entry_id] = SUCCESS
+            continue
+        log_payload(app.logger, f"{description.capitalize()} event", actual_data, event_key=keys[entry_id])
+        try:
+            notification = build_notification(actual_data)
+            if notification:
+                notify(notification, keys[entry_id])
+            statuses[entry_id] = SUCCESS
+            done.add(keys[entry_id])
+            handled.append(keys[entry_id])
+        except Exception as e:
+            app.logger.error(f"Error handling {description} event {entry_id}: {str(e)}")
+            statuses[entry_id] = RETRY
+    
+    mark_events_processed(handled)
+    return bulk_response(statuses)
 
 @app.route('/handle-order-event', methods=['POST'])
+@metrics.event_handler("order-events")
 def handle_order_event():
     """Handle order events from pub/sub"""
     try:
         event_data = request.json
-        app.logger.info(f"Received order event: {event_data}")
+        
+        if is_bulk_delivery(event_data):
+            app.logger.debug("Received %d order events in bulk", len(event_data["entries"]))
+            return jsonify(handle_events_bulk(event_data, order_event_notification, "order"))
         
         # Extract the actual event data from Dapr's CloudEvent format
-        if 'data' in event_data:
-            actual_data = event_data['data']
-        else:
-            actual_data = event_data
-        
-        event_type = actual_data.get("event_type")
-        order_id = actual_data.get("order_id")
-        customer_id = actual_data.get("customer_id")
-        
-        if event_type == "order_created":
-            message = f"Your order {order_id} has been created successfully! Total amount: ${actual_data.get('total_amount', 0):.2f}"
-            create_notification(
-                recipient=customer_id,
-                message=message,
-                notification_type="order_confirmation",
-                related_data={"order_id": order_id, "total_amount": actual_data.get("total_amount")}
-            )
-            
-        elif event_type == "order_status_updated":
-            status = actual_data.get("status")
-            message = f"Your order {order_id} status has been updated to: {status}"
-            create_notification(
-                recipient=customer_id,
-                message=message,
-                notification_type="order_update",
-                related_data={"order_id": order_id, "status": status}
-            )
+        actual_data = event_payload(event_data)
+        key = event_key(actual_data)
+        app.logger.debug("Received order event %s", key, extra={"event_key": key})
+        log_payload(app.logger, "Order event", event_data, event_key=key)
+        if event_guard.processed(dapr, [key]):
+            app.logger.info("Skipping already processed order event %s", key, extra={"event_key": key})
+            return "", 200
+        
+        notification = order_event_notification(actual_data)
+        if notification:
+            notify(notification, key)
+        mark_events_processed([key])
         
         return "", 200
         
@@ -154,49 +415,29 @@ def handle_order_event():
         return "", 500
 
 @app.route('/handle-inventory-event', methods=['POST'])
+@metrics.event_handler("inventory-events")
 def handle_inventory_event():
     """Handle inventory events from pub/sub"""
     try:
         event_data = request.json
-        app.logger.info(f"Received inventory event: {event_data}")
+        
+        if is_bulk_delivery(event_data):
+            app.logger.debug("Received %d inventory events in bulk", len(event_data["entries"]))
+            return jsonify(handle_events_bulk(event_data, inventory_event_notification, "inventory"))
         
         # Extract the actual event data from Dapr's CloudEvent format
-        if 'data' in event_data:
-            actual_data = event_data['data']
-        else:
-            actual_data = event_data
-        
-        event_type = actual_data.get("event_type")
-        order_id = actual_data.get("order_id")
-        customer_id = actual_data.get("customer_id", "unknown_customer")
-        
-        if event_type == "inventory_processed":
-            inventory_status = actual_data.get("inventory_status", [])
-            all_items_reserved = actual_data.get("all_items_reserved", False)
-            
-            if all_items_reserved:
-                reserved_items = [f"{item['product_id']} ({item['reserved_quantity']} units)" 
-                                for item in inventory_status if item["status"] == "reserved"]
-                message = f"Great news! All items for order {order_id} have been reserved: {', '.join(reserved_items)}"
-                notification_type = "inventory_reserved"
-            else:
-                # Find items that couldn't be reserved
-                problem_items = []
-                for item in inventory_status:
-                    if item["status"] == "insufficient":
-                        problem_items.append(f"{item['product_id']} (need more, only {item['available_quantity']} available)")
-                    elif item["status"] == "reservation_failed":
-                        problem_items.append(f"{item['product_id']} (reservation failed)")
-                
-                message = f"Order {order_id} has inventory issues: {', '.join(problem_items)}"
-                notification_type = "inventory_insufficient"
-            
-            create_notification(
-                recipient=customer_id,
-                message=message,
-                notification_type=notification_type,
-                related_data={"order_id": order_id, "inventory_status": inventory_status}
-            )
+        actual_data = event_payload(event_data)
+        key = event_key(actual_data)
+        app.logger.debug("Received inventory event %s", key, extra={"event_key": key})
+        log_payload(app.logger, "Inventory event", event_data, event_key=key)
+        if event_guard.processed(dapr, [key]):
+            app.logger.info("Skipping already processed inventory event %s", key, extra={"event_key": key})
+            return "", 200
+        
+        notification = inventory_event_notification(actual_data)
+        if notification:
+            notify(notification, key)
+        mark_events_processed([key])
         
         return "", 200
         
@@ -206,18 +447,27 @@ def handle_inventory_event():
 
 @app.route('/notifications/customer/<customer_id>', methods=['GET'])
 def get_customer_notifications(customer_id):
-    """Get notifications for a specific customer"""
+    """Get notifications for a specific customer, paginated and filterable like GET /notifications"""
     try:
-        customer_notifications = [n for n in notifications if n["recipient"] == customer_id]
-        return jsonify({
-            "customer_id": customer_id,
-            "notifications": customer_notifications,
-            "total": len(customer_notifications)
-        })
+        try:
+            page_args = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+        
+        page, next_cursor = notifications.query(recipient=customer_id, **page_args)
+        return stream_page(page, next_cursor, notifications.count(customer_id), customer_id=customer_id)
         
     except Exception as e:
         app.logger.error(f"Error retrieving customer notifications: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+def shutdown():
+    """Send held notifications, finish deliveries, flush queued writes and release sidecar connections before the process exits"""
+    coalescer.close()
+    delivery.close(DELIVERY_DRAIN_TIMEOUT)
+    notification_writer.close()
+    dapr.close()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5003, debug=True)
+    # Local development server; production runs under gunicorn (common/gunicorn_config.py)
+    app.run(host='0.0.0.0', port=5003, threaded=True)
@@ -0,0 +1,154 @@
+"""ASGI serving mode for the notification service.
+
+The pub/sub handlers run natively on asyncio, so a single process can keep
+thousands of event deliveries in flight. Notifications are persisted through
+the Flask app's write-behind queue, falling back to AsyncDaprClient when the
+queue is full, and then handed to its delivery pool. Every other route is
+served by the Flask app through WSGIMiddleware.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 5003
+"""
+import asyncio
+import logging
+
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+import app as flask_service
+from coalescer import settle
+from common import metrics
+from common.async_dapr_client import AsyncDaprClient
+from common.codec import json_response, request_json
+from common.idempotency import event_key
+from common.pubsub import DROP, RETRY, SUCCESS, bulk_events, bulk_response, event_payload, is_bulk_delivery
+from common.state_index import transact_with_indexes_async
+
+logger = logging.getLogger("notification-service.asgi")
+
+dapr = AsyncDaprClient(flask_service.DAPR_URL)
+
+
+async def create_notification(recipient, message, notification_type, related_data=None):
+    """Coroutine version of the Flask app's create_notification"""
+    notification = flask_service.record_notification(recipient, message, notification_type, related_data)
+
+    # Never block the event loop on a full write-behind queue; save inline instead
+    key = f"notification:{notification['id']}"
+    if not flask_service.notification_writer.put(key, notification, timeout=0):
+        try:
+            await dapr.save_state(key, notification)
+        except Exception as e:
+            logger.error(f"Failed to save notification to state store: {str(e)}")
+
+    flask_service.delivery.submit(notification)
+    return notification
+
+
+async def notify(notification, key):
+    """Coroutine version of the Flask app's notify"""
+    coalescer = flask_service.coalescer
+    ready, hold = coalescer.submit(notification, key)
+    if hold is not None:
+        await save_hold(hold)
+    for ready_notification, ready_hold in ready:
+        try:
+            await create_notification(**ready_notification)
+        except Exception:
+            if ready_hold is not None:
+                coalescer.retry(ready_hold)
+            raise
+        coalescer.sent(ready_hold)
+
+
+async def save_hold(hold):
+    """Coroutine version of the Flask app's save_hold"""
+    try:
+        await transact_with_indexes_async(dapr, lambda: flask_service.held_notifications.add(hold) + (True,))
+    except Exception as e:
+        settle(hold.stored, e)
+        if flask_service.coalescer.cancel(hold):
+            raise
+        logger.warning(f"Failed to save held notification for order {hold.order_id}, but it was already sent: {str(e)}")
+        return
+    settle(hold.stored)
+
+
+def event_handler(build_notification, description):
+    """Build an async pub/sub route that turns each delivered event into a notification"""
+
+    async def handle_entry(entry_id, actual_data, key):
+        try:
+            notification = build_notification(actual_data)
+            if notification:
+                await notify(notification, key)
+            return SUCCESS
+        except Exception as e:
+            logger.error(f"Error handling {description} event {entry_id}: {str(e)}")
+            return RETRY
+
+    @metrics.asgi_endpoint(f"/handle-{description}-event", handler=f"{description}-events")
+    async def handle(request):
+        try:
+            event_data = await request_json(request)
+
+            if is_bulk_delivery(event_data):
+                entries = list(bulk_events(event_data))
+                keys = {entry_id: event_key(actual_data) for entry_id, actual_data in entries if actual_data is not None}
+                done = await flask_service.event_guard.processed_async(dapr, list(keys.values()))
+
+                statuses = {}
+                pending = {}
+                for entry_id, actual_data in entries:
+                    if actual_data is None:
+                        statuses[entry_id] = DROP
+                    elif keys[entry_id] in done:
+                        statuses[entry_id] = SUCCESS
+                    elif keys[entry_id] not in pending:
+                        # Entries are handled concurrently, so one hold being saved does not hold up the rest
+                        pending[keys[entry_id]] = handle_entry(entry_id, actual_data, keys[entry_id])
+                results = dict(zip(pending, await asyncio.gather(*pending.values())))
+                for entry_id, _ in entries:
+                    if entry_id not in statuses:
+                        statuses[entry_id] = results[keys[entry_id]]
+                handled = [key for key, status in results.items() if status == SUCCESS]
+                flask_service.mark_events_processed(handled, timeout=0)
+                return json_response(bulk_response(statuses))
+
+            # Extract the actual event data from Dapr's CloudEvent format
+            actual_data = event_payload(event_data)
+            key = event_key(actual_data)
+            if await flask_service.event_guard.processed_async(dapr, [key]):
+                return Response(status_code=200)
+
+            notification = build_notification(actual_data)
+            if notification:
+                await notify(notification, key)
+            flask_service.mark_events_processed([key], timeout=0)
+
+            return Response(status_code=200)
+
+        except Exception as e:
+            logger.error(f"Error handling {description} event: {str(e)}")
+            return Response(status_code=500)
+
+    return handle
+
+
+app = Starlette(
+    routes=[
+        Route("/handle-order-event",
+              event_handler(flask_service.order_event_notification, "order"), methods=["POST"]),
+        Route("/handle-inventory-event",
+              event_handler(flask_service.inventory_event_notification, "inventory"), methods=["POST"]),
+        Mount("/", WSGIMiddleware(flask_service.app)),
+    ],
+    on_startup=[flask_service.coalescer.start],
+    on_shutdown=[
+        flask_service.coalescer.close,
+        lambda: flask_service.delivery.close(flask_service.DELIVERY_DRAIN_TIMEOUT),
+        flask_service.notification_writer.close,
+        dapr.close,
+    ],
+)
@@ -0,0 +1,133 @@
+"""Channel adapters that deliver notifications to customers.
+
+An adapter's send(notification) returns once the provider has accepted the
+notification. It raises DeliveryError for failures that are worth retrying
+and PermanentDeliveryError for ones that are not (a rejected recipient, a
+malformed request). Adapters are called from the delivery worker threads,
+so send() may block.
+
+NOTIFICATION_CHANNELS lists the channels every notification is delivered
+through (default "log"). Each channel gets NOTIFICATION_DELIVERY_CONCURRENCY
+workers and at most NOTIFICATION_DELIVERY_RATE_LIMIT sends per second
+(0 is unlimited). NOTIFICATION_<CHANNEL>_CONCURRENCY and
+NOTIFICATION_<CHANNEL>_RATE_LIMIT override these for one channel.
+
+New providers (email, SMS) are added by subclassing Channel and
+registering the class in ADAPTERS.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+
+from common import codec
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_CHANNELS = [name.strip() for name in os.getenv("NOTIFICATION_CHANNELS", "log").split(",") if name.strip()]
+DEFAULT_CONCURRENCY = int(os.getenv("NOTIFICATION_DELIVERY_CONCURRENCY", "4"))
+DEFAULT_RATE_LIMIT = float(os.getenv("NOTIFICATION_DELIVERY_RATE_LIMIT", "0"))
+
+
+class DeliveryError(Exception):
+    """Raised by a channel when a delivery failed but may succeed if retried"""
+
+
+class PermanentDeliveryError(DeliveryError):
+    """Raised by a channel when retrying a delivery cannot help"""
+
+
+class Channel:
+    """Base class for channel adapters"""
+
+    name = None
+
+    def __init__(self):
+        prefix = f"NOTIFICATION_{self.name.upper()}_"
+        self.concurrency = int(os.getenv(prefix + "CONCURRENCY", str(DEFAULT_CONCURRENCY)))
+        self.rate_limit = float(os.getenv(prefix + "RATE_LIMIT", str(DEFAULT_RATE_LIMIT)))
+
+    def send(self, notification):
+        raise NotImplementedError
+
+
+class LogChannel(Channel):
+    """Writes each notification to the service log; stands in for a provider in development"""
+
+    name = "log"
+
+    def send(self, notification):
+        logger.info(
+            "Delivered notification %s to %s", notification["id"], notification["recipient"],
+            extra={"notification_id": notification["id"], "notification_type": notification["type"]}
+        )
+
+
+class WebhookChannel(Channel):
+    """POSTs each notification as JSON to NOTIFICATION_WEBHOOK_URL"""
+
+    name = "webhook"
+
+    def __init__(self):
+        super().__init__()
+        self.url = os.getenv("NOTIFICATION_WEBHOOK_URL")
+        self.timeout = float(os.getenv("NOTIFICATION_WEBHOOK_TIMEOUT", "5"))
+        if not self.url:
+            raise ValueError("The webhook channel needs NOTIFICATION_WEBHOOK_URL")
+        self._local = threading.local()
+
+    def send(self, notification):
+        # One pooled session per worker thread
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        try:
+            response = session.post(
+                self.url, data=codec.dumps(notification), timeout=self.timeout,
+                headers={"Content-Type": codec.CONTENT_TYPE}
+            )
+        except requests.RequestException as e:
+            raise DeliveryError(f"Webhook request failed: {e}")
+        if response.status_code == 429 or response.status_code >= 500:
+            raise DeliveryError(f"Webhook answered {response.status_code}")
+        if response.status_code >= 400:
+            raise PermanentDeliveryError(f"Webhook rejected the notification with {response.status_code}")
+
+
+class FakeChannel(Channel):
+    """In-memory channel for tests and benchmarks.
+
+    Takes NOTIFICATION_FAKE_LATENCY seconds per send and fails a
+    NOTIFICATION_FAKE_FAILURE_RATE fraction of them; the most recent
+    deliveries are kept in sent.
+    """
+
+    name = "fake"
+
+    def __init__(self):
+        super().__init__()
+        self.latency = float(os.getenv("NOTIFICATION_FAKE_LATENCY", "0"))
+        self.failure_rate = float(os.getenv("NOTIFICATION_FAKE_FAILURE_RATE", "0"))
+        self.sent = deque(maxlen=1000)
+
+    def send(self, notification):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise DeliveryError("Fake channel failure")
+        self.sent.append(notification)
+
+
+ADAPTERS = {adapter.name: adapter for adapter in (LogChannel, WebhookChannel, FakeChannel)}
+
+
+def configured_channels():
+    """Build the adapters named in NOTIFICATION_CHANNELS"""
+    unknown = [name for name in NOTIFICATION_CHANNELS if name not in ADAPTERS]
+    if unknown:
+        raise ValueError(f"Unknown notification channels: {', '.join(unknown)}")
+    return [ADAPTERS[name]() for name in NOTIFICATION_CHANNELS]
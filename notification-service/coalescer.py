@@ -0,0 +1,395 @@
+"""Merges an order's confirmation and inventory result into one notification.
+
+Every order produces an order_created event on order-events and an
+inventory_processed event on inventory-events, and each used to become a
+notification of its own. The coalescer holds whichever of the two
+notifications arrives first for up to window seconds. If the other one
+arrives in time, the customer gets a single notification carrying both
+messages. Otherwise the held one is sent on its own when the window ends.
+
+At most max_pending orders are held; beyond that the longest-held one is
+sent straight away, so memory stays bounded however far the inventory
+results fall behind. close() sends the held notifications before the
+process exits.
+
+A held notification is saved to the state store by HeldStore before its
+event is acknowledged, so no handler waits out the window. From then on the
+coalescer owns it: a notification that fails to be created is retried from
+its thread, and the saved copy is deleted once it has been created. Copies
+left behind by a process that died while holding them are resent by a
+sweep, in the manner of the outbox relay. Like the outbox, this is
+at-least-once: a hold whose copy could not be deleted is sent twice.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from common.dapr_client import DaprError, EtagMismatchError, delete_operation, upsert_operation
+from common.state_index import BucketedIndex
+
+logger = logging.getLogger(__name__)
+
+# Notification types that are held for merging, and which half of an order they are
+KINDS = {
+    "order_confirmation": "order",
+    "inventory_reserved": "inventory",
+    "inventory_insufficient": "inventory",
+}
+
+# Index buckets fetched per bulk read while sweeping, and swept per sweep at most
+SWEEP_BUCKETS_PER_READ = 16
+MAX_SWEEP_BUCKETS = 360
+
+
+def merge(order, inventory):
+    """One notification for both halves of an order; it takes the inventory result's type"""
+    return {
+        "recipient": order["recipient"],
+        "message": f"{order['message']} {inventory['message']}",
+        "notification_type": inventory["notification_type"],
+        "related_data": dict(
+            order["related_data"],
+            **inventory["related_data"],
+            coalesced=[order["notification_type"], inventory["notification_type"]]
+        ),
+    }
+
+
+def settle(future, error=None):
+    """Complete a future unless it already is"""
+    if future is None or future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+class Hold:
+    """A notification held for merging, and the event it came from.
+
+    stored completes once its copy has been saved to the state store, or
+    failed to be.
+    """
+
+    __slots__ = ("order_id", "kind", "notification", "key", "deadline", "held_at", "stored")
+
+    def __init__(self, order_id, kind, notification, key, deadline):
+        self.order_id = order_id
+        self.kind = kind
+        self.notification = notification
+        self.key = key
+        self.deadline = deadline
+        self.held_at = time.time()
+        self.stored = Future()
+
+    @property
+    def record_id(self):
+        return f"{self.order_id}:{self.kind}"
+
+
+class HeldStore:
+    """Saved copies of held notifications, indexed by when they were held.
+
+    Like the outbox, the holders write the index and the sweep only deletes
+    index buckets whose window closed more than stale_after seconds ago.
+    """
+
+    def __init__(self, dapr, name="notification-held", partitions=32, bucket_seconds=10.0,
+                 stale_after=30.0, ttl=86400, sweep_lookback=86400.0):
+        self.dapr = dapr
+        self.name = name
+        self.index = BucketedIndex(f"{name}-index", bucket_seconds, partitions, ttl=ttl, directory=False)
+        self.cursor_key = f"{name}-sweep"
+        self.stale_after = stale_after
+        self.ttl = ttl
+        self.sweep_lookback = sweep_lookback
+
+    def key(self, record_id):
+        return f"{self.name}:{record_id}"
+
+    def add(self, hold):
+        """State operations and index changes saving a hold, for transact_with_indexes"""
+        record = {
+            "order_id": hold.order_id,
+            "kind": hold.kind,
+            "key": hold.key,
+            "notification": hold.notification,
+            "held_at": hold.held_at,
+        }
+        return (
+            [upsert_operation(self.key(hold.record_id), record, ttl=self.ttl)],
+            [self.index.add(hold.record_id, hold.held_at)]
+        )
+
+    def delete(self, holds):
+        """Delete the saved copies of holds whose notifications have been created"""
+        self.dapr.transact_state([delete_operation(self.key(hold.record_id)) for hold in holds])
+
+    def sweep(self, resend, is_held):
+        """Resend the holds that are still saved in closed buckets; returns how many were resent.
+
+        resend(records) creates their notifications and returns True if all
+        of them were. A bucket with a hold is_held(record) by this process is
+        left for a later sweep.
+        """
+        last = self.index.bucket(time.time() - self.stale_after) - 1
+        swept = resent = 0
+        try:
+            while swept < MAX_SWEEP_BUCKETS:
+                cursor, etag = self.dapr.get_state_with_etag(self.cursor_key)
+                first = cursor["next_bucket"] if cursor else self.index.bucket(time.time() - self.sweep_lookback)
+                buckets = list(range(first, min(last, first + SWEEP_BUCKETS_PER_READ - 1) + 1))
+                if not buckets:
+                    break
+                documents = self.dapr.get_bulk_state([key for bucket in buckets for key in self.index.bucket_keys(bucket)])
+                keys = [self.key(record_id) for document in documents.values() for record_id in document]
+                records = self.dapr.get_bulk_state(keys) if keys else {}
+                if any(is_held(record) for record in records.values()):
+                    break
+                if records and not resend(list(records.values())):
+                    break
+                resent += len(records)
+
+                operations = [delete_operation(key) for key in list(records) + list(documents)]
+                operations.append(upsert_operation(self.cursor_key, {"next_bucket": buckets[-1] + 1}, etag, first_write=True))
+                try:
+                    self.dapr.transact_state(operations)
+                except EtagMismatchError:
+                    # Another replica swept them at the same time
+                    break
+                swept += len(buckets)
+        except DaprError as e:
+            logger.error(f"Sweep of held notifications failed: {e}")
+        return resent
+
+
+class NotificationCoalescer:
+    """Holds the first notification of an order until its counterpart arrives or the window ends.
+
+    emit(notification) is called from a background thread for notifications
+    whose window ended. submit() hands back the notifications to create
+    now, each with its Hold if it was held; the caller saves a new Hold
+    with store, reports each created one with sent() and each that failed
+    with retry().
+    """
+
+    def __init__(self, emit, window, max_pending, store=None, sweep_interval=10.0):
+        self.emit = emit
+        self.window = window
+        self.max_pending = max_pending
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self.held = 0
+        self.merged = 0
+        self.expired = 0
+        self.overflowed = 0
+        self.retried = 0
+        self.recovered = 0
+        self._pending = OrderedDict()  # order_id -> Hold, oldest first
+        self._retries = deque()  # Holds whose notification failed to be created, oldest first
+        self._sent = []  # Holds whose notification was created, with saved copies to delete
+        self._sent_alone = OrderedDict()  # order_id -> kind, for the last max_pending orders sent unmerged
+        self._condition = threading.Condition()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the thread in this process if it is not running yet (also after a fork)"""
+        if self.window <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="notification-coalescer", daemon=True).start()
+
+    def submit(self, notification, key=None):
+        """Hand over the notification of event key.
+
+        Returns (ready, hold). ready lists the (notification, Hold or None)
+        pairs to create now, possibly none. hold is the Hold of this
+        notification if it is being held, else None; it must be saved
+        before the event is acknowledged.
+        """
+        order_id = (notification.get("related_data") or {}).get("order_id")
+        kind = KINDS.get(notification["notification_type"])
+        if self.window <= 0 or order_id is None:
+            return [(notification, None)], None
+        self.start()
+
+        with self._condition:
+            held = self._pending.get(order_id)
+            if held is not None and key is not None and held.key == key:
+                # A redelivery of the event whose notification is held
+                return [], held
+            held = self._pending.pop(order_id, None)
+            if held is None:
+                if kind is None:
+                    return [(notification, None)], None
+                if self._sent_alone.get(order_id, kind) != kind:
+                    # The counterpart came too late and was sent on its own, so there is nothing to wait for
+                    del self._sent_alone[order_id]
+                    return [(notification, None)], None
+                hold = Hold(order_id, kind, notification, key, time.monotonic() + self.window)
+                self._pending[order_id] = hold
+                self.held += 1
+                overflow = []
+                while len(self._pending) > self.max_pending:
+                    overflowed_order, overflowed = self._pending.popitem(last=False)
+                    self._remember_sent_alone(overflowed_order, overflowed.kind)
+                    overflow.append((overflowed.notification, overflowed))
+                    self.overflowed += 1
+                self._condition.notify()
+                return overflow, hold
+
+            if kind is None or kind == held.kind:
+                # Not the counterpart (a status update, or a repeated result):
+                # send the held notification first, keeping their order
+                return [(held.notification, held), (notification, None)], None
+            self.merged += 1
+            if kind == "order":
+                return [(merge(notification, held.notification), held)], None
+            return [(merge(held.notification, notification), held)], None
+
+    def cancel(self, hold):
+        """Stop holding a notification whose copy could not be saved; False if it was already sent"""
+        with self._condition:
+            if self._pending.get(hold.order_id) is not hold:
+                return False
+            del self._pending[hold.order_id]
+            return True
+
+    def sent(self, hold):
+        """Report a held notification as created, so its saved copy gets deleted"""
+        if hold is None or self.store is None:
+            return
+        with self._condition:
+            self._sent.append(hold)
+            self._condition.notify()
+
+    def retry(self, hold):
+        """Report a held notification that failed to be created; it is sent on its own a window later"""
+        with self._condition:
+            self._remember_sent_alone(hold.order_id, hold.kind)
+            hold.deadline = time.monotonic() + self.window
+            self._retries.append(hold)
+            self.retried += 1
+            self._condition.notify()
+
+    def _due(self):
+        """Remove and return the holds whose window or retry delay has ended"""
+        now = time.monotonic()
+        due = []
+        while self._pending:
+            order_id, hold = next(iter(self._pending.items()))
+            if hold.deadline > now:
+                break
+            del self._pending[order_id]
+            self._remember_sent_alone(order_id, hold.kind)
+            due.append(hold)
+        self.expired += len(due)
+        while self._retries and self._retries[0].deadline <= now:
+            due.append(self._retries.popleft())
+        return due
+
+    def _remember_sent_alone(self, order_id, kind):
+        self._sent_alone[order_id] = kind
+        while len(self._sent_alone) > self.max_pending:
+            self._sent_alone.popitem(last=False)
+
+    def _next_wakeup(self, next_sweep):
+        # Every hold gets the same window and retry delay, so the oldest ones are the next to end
+        deadlines = [next_sweep]
+        if self._pending:
+            deadlines.append(next(iter(self._pending.values())).deadline)
+        if self._retries:
+            deadlines.append(self._retries[0].deadline)
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _run(self):
+        sweeping = self.store is not None and self.sweep_interval > 0
+        next_sweep = time.monotonic() + (self.sweep_interval if sweeping else float("inf"))
+        while True:
+            with self._condition:
+                due = self._due()
+                while not due and not self._deletable() and time.monotonic() < next_sweep:
+                    timeout = self._next_wakeup(next_sweep)
+                    self._condition.wait(None if timeout == float("inf") else timeout)
+                    due = self._due()
+            self._send(due)
+            if self.store is not None:
+                self._delete_sent()
+            if time.monotonic() >= next_sweep:
+                self.recovered += self.store.sweep(self._resend, self._is_held)
+                next_sweep = time.monotonic() + self.sweep_interval
+
+    def _send(self, holds):
+        for hold in holds:
+            try:
+                self.emit(hold.notification)
+            except Exception as e:
+                logger.error(f"Failed to send held notification for order {hold.order_id}, retrying: {e}")
+                self.retry(hold)
+            else:
+                self.sent(hold)
+
+    def _deletable(self):
+        return any(hold.stored.done() for hold in self._sent)
+
+    def _delete_sent(self):
+        """Delete the saved copies of created notifications, once their save has finished"""
+        with self._condition:
+            done = [hold for hold in self._sent if hold.stored.done()]
+            self._sent = [hold for hold in self._sent if not hold.stored.done()]
+        saved = [hold for hold in done if hold.stored.exception() is None]
+        if not saved:
+            return
+        try:
+            self.store.delete(saved)
+        except DaprError as e:
+            logger.error(f"Failed to delete {len(saved)} sent held notifications; they will be resent: {e}")
+
+    def _resend(self, records):
+        """Create the notifications of holds left behind by another process"""
+        for record in records:
+            try:
+                self.emit(record["notification"])
+            except Exception as e:
+                logger.error(f"Failed to resend held notification for order {record['order_id']}: {e}")
+                return False
+        return True
+
+    def _is_held(self, record):
+        with self._condition:
+            holds = list(self._pending.values()) + list(self._retries) + self._sent
+        return any(hold.record_id == f"{record['order_id']}:{record['kind']}" for hold in holds)
+
+    def close(self):
+        """Send every held notification now"""
+        with self._condition:
+            held = list(self._pending.values()) + list(self._retries)
+            self._pending.clear()
+            self._retries.clear()
+        self._send(held)
+        if self.store is not None:
+            self._delete_sent()
+
+    def stats(self):
+        with self._condition:
+            pending = len(self._pending)
+            retrying = len(self._retries)
+        return {
+            "window_seconds": self.window,
+            "pending_orders": pending,
+            "max_pending": self.max_pending,
+            "held": self.held,
+            "merged": self.merged,
+            "sent_alone": self.expired,
+            "overflowed": self.overflowed,
+            "retrying": retrying,
+            "retried": self.retried,
+            "recovered": self.recovered,
+        }
@@ -0,0 +1,263 @@
+"""Asynchronous notification delivery, off the pub/sub handlers.
+
+Handlers only submit() a notification, which puts one delivery per
+channel on that channel's bounded queue and returns. Each channel has its
+own pool of worker threads, sized by its concurrency, and a token bucket
+that caps its sends per second. So delivery throughput is tuned per
+channel, independently of how fast events are taken in, and a slow
+provider only backs up its own queue.
+
+A failed send is retried up to max_attempts times with jittered
+exponential backoff. A delivery that still fails, fails permanently, or
+finds its channel's queue full is dead-lettered. It is kept in a bounded
+in-memory list that the service exposes, and it is passed to the
+dead_letter callback. A notification's status goes from queued to sent
+once every channel has delivered it, or to failed if any channel
+dead-lettered it.
+"""
+import heapq
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from channels import PermanentDeliveryError
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket shared by a channel's workers; a rate of 0 is unlimited"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a send is allowed"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class _Lane:
+    """One channel's queue, limiter and counters"""
+
+    def __init__(self, channel, queue_size):
+        self.channel = channel
+        self.queue_size = queue_size
+        self.limiter = RateLimiter(channel.rate_limit)
+        self.queue = None
+        self.in_flight = 0
+        self.sent = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+
+class DeliveryPool:
+    """Per-channel worker pools delivering notifications with retries and a dead-letter list.
+
+    on_status(notification, status) records a status change;
+    on_dead_letter(entry) is called for each delivery that is given up on.
+    Both are called from the worker threads.
+    """
+
+    def __init__(self, channels, on_status, on_dead_letter=None, max_attempts=5, retry_backoff=0.5,
+                 max_retry_backoff=30.0, queue_size=10000, dead_letter_size=1000):
+        self.lanes = {channel.name: _Lane(channel, queue_size) for channel in channels}
+        self.on_status = on_status
+        self.on_dead_letter = on_dead_letter
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.dead_letters = deque(maxlen=dead_letter_size)
+        self._lock = threading.Lock()
+        self._outstanding = {}  # notification id -> [channels left, any dead-lettered]
+        self._retries = []  # heap of (due, sequence, job)
+        self._sequence = itertools.count()
+        self._retry_ready = threading.Condition(self._lock)
+        self._closed = False
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the worker and retry threads in this process if they are not running yet (also after a fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                for lane in self.lanes.values():
+                    lane.queue = queue.Queue(lane.queue_size)
+                    for worker in range(lane.channel.concurrency):
+                        threading.Thread(target=self._work, args=(lane,), daemon=True,
+                                         name=f"delivery-{lane.channel.name}-{worker}").start()
+                threading.Thread(target=self._schedule_retries, name="delivery-retries", daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, notification):
+        """Queue a notification on every channel without blocking"""
+        if not self.lanes:
+            self.on_status(notification, "sent")
+            return
+        self.start()
+        with self._lock:
+            self._outstanding[notification["id"]] = [len(self.lanes), False]
+        for lane in self.lanes.values():
+            self._enqueue(lane, (notification, lane.channel.name, 1))
+
+    def _enqueue(self, lane, job):
+        if self._closed:
+            self._give_up(lane, job, "notification service is shutting down")
+            return
+        try:
+            lane.queue.put_nowait(job)
+        except queue.Full:
+            self._give_up(lane, job, "delivery queue is full")
+
+    def _work(self, lane):
+        while True:
+            job = lane.queue.get()
+            notification, _, attempt = job
+            with self._lock:
+                lane.in_flight += 1
+            try:
+                lane.limiter.acquire()
+                lane.channel.send(notification)
+            except PermanentDeliveryError as e:
+                self._give_up(lane, job, str(e))
+            except Exception as e:
+                if attempt < self.max_attempts and not self._closed:
+                    self._retry_later(lane, job)
+                else:
+                    self._give_up(lane, job, str(e))
+            else:
+                with self._lock:
+                    lane.sent += 1
+                self._finish(notification, dead=False)
+            finally:
+                with self._lock:
+                    lane.in_flight -= 1
+
+    def _retry_later(self, lane, job):
+        notification, channel, attempt = job
+        backoff = min(self.max_retry_backoff, self.retry_backoff * (2 ** (attempt - 1))) * random.uniform(0.5, 1.5)
+        with self._lock:
+            lane.retried += 1
+            heapq.heappush(self._retries, (time.monotonic() + backoff, next(self._sequence), (notification, channel, attempt + 1)))
+            self._retry_ready.notify()
+
+    def _schedule_retries(self):
+        while True:
+            with self._lock:
+                while not self._retries or self._retries[0][0] > time.monotonic():
+                    self._retry_ready.wait(self._retries[0][0] - time.monotonic() if self._retries else None)
+                _, _, job = heapq.heappop(self._retries)
+            self._enqueue(self.lanes[job[1]], job)
+
+    def _give_up(self, lane, job, error):
+        notification, channel, attempt = job
+        entry = {
+            "notification_id": notification["id"],
+            "channel": channel,
+            "attempts": attempt,
+            "error": error,
+            "failed_at": datetime.utcnow().isoformat(),
+            "notification": notification,
+        }
+        with self._lock:
+            lane.dead_lettered += 1
+            self.dead_letters.append(entry)
+        logger.warning(
+            "Gave up delivering notification %s over %s after %d attempts: %s", notification["id"], channel, attempt, error,
+            extra={"notification_id": notification["id"], "channel": channel}
+        )
+        if self.on_dead_letter is not None:
+            try:
+                self.on_dead_letter(entry)
+            except Exception as e:
+                logger.error(f"Failed to record dead letter for notification {notification['id']}: {e}")
+        self._finish(notification, dead=True)
+
+    def _finish(self, notification, dead):
+        """Count one channel as done; records the final status once all of them are"""
+        with self._lock:
+            outstanding = self._outstanding.get(notification["id"])
+            if outstanding is None:
+                # A dead letter being retried
+                status = None if dead else "sent"
+            else:
+                outstanding[0] -= 1
+                outstanding[1] = outstanding[1] or dead
+                status = None
+                if outstanding[0] == 0:
+                    del self._outstanding[notification["id"]]
+                    status = "failed" if outstanding[1] else "sent"
+        if status is not None:
+            try:
+                self.on_status(notification, status)
+            except Exception as e:
+                logger.error(f"Failed to record status of notification {notification['id']}: {e}")
+
+    def retry_dead_letters(self):
+        """Queue every dead-lettered delivery again; returns how many were queued"""
+        with self._lock:
+            entries = list(self.dead_letters)
+            self.dead_letters.clear()
+        self.start()
+        for entry in entries:
+            lane = self.lanes.get(entry["channel"])
+            if lane is not None:
+                self._enqueue(lane, (entry["notification"], entry["channel"], 1))
+        return len(entries)
+
+    def close(self, timeout=10.0):
+        """Stop retrying and wait up to timeout for the queued deliveries to finish"""
+        if self._pid != os.getpid():
+            return
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                busy = any(lane.in_flight for lane in self.lanes.values())
+            if not busy and all(lane.queue.empty() for lane in self.lanes.values()):
+                return
+            time.sleep(0.05)
+        logger.warning(f"Notification delivery still had {len(self._outstanding)} notifications after {timeout}s drain")
+
+    def stats(self):
+        with self._lock:
+            channels = {
+                name: {
+                    "concurrency": lane.channel.concurrency,
+                    "rate_limit": lane.channel.rate_limit,
+                    "queued": lane.queue.qsize() if self._pid == os.getpid() else 0,
+                    "in_flight": lane.in_flight,
+                    "sent": lane.sent,
+                    "retried": lane.retried,
+                    "dead_lettered": lane.dead_lettered,
+                }
+                for name, lane in self.lanes.items()
+            }
+            return {
+                "outstanding": len(self._outstanding),
+                "retries_scheduled": len(self._retries),
+                "dead_letters": len(self.dead_letters),
+                "channels": channels,
+            }
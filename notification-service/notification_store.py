@@ -0,0 +1,170 @@
+"""Bounded, indexed in-memory notification store.
+
+Notifications are kept in arrival order with a per-recipient index, so
+per-customer queries cost in proportion to that customer's notifications
+rather than to the whole history. Retention is capped by count and by age;
+the oldest notifications are evicted first.
+
+Notification IDs are assigned from a counter and only the oldest entries
+are ever evicted, so the retained IDs always form a contiguous range. That
+lets a cursor (the last ID a client saw) be resolved without scanning.
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+DEFAULT_MAX_ITEMS = int(os.getenv("NOTIFICATION_MAX_ITEMS", "10000"))
+DEFAULT_MAX_AGE_SECONDS = float(os.getenv("NOTIFICATION_MAX_AGE_SECONDS", "86400"))
+
+
+class _Record:
+    """Compact storage for one notification"""
+
+    __slots__ = ("id", "recipient", "message", "type", "sent_at", "status", "related_data", "created")
+
+    def __init__(self, id, recipient, message, type, sent_at, status, related_data, created):
+        self.id = id
+        self.recipient = recipient
+        self.message = message
+        self.type = type
+        self.sent_at = sent_at
+        self.status = status
+        self.related_data = related_data
+        self.created = created
+
+    def to_dict(self):
+        notification = {
+            "id": self.id,
+            "recipient": self.recipient,
+            "message": self.message,
+            "type": self.type,
+            "sent_at": self.sent_at,
+            "status": self.status,
+        }
+        if self.related_data is not None:
+            notification["related_data"] = self.related_data
+        return notification
+
+
+class NotificationStore:
+    """Thread-safe notification store with a recipient index and retention cap"""
+
+    def __init__(self, max_items=None, max_age_seconds=None):
+        self.max_items = DEFAULT_MAX_ITEMS if max_items is None else max_items
+        self.max_age_seconds = DEFAULT_MAX_AGE_SECONDS if max_age_seconds is None else max_age_seconds
+        self._lock = threading.Lock()
+        self._records = {}
+        self._by_recipient = {}
+        self._first_id = 1
+        self._next_id = 1
+        self.evicted = 0
+
+    def __len__(self):
+        with self._lock:
+            self._evict_expired()
+            return len(self._records)
+
+    def add(self, recipient, message, notification_type, related_data=None, status="sent"):
+        """Store a new notification and return it as a dict"""
+        if isinstance(recipient, str):
+            recipient = sys.intern(recipient)
+        with self._lock:
+            record = _Record(
+                self._next_id,
+                recipient,
+                message,
+                sys.intern(notification_type) if isinstance(notification_type, str) else notification_type,
+                datetime.utcnow().isoformat(),
+                status,
+                related_data,
+                time.time(),
+            )
+            self._next_id += 1
+            self._records[record.id] = record
+            self._by_recipient.setdefault(recipient, deque()).append(record.id)
+            self._evict_expired()
+            while self.max_items and len(self._records) > self.max_items:
+                self._evict_oldest()
+            return record.to_dict()
+
+    def set_status(self, notification_id, status):
+        """Update a notification's delivery status; returns it, or None if it has been evicted"""
+        with self._lock:
+            record = self._records.get(notification_id)
+            if record is None:
+                return None
+            record.status = status
+            return record.to_dict()
+
+    def count(self, recipient=None):
+        """Number of retained notifications, optionally for one recipient"""
+        with self._lock:
+            self._evict_expired()
+            if recipient is None:
+                return len(self._records)
+            return len(self._by_recipient.get(recipient, ()))
+
+    def query(self, recipient=None, notification_type=None, since=None, until=None,
+              order_id=None, after=None, limit=100):
+        """Return one page of matching notifications, oldest first.
+
+        Returns (records, next_cursor): records are compact records to be
+        rendered with to_dict() by the caller, and next_cursor is the ID to
+        pass as `after` for the next page, or None on the last page. since
+        and until are ISO-8601 UTC timestamps compared against sent_at.
+        """
+        with self._lock:
+            self._evict_expired()
+            start = self._first_id if after is None else max(after + 1, self._first_id)
+            if recipient is None:
+                ids = range(start, self._next_id)
+            else:
+                recipient_ids = self._by_recipient.get(recipient, deque())
+                ids = _islice_from(recipient_ids, bisect.bisect_left(recipient_ids, start))
+
+            page = []
+            for notification_id in ids:
+                record = self._records[notification_id]
+                if notification_type is not None and record.type != notification_type:
+                    continue
+                if since is not None and record.sent_at < since:
+                    continue
+                if until is not None and record.sent_at > until:
+                    # IDs follow arrival order, so nothing later can match
+                    break
+                if order_id is not None and (record.related_data or {}).get("order_id") != order_id:
+                    continue
+                if len(page) == limit:
+                    return page, page[-1].id
+                page.append(record)
+            return page, None
+
+    def _evict_expired(self):
+        if not self.max_age_seconds:
+            return
+        cutoff = time.time() - self.max_age_seconds
+        while self._records:
+            if self._records[self._first_id].created >= cutoff:
+                break
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        record = self._records.pop(self._first_id)
+        self._first_id += 1
+        # Notifications are appended in id order, so the oldest one for its
+        # recipient is always at the front of that recipient's index
+        ids = self._by_recipient[record.recipient]
+        ids.popleft()
+        if not ids:
+            del self._by_recipient[record.recipient]
+        self.evicted += 1
+
+
+def _islice_from(items, start):
+    """Iterate a deque from an index without copying it"""
+    for index in range(start, len(items)):
+        yield items[index]
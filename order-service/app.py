@@ -1,68 +1,208 @@
 from flask import Flask, request, jsonify
-import json
+import itertools
+import os
 import uuid
-from datetime import datetime
-import requests
-import logging
+from datetime import datetime, timezone
+
+from common import codec, metrics
+from common.dapr_client import DaprClient, DaprError, upsert_operation
+from common.outbox import Outbox
+from common.state_index import BucketedIndex, IndexConflictError, take, transact_with_indexes
+from common.structured_logging import configure_logging
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+log_handler = configure_logging("order-service")
+app.json = codec.json_provider(app)
+metrics.instrument_flask(app)
 
 # Dapr sidecar endpoint
-DAPR_HTTP_PORT = 3500
+DAPR_HTTP_PORT = int(os.getenv("DAPR_HTTP_PORT", "3500"))
 DAPR_URL = f"http://localhost:{DAPR_HTTP_PORT}"
 
+# Shared, pooled client for all sidecar calls
+dapr = DaprClient(DAPR_URL)
+
+# Secondary indexes used by GET /orders; members are order IDs scored by
+# created_at. Each index document holds one time bucket of one partition, so
+# creating an order only rewrites small documents of the current bucket.
+ORDER_INDEX_PARTITIONS = int(os.getenv("ORDER_INDEX_PARTITIONS", "32"))
+ORDER_INDEX_BUCKET_SECONDS = int(os.getenv("ORDER_INDEX_BUCKET_SECONDS", "60"))
+ORDER_CUSTOMER_INDEX_BUCKET_SECONDS = int(os.getenv("ORDER_CUSTOMER_INDEX_BUCKET_SECONDS", "86400"))
+all_orders_index = BucketedIndex("order-index:all", ORDER_INDEX_BUCKET_SECONDS, ORDER_INDEX_PARTITIONS)
+
+# Order events are written to an outbox together with the order and relayed in bulk
+outbox = Outbox(
+    dapr,
+    name="order-outbox",
+    partitions=int(os.getenv("OUTBOX_INDEX_PARTITIONS", "32")),
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("OUTBOX_FLUSH_INTERVAL", "0.02")),
+    sweep_interval=float(os.getenv("OUTBOX_SWEEP_INTERVAL", "5")),
+    stale_after=float(os.getenv("OUTBOX_STALE_AFTER", "10")),
+    bucket_seconds=float(os.getenv("OUTBOX_INDEX_BUCKET_SECONDS", "10"))
+)
+metrics.REGISTRY.register_stats("order_outbox", outbox.stats)
+metrics.REGISTRY.register_stats("log_queue", log_handler.stats)
+
+# Limits for POST /orders/batch; each chunk of a batch is saved in one state transaction
+MAX_BATCH_SIZE = int(os.getenv("ORDER_BATCH_MAX_SIZE", "1000"))
+BATCH_CHUNK_SIZE = int(os.getenv("ORDER_BATCH_CHUNK_SIZE", "250"))
+
+DEFAULT_PAGE_SIZE = int(os.getenv("ORDER_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("ORDER_MAX_PAGE_SIZE", "500"))
+
+def customer_index(customer_id):
+    return BucketedIndex(f"order-index:customer:{customer_id}", ORDER_CUSTOMER_INDEX_BUCKET_SECONDS)
+
+def status_index(status):
+    return BucketedIndex(f"order-index:status:{status}", ORDER_INDEX_BUCKET_SECONDS, ORDER_INDEX_PARTITIONS)
+
+def new_order_index_changes(order):
+    """Index changes for a newly created order"""
+    return [
+        all_orders_index.add(order["order_id"], order["created_at"]),
+        customer_index(order["customer_id"]).add(order["order_id"], order["created_at"]),
+        status_index(order["status"]).add(order["order_id"], order["created_at"])
+    ]
+
+def status_change_index_changes(order, previous_status):
+    """Index changes for an order moving from previous_status to its current status"""
+    if previous_status == order["status"]:
+        return []
+    return [
+        status_index(previous_status).remove(order["order_id"], order["created_at"]),
+        status_index(order["status"]).add(order["order_id"], order["created_at"])
+    ]
+
+def order_write(order, event, index_changes, etag=None):
+    """Operations, index changes and outbox record that save an order together with its event"""
+    record = outbox.record("order-events", event)
+    outbox_operations, outbox_index_changes = outbox.add(record)
+    return (
+        [upsert_operation(f"order:{order['order_id']}", order, etag)] + outbox_operations,
+        index_changes + outbox_index_changes,
+        record
+    )
+
+def order_batch_write(orders):
+    """Operations, index changes and outbox records that save a chunk of new orders"""
+    operations, index_changes, records = [], [], []
+    for order in orders:
+        order_operations, order_index_changes, record = order_write(
+            order, order_created_event(order), new_order_index_changes(order)
+        )
+        operations.extend(order_operations)
+        index_changes.extend(order_index_changes)
+        records.append(record)
+    return operations, index_changes, records
+
+def prepare_order_batch(batch_data):
+    """Validate a batch payload; returns (results, accepted) or raises ValueError.
+
+    results has one entry per submitted order, in order; accepted lists
+    (position, order) for the orders that passed validation.
+    """
+    orders_data = batch_data.get("orders") if isinstance(batch_data, dict) else batch_data
+    if not isinstance(orders_data, list) or not orders_data:
+        raise ValueError("Expected a non-empty list of orders")
+    if len(orders_data) > MAX_BATCH_SIZE:
+        raise ValueError(f"A batch may contain at most {MAX_BATCH_SIZE} orders")
+    
+    results = []
+    accepted = []
+    for position, order_data in enumerate(orders_data):
+        error = validate_order(order_data) if isinstance(order_data, dict) else "Order must be a JSON object"
+        if error:
+            results.append({"index": position, "status": "rejected", "error": error})
+            continue
+        order = build_order(order_data)
+        results.append({"index": position, "status": "created", "order": order})
+        accepted.append((position, order))
+    return results, accepted
+
+def batch_chunks(accepted):
+    """Split accepted (position, order) pairs into per-transaction chunks"""
+    return [accepted[start:start + BATCH_CHUNK_SIZE] for start in range(0, len(accepted), BATCH_CHUNK_SIZE)]
+
+def fail_chunk(results, chunk):
+    """Mark every order of a chunk that could not be saved as failed"""
+    for position, _ in chunk:
+        results[position] = {"index": position, "status": "failed", "error": "Failed to save order"}
+
+def batch_response(results):
+    """Summary body and status code for POST /orders/batch"""
+    created = sum(1 for result in results if result["status"] == "created")
+    body = {
+        "results": results,
+        "created": created,
+        "rejected": sum(1 for result in results if result["status"] == "rejected"),
+        "failed": sum(1 for result in results if result["status"] == "failed")
+    }
+    return body, 201 if created == len(results) else 207
+
+@app.before_request
+def start_outbox_relay():
+    """Start this process's outbox relay so that leftover events get swept"""
+    outbox.start()
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
     return jsonify({"status": "healthy", "service": "order-service"})
 
+def validate_order(order_data):
+    """Return an error message if the order payload is invalid, else None"""
+    required_fields = ['customer_id', 'items']
+    for field in required_fields:
+        if field not in order_data:
+            return f"Missing required field: {field}"
+    return None
+
+def build_order(order_data):
+    """Build a new order record with a generated ID and timestamp"""
+    return {
+        "order_id": str(uuid.uuid4()),
+        "customer_id": order_data["customer_id"],
+        "items": order_data["items"],
+        "status": "pending",
+        "created_at": datetime.utcnow().isoformat(),
+        "total_amount": sum(item.get("price", 0) * item.get("quantity", 1) for item in order_data["items"])
+    }
+
+def order_created_event(order):
+    """Build the order_created event published for a new order"""
+    return {
+        "event_id": str(uuid.uuid4()),
+        "order_id": order["order_id"],
+        "customer_id": order["customer_id"],
+        "items": order["items"],
+        "total_amount": order["total_amount"],
+        "event_type": "order_created"
+    }
+
 @app.route('/orders', methods=['POST'])
 def create_order():
     """Create a new order and publish event"""
     try:
         order_data = request.json
         
-        # Validate required fields
-        required_fields = ['customer_id', 'items']
-        for field in required_fields:
-            if field not in order_data:
-                return jsonify({"error": f"Missing required field: {field}"}), 400
-        
-        # Generate order ID and timestamp
-        order_id = str(uuid.uuid4())
-        order = {
-            "order_id": order_id,
-            "customer_id": order_data["customer_id"],
-            "items": order_data["items"],
-            "status": "pending",
-            "created_at": datetime.utcnow().isoformat(),
-            "total_amount": sum(item.get("price", 0) * item.get("quantity", 1) for item in order_data["items"])
-        }
-        
-        # Save order to state store
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore"
-        state_data = [{"key": f"order:{order_id}", "value": order}]
-        
-        response = requests.post(state_url, json=state_data)
-        if response.status_code != 204:
-            app.logger.error(f"Failed to save order to state store: {response.text}")
-            return jsonify({"error": "Failed to save order"}), 500
+        error = validate_order(order_data)
+        if error:
+            return jsonify({"error": error}), 400
         
-        # Publish order created event
-        event_data = {
-            "order_id": order_id,
-            "customer_id": order["customer_id"],
-            "items": order["items"],
-            "total_amount": order["total_amount"],
-            "event_type": "order_created"
-        }
+        order = build_order(order_data)
+        order_id = order["order_id"]
         
-        pubsub_url = f"{DAPR_URL}/v1.0/publish/redis-pubsub/order-events"
-        publish_response = requests.post(pubsub_url, json=event_data)
+        # Save order, index entries and order created event in one transaction
+        event = order_created_event(order)
+        try:
+            record = transact_with_indexes(dapr, lambda: order_write(order, event, new_order_index_changes(order)))
+        except (DaprError, IndexConflictError) as e:
+            app.logger.error(f"Failed to save order to state store: {e}")
+            return jsonify({"error": "Failed to save order"}), 500
         
-        if publish_response.status_code != 204:
-            app.logger.error(f"Failed to publish event: {publish_response.text}")
+        # Publish order created event
+        outbox.notify([record])
         
         app.logger.info(f"Order created: {order_id}")
         return jsonify(order), 201
@@ -71,20 +211,49 @@ def create_order():
         app.logger.error(f"Error creating order: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/orders/batch', methods=['POST'])
+def create_orders_batch():
+    """Create many orders in one request, with a result per order"""
+    try:
+        try:
+            results, accepted = prepare_order_batch(request.json)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Save each chunk of orders, index entries and events in one transaction
+        for chunk in batch_chunks(accepted):
+            orders = [order for _, order in chunk]
+            try:
+                records = transact_with_indexes(dapr, lambda: order_batch_write(orders))
+            except (DaprError, IndexConflictError) as e:
+                app.logger.error(f"Failed to save {len(chunk)} batched orders: {e}")
+                fail_chunk(results, chunk)
+                continue
+            
+            # Publish order created events in bulk
+            outbox.notify(records)
+        
+        body, status_code = batch_response(results)
+        app.logger.info(f"Order batch processed: {body['created']} created, {body['rejected']} rejected, {body['failed']} failed")
+        return jsonify(body), status_code
+        
+    except Exception as e:
+        app.logger.error(f"Error creating order batch: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
 @app.route('/orders/<order_id>', methods=['GET'])
 def get_order(order_id):
     """Get order by ID"""
     try:
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore/order:{order_id}"
-        response = requests.get(state_url)
+        try:
+            order = dapr.get_state(f"order:{order_id}")
+        except DaprError as e:
+            app.logger.error(f"Failed to retrieve order {order_id}: {e}")
+            return jsonify({"error": "Failed to retrieve order"}), 500
         
-        if response.status_code == 204:  # No content means key doesn't exist
+        if order is None:  # No content means key doesn't exist
             return jsonify({"error": "Order not found"}), 404
         
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to retrieve order"}), 500
-        
-        order = response.json()
         return jsonify(order)
         
     except Exception as e:
@@ -101,34 +270,42 @@ def update_order_status(order_id):
         if not new_status:
             return jsonify({"error": "Status is required"}), 400
         
-        # Get current order
-        state_url = f"{DAPR_URL}/v1.0/state/redis-statestore/order:{order_id}"
-        response = requests.get(state_url)
-        
-        if response.status_code == 204:
-            return jsonify({"error": "Order not found"}), 404
-        
-        order = response.json()
-        order["status"] = new_status
-        order["updated_at"] = datetime.utcnow().isoformat()
+        def prepare():
+            # Get current order
+            order, etag = dapr.get_state_with_etag(f"order:{order_id}")
+            if order is None:
+                return None
+            
+            previous_status = order["status"]
+            order["status"] = new_status
+            order["updated_at"] = datetime.utcnow().isoformat()
+            
+            # Status update event, committed with the order through the outbox
+            event_data = {
+                "event_id": str(uuid.uuid4()),
+                "order_id": order_id,
+                "customer_id": order["customer_id"],
+                "status": new_status,
+                "event_type": "order_status_updated"
+            }
+            operations, index_changes, record = order_write(
+                order, event_data, status_change_index_changes(order, previous_status), etag
+            )
+            return operations, index_changes, (order, record)
         
-        # Update order in state store
-        state_data = [{"key": f"order:{order_id}", "value": order}]
-        update_response = requests.post(state_url.replace(f"/order:{order_id}", ""), json=state_data)
-        
-        if update_response.status_code != 204:
+        # Update order in state store and move it between status indexes
+        try:
+            updated = transact_with_indexes(dapr, prepare)
+        except (DaprError, IndexConflictError) as e:
+            app.logger.error(f"Failed to update order {order_id}: {e}")
             return jsonify({"error": "Failed to update order"}), 500
         
-        # Publish status update event
-        event_data = {
-            "order_id": order_id,
-            "customer_id": order["customer_id"],
-            "status": new_status,
-            "event_type": "order_status_updated"
-        }
+        if updated is None:
+            return jsonify({"error": "Order not found"}), 404
         
-        pubsub_url = f"{DAPR_URL}/v1.0/publish/redis-pubsub/order-events"
-        requests.post(pubsub_url, json=event_data)
+        # Publish status update event
+        order, record = updated
+        outbox.notify([record])
         
         app.logger.info(f"Order {order_id} status updated to {new_status}")
         return jsonify(order)
@@ -137,17 +314,88 @@ def update_order_status(order_id):
         app.logger.error(f"Error updating order status: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+def parse_timestamp(value):
+    """Normalise an ISO-8601 query parameter to the naive UTC format of created_at"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.isoformat()
+
+def orders_in_status(entries, status, limit):
+    """Fetch the orders of index entries until limit of them have status; returns (orders, next_after)"""
+    orders = []
+    entries = iter(entries)
+    while True:
+        chunk = list(itertools.islice(entries, limit))
+        if not chunk:
+            return orders, None
+        records = dapr.get_bulk_state([f"order:{order_id}" for _, order_id in chunk])
+        for entry in chunk:
+            order = records.get(f"order:{entry[1]}")
+            if order is None or order["status"] != status:
+                continue
+            if len(orders) == limit:
+                return orders, last_entry
+            orders.append(order)
+            last_entry = entry
+
 @app.route('/orders', methods=['GET'])
 def list_orders():
-    """List all orders (simple implementation)"""
+    """List orders, filtered by customer_id/status/since/until and paginated with limit/after"""
     try:
-        # Note: In a production system, you'd implement proper pagination and filtering
-        # This is a simplified version for demo purposes
-        return jsonify({"message": "Use GET /orders/{order_id} to retrieve specific orders"}), 200
+        args = request.args
+        try:
+            limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+            if limit < 1 or limit > MAX_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+            since = parse_timestamp(args["since"]) if args.get("since") else None
+            until = parse_timestamp(args["until"]) if args.get("until") else None
+            after = tuple(args["after"].split("|", 1)) if args.get("after") else None
+            if after is not None and len(after) != 2:
+                raise ValueError("malformed cursor")
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+        
+        customer_id = args.get("customer_id")
+        status = args.get("status")
+        
+        # Scan the narrowest index, reading only the buckets this page needs
+        if customer_id:
+            index = customer_index(customer_id)
+        elif status:
+            index = status_index(status)
+        else:
+            index = all_orders_index
+        entries = index.scan(dapr, min_score=since, max_score=until, after=after)
+        
+        if customer_id and status:
+            orders, next_after = orders_in_status(entries, status, limit)
+        else:
+            entries, next_after = take(entries, limit)
+            keys = [f"order:{order_id}" for _, order_id in entries]
+            records = dapr.get_bulk_state(keys)
+            orders = [records[key] for key in keys if key in records]
+        
+        return jsonify({
+            "orders": orders,
+            "count": len(orders),
+            "next_cursor": "|".join(next_after) if next_after else None
+        }), 200
         
     except Exception as e:
         app.logger.error(f"Error listing orders: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/orders/outbox/stats', methods=['GET'])
+def outbox_stats():
+    """Outbox depth, relay throughput and publish lag"""
+    return jsonify(outbox.stats())
+
+def shutdown():
+    """Publish pending outbox events and release sidecar connections before the process exits"""
+    outbox.close()
+    dapr.close()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # Local development server; production runs under gunicorn (common/gunicorn_config.py)
+    app.run(host='0.0.0.0', port=5001, threaded=True)
@@ -0,0 +1,118 @@
+"""ASGI serving mode for the order service.
+
+The sidecar-heavy routes run natively on asyncio with AsyncDaprClient, so a
+single process can keep thousands of requests in flight while they wait on
+the sidecar. Every other route is served by the Flask app through
+WSGIMiddleware.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 5001
+"""
+import logging
+
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.routing import Mount, Route
+
+import app as flask_service
+from common import metrics
+from common.async_dapr_client import AsyncDaprClient
+from common.codec import json_response, request_json
+from common.dapr_client import DaprError
+from common.state_index import IndexConflictError, transact_with_indexes_async
+
+logger = logging.getLogger("order-service.asgi")
+
+dapr = AsyncDaprClient(flask_service.DAPR_URL)
+
+
+@metrics.asgi_endpoint("/orders")
+async def create_order(request):
+    """Create a new order and publish event"""
+    try:
+        order_data = await request_json(request)
+
+        error = flask_service.validate_order(order_data)
+        if error:
+            return json_response({"error": error}, status_code=400)
+
+        order = flask_service.build_order(order_data)
+        order_id = order["order_id"]
+
+        # Save the order, its index entries and its event through the outbox
+        event = flask_service.order_created_event(order)
+        try:
+            record = await transact_with_indexes_async(
+                dapr,
+                lambda: flask_service.order_write(order, event, flask_service.new_order_index_changes(order))
+            )
+        except (DaprError, IndexConflictError) as e:
+            logger.error(f"Failed to save order to state store: {e}")
+            return json_response({"error": "Failed to save order"}, status_code=500)
+
+        flask_service.outbox.notify([record])
+
+        logger.info(f"Order created: {order_id}")
+        return json_response(order, status_code=201)
+
+    except Exception as e:
+        logger.error(f"Error creating order: {str(e)}")
+        return json_response({"error": "Internal server error"}, status_code=500)
+
+
+@metrics.asgi_endpoint("/orders/batch")
+async def create_orders_batch(request):
+    """Create many orders in one request, with a result per order"""
+    try:
+        try:
+            results, accepted = flask_service.prepare_order_batch(await request_json(request))
+        except ValueError as e:
+            return json_response({"error": str(e)}, status_code=400)
+
+        for chunk in flask_service.batch_chunks(accepted):
+            orders = [order for _, order in chunk]
+            try:
+                records = await transact_with_indexes_async(dapr, lambda: flask_service.order_batch_write(orders))
+            except (DaprError, IndexConflictError) as e:
+                logger.error(f"Failed to save {len(chunk)} batched orders: {e}")
+                flask_service.fail_chunk(results, chunk)
+                continue
+
+            flask_service.outbox.notify(records)
+
+        body, status_code = flask_service.batch_response(results)
+        logger.info(f"Order batch processed: {body['created']} created, {body['rejected']} rejected, {body['failed']} failed")
+        return json_response(body, status_code=status_code)
+
+    except Exception as e:
+        logger.error(f"Error creating order batch: {str(e)}")
+        return json_response({"error": "Internal server error"}, status_code=500)
+
+
+@metrics.asgi_endpoint("/orders/<order_id>")
+async def get_order(request):
+    """Get order by ID"""
+    order_id = request.path_params["order_id"]
+    try:
+        order = await dapr.get_state(f"order:{order_id}")
+    except DaprError as e:
+        logger.error(f"Failed to retrieve order {order_id}: {e}")
+        return json_response({"error": "Failed to retrieve order"}, status_code=500)
+    except Exception as e:
+        logger.error(f"Error retrieving order: {str(e)}")
+        return json_response({"error": "Internal server error"}, status_code=500)
+
+    if order is None:
+        return json_response({"error": "Order not found"}, status_code=404)
+    return json_response(order)
+
+
+app = Starlette(
+    routes=[
+        Route("/orders", create_order, methods=["POST"]),
+        Route("/orders/batch", create_orders_batch, methods=["POST"]),
+        Route("/orders/{order_id}", get_order, methods=["GET"]),
+        Mount("/", WSGIMiddleware(flask_service.app)),
+    ],
+    on_startup=[flask_service.outbox.start],
+    on_shutdown=[flask_service.outbox.close, dapr.close],
+)
@@ -30,6 +30,9 @@ try {
 # Set the resources path (formerly components path)
 $resourcesPath = Join-Path $PSScriptRoot "..\dapr-components"
 
+# Make the shared helpers in common/ importable by every service
+$env:PYTHONPATH = (Resolve-Path (Join-Path $PSScriptRoot "..")).Path
+
 Write-Host "Starting Order Service..." -ForegroundColor Cyan
 Start-Process PowerShell -ArgumentList "-NoExit", "-Command", "cd '$PSScriptRoot\..\order-service'; dapr run --app-id order-service --app-port 5001 --dapr-http-port 3500 --resources-path '$resourcesPath' -- python app.py"
 
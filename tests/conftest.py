@@ -0,0 +1,40 @@
+"""Shared fixtures: one fake Dapr sidecar for the whole test session.
+
+The services import their own modules by bare name (app, reservations,
+coalescer, ...), so each test module puts its service's directory on the
+path itself, and a session only ever imports one service's app.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_sidecar import FakeDapr  # noqa: E402
+from benchmarks.run import free_port  # noqa: E402
+from common.dapr_client import DaprClient  # noqa: E402
+
+
+def use_service(service):
+    """Make a service's modules importable"""
+    path = os.path.join(ROOT, service)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope="session")
+def fake_dapr():
+    """The fake sidecar; DAPR_HTTP_PORT points at it for apps imported afterwards"""
+    fake = FakeDapr()
+    port = free_port()
+    fake.serve(port)
+    os.environ["DAPR_HTTP_PORT"] = str(port)
+    yield fake
+    fake.shutdown()
+
+
+@pytest.fixture
+def dapr(fake_dapr):
+    return DaprClient(f"http://127.0.0.1:{os.environ['DAPR_HTTP_PORT']}")
@@ -0,0 +1,100 @@
+import time
+
+from conftest import use_service
+
+use_service("notification-service")
+
+from channels import FakeChannel  # noqa: E402
+from coalescer import HeldStore, Hold, NotificationCoalescer, settle  # noqa: E402
+from common.state_index import transact_with_indexes  # noqa: E402
+
+
+def notification(order_id, notification_type, message):
+    return {
+        "recipient": "customer-1",
+        "message": message,
+        "notification_type": notification_type,
+        "related_data": {"order_id": order_id},
+    }
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_counterpart_within_window_is_merged():
+    channel = FakeChannel()
+    coalescer = NotificationCoalescer(channel.send, window=0.2, max_pending=10)
+
+    ready, hold = coalescer.submit(notification("o1", "order_confirmation", "Order placed."), key="e1")
+    assert ready == [] and hold is not None
+    ready, second = coalescer.submit(notification("o1", "inventory_reserved", "Items reserved."), key="e2")
+
+    assert second is None
+    [(merged, merged_hold)] = ready
+    assert merged_hold is hold
+    assert merged["notification_type"] == "inventory_reserved"
+    assert merged["message"] == "Order placed. Items reserved."
+    assert merged["related_data"]["coalesced"] == ["order_confirmation", "inventory_reserved"]
+
+    time.sleep(0.3)
+    assert list(channel.sent) == []
+    assert coalescer.stats()["merged"] == 1
+
+
+def test_held_notification_is_sent_alone_when_window_ends():
+    channel = FakeChannel()
+    coalescer = NotificationCoalescer(channel.send, window=0.05, max_pending=10)
+
+    held = notification("o2", "order_confirmation", "Order placed.")
+    coalescer.submit(held, key="e1")
+    wait_for(lambda: len(channel.sent) == 1)
+    assert channel.sent[0] is held
+    assert coalescer.stats()["sent_alone"] == 1
+
+    # The counterpart came too late, so it is not held either
+    late = notification("o2", "inventory_reserved", "Items reserved.")
+    assert coalescer.submit(late, key="e2") == ([(late, None)], None)
+
+
+def test_failed_send_is_retried_alone():
+    channel = FakeChannel()
+    coalescer = NotificationCoalescer(channel.send, window=0.05, max_pending=10)
+
+    _, hold = coalescer.submit(notification("o3", "order_confirmation", "Order placed."), key="e1")
+    [(merged, merged_hold)], _ = coalescer.submit(notification("o3", "inventory_reserved", "Items reserved."), key="e2")
+    coalescer.retry(merged_hold)
+
+    wait_for(lambda: len(channel.sent) == 1)
+    assert channel.sent[0] is hold.notification
+    assert coalescer.stats()["retried"] == 1
+
+
+def test_sent_hold_has_its_saved_copy_deleted(dapr, fake_dapr):
+    channel = FakeChannel()
+    store = HeldStore(dapr, name="test-held-sent")
+    coalescer = NotificationCoalescer(channel.send, window=0.05, max_pending=10, store=store, sweep_interval=0)
+
+    _, hold = coalescer.submit(notification("o4", "order_confirmation", "Order placed."), key="e1")
+    transact_with_indexes(dapr, lambda: store.add(hold) + (True,))
+    settle(hold.stored)
+    assert store.key(hold.record_id) in fake_dapr.state
+
+    wait_for(lambda: len(channel.sent) == 1)
+    wait_for(lambda: store.key(hold.record_id) not in fake_dapr.state)
+
+
+def test_sweep_resends_holds_left_by_a_dead_process(dapr, fake_dapr):
+    store = HeldStore(dapr, name="test-held-sweep", bucket_seconds=1.0, stale_after=0.0, sweep_lookback=60.0)
+    orphan = Hold("o5", "order", notification("o5", "order_confirmation", "Order placed."), "e1", 0)
+    orphan.held_at = time.time() - 5
+    transact_with_indexes(dapr, lambda: store.add(orphan) + (True,))
+
+    resent = []
+    assert store.sweep(lambda records: resent.extend(records) or True, lambda record: False) == 1
+    assert [record["notification"] for record in resent] == [orphan.notification]
+    assert store.key(orphan.record_id) not in fake_dapr.state
+    assert store.sweep(lambda records: resent.extend(records) or True, lambda record: False) == 0
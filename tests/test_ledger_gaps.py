@@ -0,0 +1,56 @@
+import importlib
+
+import pytest
+from starlette.testclient import TestClient
+
+from conftest import use_service
+
+use_service("inventory-service")
+
+
+@pytest.fixture(scope="module")
+def inventory(fake_dapr):
+    """The inventory service in ledger mode, against the fake sidecar"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("INVENTORY_MODE", "ledger")
+        monkeypatch.setenv("INVENTORY_LEDGER_COMPACT_INTERVAL", "0")
+        app = importlib.import_module("app")
+        asgi = importlib.import_module("asgi")
+    yield app, asgi
+
+
+def break_ledger(client, fake_dapr, product_id):
+    """Create a product with a few pending changes, then lose the middle one"""
+    client.post("/inventory", json={"product_id": product_id, "quantity": 10})
+    for i in range(3):
+        client.post(f"/inventory/{product_id}/reserve", json={"quantity": 1, "order_id": f"{product_id}-{i}"})
+    changes = sorted(
+        (key for key in fake_dapr.state if key.startswith(f"inventory-ledger:{product_id}:")),
+        key=lambda key: int(key.rsplit(":", 1)[1])
+    )
+    del fake_dapr.state[changes[1]]
+
+
+def test_flask_answers_a_ledger_gap_with_409(inventory, fake_dapr):
+    app, _ = inventory
+    client = app.app.test_client()
+    break_ledger(client, fake_dapr, "gap-flask")
+    app.inventory_cache.clear()
+
+    response = client.get("/inventory/gap-flask")
+    assert response.status_code == 409
+    assert response.get_json() == {"error": "Change 2 of the ledger of gap-flask is missing"}
+
+    response = client.post("/inventory/gap-flask/reserve", json={"quantity": 1, "order_id": "gap-flask-more"})
+    assert response.status_code == 409
+
+
+def test_asgi_answers_a_ledger_gap_with_409(inventory, fake_dapr):
+    app, asgi = inventory
+    with TestClient(asgi.app) as client:
+        break_ledger(client, fake_dapr, "gap-asgi")
+        app.inventory_cache.clear()
+
+        response = client.get("/inventory/gap-asgi")
+    assert response.status_code == 409
+    assert response.json() == {"error": "Change 2 of the ledger of gap-asgi is missing"}
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import use_service
+
+use_service("inventory-service")
+
+import ledger  # noqa: E402
+import reservations  # noqa: E402
+from common.dapr_client import EtagMismatchError  # noqa: E402
+
+BUCKET = timedelta(seconds=reservations.EXPIRY_BUCKET_SECONDS)
+
+
+class Clock(datetime):
+    """datetime whose utcnow() is set by the test"""
+
+    now = None
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now
+
+
+class LosesFirstRace:
+    """Dapr client whose first transaction loses a write race while the clock crosses an expiry bucket"""
+
+    def __init__(self, dapr):
+        self.dapr = dapr
+        self.transactions = 0
+
+    def __getattr__(self, name):
+        return getattr(self.dapr, name)
+
+    def transact_state(self, operations):
+        self.transactions += 1
+        if self.transactions == 1:
+            Clock.now += BUCKET
+            raise EtagMismatchError("lost the race")
+        return self.dapr.transact_state(operations)
+
+
+@pytest.mark.parametrize("mode", [reservations, ledger], ids=["state", "ledger"])
+def test_retry_after_bucket_rollover_reserves_into_the_new_bucket(mode, dapr, fake_dapr, monkeypatch):
+    monkeypatch.setattr(mode, "datetime", Clock)
+    product_id = f"rollover-{mode.__name__}"
+    start = datetime(2030, 1, 1) + BUCKET * 10 + timedelta(seconds=1)
+    Clock.now = start + BUCKET
+    mode.add_stock(dapr, product_id, 10)
+
+    # Another order's hold already created the next bucket's document
+    mode.reserve_items(dapr, "rollover-first", [{"product_id": product_id, "quantity": 1}])
+
+    Clock.now = start
+    racing = LosesFirstRace(dapr)
+    result = mode.reserve_items(racing, "rollover-second", [{"product_id": product_id, "quantity": 1}], max_retries=3)
+
+    assert result["all_items_reserved"]
+    assert racing.transactions == 2
+    index = reservations.expiry_index(product_id)
+    expires_at = reservations.expiry_of((start + BUCKET).isoformat())
+    holds = fake_dapr.state[index.document_key(None, expires_at)][0]
+    assert sorted(holds) == [
+        reservations.reservation_key("rollover-first", product_id),
+        reservations.reservation_key("rollover-second", product_id),
+    ]